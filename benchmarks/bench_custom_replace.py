@@ -0,0 +1,70 @@
+"""
+Microbenchmark: compiled ReplaceEngine against the previous one re.sub per pair custom_replace.
+
+Usage (from the extension directory):
+    python benchmarks/bench_custom_replace.py [--pairs 50 300 1000] [--images 200]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch.text import ReplaceEngineCache
+
+# Previous implementation, kept here as the reference for output and speed
+def legacy_custom_replace(text, replace_pairs):
+    for old, new in replace_pairs.items():
+        text = re.sub(r'\b' + re.escape(old) + r'\b', new, text)
+    return text
+
+def legacy_parse_replace_pairs(custom_replace_find, custom_replace_replacements):
+    old_list = [phrase.strip() for phrase in custom_replace_find.split(',')]
+    new_list = [phrase.strip() for phrase in custom_replace_replacements.split(',')]
+    min_length = min(len(old_list), len(new_list))
+    return {old_list[i]: new_list[i] for i in range(min_length)}
+
+def make_vocabulary(size, rng):
+    syllables = ["ka", "ri", "mo", "to", "na", "shi", "ro", "ze", "lu", "pa", "hair", "eyes", "dress", "sky", "smile"]
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add("_".join(rng.choice(syllables) + rng.choice(syllables) for _ in range(rng.randint(1, 3))))
+    return sorted(vocabulary)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, nargs="+", default=[50, 300, 1000], help="number of find & replace pairs")
+    parser.add_argument("--images", type=int, default=200, help="interrogations processed per size")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(max(args.pairs) * 4, rng)
+    print(f"{'pairs':>6} {'runs':>5} {'legacy ms/img':>14} {'compiled ms/img':>16} {'speedup':>8}")
+    for size in args.pairs:
+        finds = rng.sample(vocabulary, size)
+        # Aliases in the style of booru tag-alias data: underscores to spaces, plus a few renames
+        replacements = [find.replace("_", " ") if rng.random() < 0.8 else rng.choice(vocabulary) for find in finds]
+        custom_replace_find = ", ".join(finds)
+        custom_replace_replacements = ", ".join(replacements)
+        interrogations = [", ".join(rng.sample(vocabulary, 60)) for _ in range(args.images)]
+
+        started = time.perf_counter()
+        legacy = [legacy_custom_replace(text, legacy_parse_replace_pairs(custom_replace_find, custom_replace_replacements)) for text in interrogations]
+        legacy_time = time.perf_counter() - started
+
+        engines = ReplaceEngineCache()
+        started = time.perf_counter()
+        compiled = [engines.from_text(custom_replace_find, custom_replace_replacements).apply(text) for text in interrogations]
+        compiled_time = time.perf_counter() - started
+
+        if legacy != compiled:
+            raise SystemExit(f"Output mismatch at {size} pairs")
+        runs = len(engines.from_text(custom_replace_find, custom_replace_replacements).runs)
+        print(f"{size:>6} {runs:>5} {legacy_time / args.images * 1000:>14.3f} {compiled_time / args.images * 1000:>16.3f} {legacy_time / compiled_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
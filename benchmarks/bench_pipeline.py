@@ -0,0 +1,209 @@
+"""
+Offline benchmark of the process_batch text path, with deterministic stub interrogators instead of the real models.
+
+Every synthetic image goes through the same chain as process_batch: one interrogation per selected model,
+dedupe, find & replace, positive/negative/custom filters, punctuation removal, underscore fix (WD),
+prompt weighting and prompt assembly. Per-stage and end-to-end throughput are compared against a stored
+baseline, together with a digest of every generated prompt so output changes are caught as well.
+
+Usage (from the extension directory):
+    python benchmarks/bench_pipeline.py [--images 2000] [--models "Deepbooru (Native)" "WD (EXT)"]
+    python benchmarks/bench_pipeline.py --save-baseline    # after an intended change, or on a new machine
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch.pipeline import assemble_prompt, post_processing_stages, replace_underscores, run_stages, weight_interrogation
+from lib_tag_batch.text import ReplaceEngineCache, TagFilterCache
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_pipeline.json")
+MODELS = ["Deepbooru (Native)", "CLIP (Native)", "CLIP (EXT)", "WD (EXT)"]
+SYLLABLES = ["ka", "ri", "mo", "to", "na", "shi", "ro", "ze", "lu", "pa"]
+WORDS = ["hair", "eyes", "dress", "sky", "smile", "long", "short", "blue", "red", "open", "mouth", "holding", "looking", "at", "viewer", "outdoors", "skirt"]
+RATINGS = ["general", "sensitive", "questionable", "explicit"]
+
+# Booru style vocabulary: underscored tags, some with a qualifier in parentheses, a few underscore emoticons
+def make_vocabulary(size, rng):
+    vocabulary = {"o_o", "^_^", "x_x", "1girl", "solo"}
+    while len(vocabulary) < size:
+        tag = "_".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+        if rng.random() < 0.05:
+            tag += f"_({rng.choice(SYLLABLES)}{rng.choice(SYLLABLES)})"
+        vocabulary.add(tag)
+    return sorted(vocabulary)
+
+class StubDeepbooru:
+    """Stands in for deepbooru.model.tag: spaced, sorted tags with escaped parentheses."""
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def tag(self, image):
+        rng = random.Random(f"deepbooru{image}")
+        tags = sorted(rng.sample(self.vocabulary, 35))
+        return ", ".join(tag.replace("_", " ").replace("(", "\\(").replace(")", "\\)") for tag in tags)
+
+class StubInterrogator:
+    """Stands in for shared.interrogator.interrogate: a caption followed by medium, artist and flavor phrases."""
+
+    def interrogate(self, image):
+        rng = random.Random(f"clip{image}")
+        caption = "a " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 14)))
+        flavors = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))) for _ in range(12)]
+        return ", ".join([caption, f"by {rng.choice(SYLLABLES)}{rng.choice(SYLLABLES)}"] + flavors)
+
+class StubClipExt:
+    """Stands in for the clip-interrogator-ext module: image_to_prompt(image, mode, model)."""
+
+    def image_to_prompt(self, image, mode, clip_model):
+        rng = random.Random(f"clip_ext{image}{mode}{clip_model}")
+        caption = "a " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 16)))
+        flavors = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))) for _ in range(30 if mode == "best" else 10)]
+        return ", ".join([caption] + flavors) + ", 8k :)"
+
+class StubWDInterrogator:
+    """Stands in for a wd_ext_utils.interrogators entry: interrogate(image) returns rating and tag confidence dicts."""
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def interrogate(self, image):
+        rng = random.Random(f"wd{image}")
+        ratings = {rating: rng.random() for rating in RATINGS}
+        # Most tags are close to zero, a few dozen clear the usual thresholds
+        tags = {tag: rng.random() ** 12 for tag in self.vocabulary}
+        return ratings, tags
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = {}
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def record(self, name, seconds, before, after):
+        self.add(name, seconds)
+
+    def timed(self, name, fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        self.add(name, time.perf_counter() - started)
+        return result
+
+def make_settings(vocabulary, rng):
+    spaced = [replace_underscores(tag) for tag in vocabulary]
+    finds = rng.sample(spaced, 300)
+    return {
+        "prompt": "masterpiece, best quality, " + ", ".join(rng.sample(spaced, 10)),
+        "negative_prompt": "lowres, bad anatomy, " + ", ".join(rng.sample(spaced, 20)),
+        "custom_filter": ", ".join(rng.sample(spaced, 1000)),
+        "custom_replace_find": ", ".join(finds),
+        "custom_replace_replacements": ", ".join(find.upper() if rng.random() < 0.5 else rng.choice(spaced) for find in finds),
+    }
+
+def run(args, models):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    settings = make_settings(vocabulary, rng)
+    deepbooru, interrogator, clip_ext, wd = StubDeepbooru(vocabulary), StubInterrogator(), StubClipExt(), StubWDInterrogator(vocabulary)
+    tag_filters, replace_engines = TagFilterCache(), ReplaceEngineCache()
+    wd_tag_store = None
+    if "WD (EXT)" in models:
+        from lib_tag_batch.wd_store import TagConfidenceStore
+        wd_tag_store = TagConfidenceStore(os.path.join(tempfile.mkdtemp(), "wd_vocabulary.json"), replace_underscores)
+
+    timer = StageTimer()
+    digest = hashlib.blake2b(digest_size=16)
+    started = time.perf_counter()
+    for image in range(args.images):
+        interrogation = ""
+        for model in models:
+            if model == "Deepbooru (Native)":
+                interrogation += f"{timer.timed(model, deepbooru.tag, image)}, "
+            elif model == "CLIP (Native)":
+                interrogation += f"{timer.timed(model, interrogator.interrogate, image)}, "
+            elif model == "CLIP (EXT)":
+                interrogation += f"{timer.timed(model, clip_ext.image_to_prompt, image, 'fast', 'ViT-L-14/openai')}, "
+            elif model == "WD (EXT)":
+                rating, tags = timer.timed(model, wd.interrogate, image)
+                # Underscore fix is applied by the confidence store while selecting tags, as in process_batch
+                vector = timer.timed("wd encode", lambda: wd_tag_store.decode("stub", wd_tag_store.encode("stub", rating, tags)))
+                tags_list, _ = timer.timed("wd select", wd_tag_store.select, "stub", vector, 0.35, True, None, 0)
+                interrogation += f"{', '.join(tags_list)}, "
+
+        stages = timer.timed("build stages", post_processing_stages,
+            False, True, settings["custom_replace_find"], settings["custom_replace_replacements"], True, settings["prompt"],
+            True, settings["negative_prompt"], True, settings["custom_filter"], True, tag_filters, replace_engines
+        )
+        interrogation = run_stages(interrogation, stages, timer.record)
+        interrogation = timer.timed("weight", weight_interrogation, interrogation, True, 0.8)
+        prompt = timer.timed("assembly", assemble_prompt, settings["prompt"], interrogation, "Append to prompt")
+        digest.update(prompt.encode("utf-8"))
+    total = time.perf_counter() - started
+    return timer.seconds, total, digest.hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=2000, help="synthetic images to process")
+    parser.add_argument("--models", nargs="+", default=MODELS, choices=MODELS, help="stub interrogators to run, in order")
+    parser.add_argument("--vocabulary", type=int, default=9000, help="tags known to the stub taggers")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop against the baseline, 0.2 = 20%%")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline for its configuration")
+    args = parser.parse_args()
+
+    models = list(args.models)
+    if "WD (EXT)" in models and importlib.util.find_spec("numpy") is None:
+        print("NumPy is not installed, skipping the WD (EXT) stub.")
+        models.remove("WD (EXT)")
+
+    seconds, total, digest = run(args, models)
+    throughput = {name: args.images / value for name, value in seconds.items() if value > 0}
+    throughput["end to end"] = args.images / total
+
+    # Throughput is only comparable for the same workload, every configuration has its own baseline
+    configuration = f"{'|'.join(models)}|images={args.images}|vocabulary={args.vocabulary}|seed={args.seed}"
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baselines = json.load(file)
+    baseline = baselines.get(configuration)
+
+    failed = False
+    print(f"{'stage':>20} {'images/s':>12} {'baseline':>12} {'change':>8}")
+    for name, value in throughput.items():
+        line = f"{name:>20} {value:>12.1f}"
+        if baseline is not None and name in baseline["throughput"]:
+            change = value / baseline["throughput"][name] - 1
+            line += f" {baseline['throughput'][name]:>12.1f} {change:>+7.0%}"
+            if change < -args.tolerance:
+                line += "  REGRESSION"
+                failed = True
+        print(line)
+    print(f"\nprompt digest: {digest}")
+
+    if args.save_baseline:
+        baselines[configuration] = {"throughput": throughput, "digest": digest}
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+    elif baseline is None:
+        print("No baseline for this configuration, run again with --save-baseline to store one.")
+    elif baseline["digest"] != digest:
+        print(f"OUTPUT CHANGED: baseline prompt digest is {baseline['digest']}")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark: interrogation preprocessing of webui-shaped inputs with and without Reduced-Resolution Decoding.
+
+The img2img batch tab hands the script an already decoded, EXIF-transposed copy of every image (no filename), this
+benchmark starts from the same. Per image it times what process_batch does before the interrogators run: the content
+hash for the cache, lookahead and sidecar lookup, and the RGB input of the interrogators. Decoding the file again at
+reduced JPEG scale is timed for comparison.
+
+Usage (from the extension directory):
+    python benchmarks/bench_reduced_decoding.py [--image photo.jpg] [--size 6000 4000] [--repeat 10]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from lib_tag_batch.cache import image_digest
+from lib_tag_batch.preprocess import DECODE_SIDE, PreparedImage, decode_reduced
+
+# Smooth gradients with noise, compresses like a photo
+def make_photo(path, size, seed=0):
+    width, height = size
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1) + rng.normal(0, 12, (height, width, 3))
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, quality=90)
+
+# Reads the image like the img2img batch tab
+def read_like_batch_tab(path):
+    with Image.open(path) as image:
+        return ImageOps.exif_transpose(image)
+
+def average_time(function, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="JPEG to use, a synthetic photo of --size is generated when not given")
+    parser.add_argument("--size", type=int, nargs=2, default=(6000, 4000), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.image
+        if path is None:
+            path = os.path.join(directory, "photo.jpg")
+            make_photo(path, args.size)
+        image = read_like_batch_tab(path)
+        image.load()
+        print(f"{path}: {image.size[0]}x{image.size[1]} {image.mode}, filename: {getattr(image, 'filename', None) or 'none'}")
+
+        def full_resolution():
+            prepared = PreparedImage(image)
+            image_digest(prepared.small())
+
+        def reduced():
+            prepared = PreparedImage(image, decode=True)
+            image_digest(prepared.small())
+
+        full_time = average_time(full_resolution, args.repeat)
+        reduced_time = average_time(reduced, args.repeat)
+        redecode_time = average_time(lambda: decode_reduced(path, DECODE_SIDE, image.size), args.repeat)
+        print(f"full resolution (RGB input + hash): {full_time * 1000:8.1f} ms/image")
+        print(f"reduced in memory (copy + hash):    {reduced_time * 1000:8.1f} ms/image  ({full_time / reduced_time:.1f}x faster)")
+        print(f"decoding the file again (reference): {redecode_time * 1000:7.1f} ms/image, without the hash")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Microbenchmark: precompiled TagFilter against the previous filter_words implementation.
+
+Usage (from the extension directory):
+    python benchmarks/bench_tag_filter.py [--sizes 100 1000 10000] [--images 200]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch.text import TagFilterCache
+
+# Previous implementation, kept here as the reference for output and speed
+def legacy_remove_attention(words):
+    words = re.sub(r":\d+(\.\d+)?", "", words)
+    words = re.sub(r"\\\(", r"TEMP_LEFT_PLACEHOLDER", words)
+    words = re.sub(r"\\\)", r"TEMP_RIGHT_PLACEHOLDER", words)
+    words = re.sub(r"(\(|\))", "", words)
+    words = re.sub(r"TEMP_LEFT_PLACEHOLDER", r"\\(", words)
+    words = re.sub(r"TEMP_RIGHT_PLACEHOLDER", r"\\)", words)
+    return words.strip()
+
+def legacy_filter_words(prompt, negative):
+    if negative is None:
+        negative = ""
+    prompt_words = [word.strip() for word in prompt.split(",")]
+    negative_words = [legacy_remove_attention(word.strip()) for word in negative.split(",")]
+    filtered_words = [word for word in prompt_words if legacy_remove_attention(word) not in negative_words]
+    return ", ".join(filtered_words)
+
+def make_vocabulary(size, rng):
+    syllables = ["ka", "ri", "mo", "to", "na", "shi", "ro", "ze", "lu", "pa", "hair", "eyes", "dress", "sky", "smile"]
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add(" ".join(rng.choice(syllables) + rng.choice(syllables) for _ in range(rng.randint(1, 3))))
+    return sorted(vocabulary)
+
+def decorate(tag, rng):
+    roll = rng.random()
+    if roll < 0.1:
+        return f"({tag}:{rng.uniform(0.5, 1.5):.2f})"
+    if roll < 0.15:
+        return f"({tag})"
+    return tag
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="custom filter sizes")
+    parser.add_argument("--images", type=int, default=200, help="interrogations filtered per size")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(max(args.sizes) * 2, rng)
+    print(f"{'filter size':>12} {'legacy ms/img':>14} {'compiled ms/img':>16} {'speedup':>8}")
+    for size in args.sizes:
+        custom_filter = ", ".join(decorate(tag, rng) for tag in rng.sample(vocabulary, size))
+        interrogations = [", ".join(decorate(tag, rng) for tag in rng.sample(vocabulary, 60)) for _ in range(args.images)]
+
+        started = time.perf_counter()
+        legacy = [legacy_filter_words(interrogation, custom_filter) for interrogation in interrogations]
+        legacy_time = time.perf_counter() - started
+
+        filters = TagFilterCache()
+        started = time.perf_counter()
+        compiled = [filters.get(custom_filter).apply(interrogation) for interrogation in interrogations]
+        compiled_time = time.perf_counter() - started
+
+        if legacy != compiled:
+            raise SystemExit(f"Output mismatch at filter size {size}")
+        print(f"{size:>12} {legacy_time / args.images * 1000:>14.3f} {compiled_time / args.images * 1000:>16.3f} {legacy_time / compiled_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
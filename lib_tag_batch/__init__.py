@@ -0,0 +1,6 @@
+"""
+Helper library for the Img2img Batch Interrogator script.
+
+Everything in this package is plain Python (no gradio, no webui imports) so it can be
+imported by scripts/sd_tag_batch.py at startup as well as by tools running outside the webui.
+"""
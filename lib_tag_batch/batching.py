@@ -0,0 +1,101 @@
+import os
+import numpy as np
+from PIL import Image
+
+# Same extensions the img2img batch tab accepts
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff", ".bmp")
+
+# Lists image files in a directory tree, sorted the same way the img2img batch tab walks them
+def list_images(directory):
+    paths = []
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, filename))
+    return sorted(paths)
+
+# Splits items into lists of at most size entries
+def chunked(items, size):
+    size = max(1, int(size))
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+# Distinct items in order of first appearance, returns their indices and the index into them of every item
+def distinct_items(items, key=None):
+    first, slots, seen = [], [], {}
+    for index, item in enumerate(items):
+        value = key(item) if key is not None else item
+        if value not in seen:
+            seen[value] = len(first)
+            first.append(index)
+        slots.append(seen[value])
+    return first, slots
+
+# WD tagger input for one image, mirrors WaifuDiffusionInterrogator.interrogate from the WD EXT
+def wd_preprocess(image, height, dbimutils):
+    # alpha to white
+    image = image.convert("RGBA")
+    new_image = Image.new("RGBA", image.size, "WHITE")
+    new_image.paste(image, mask=image)
+    image = np.asarray(new_image.convert("RGB"))
+    # PIL RGB to OpenCV BGR
+    image = image[:, :, ::-1]
+    image = dbimutils.make_square(image, height)
+    image = dbimutils.smart_resize(image, height)
+    return image.astype(np.float32)
+
+class PortedDbimutils:
+    """
+    make_square and smart_resize of tagger.dbimutils from the WD EXT, for WD taggers run without the extension.
+        The padding is the same white border. The resize uses OpenCV like the extension (INTER_AREA down, INTER_CUBIC up)
+        when cv2 is installed, otherwise PIL box and bicubic resampling, which can shift tag confidences slightly.
+        resize_backend tells which one is used.
+    """
+
+    def __init__(self):
+        try:
+            import cv2
+            self.cv2 = cv2
+            self.resize_backend = "cv2"
+        except ImportError:
+            self.cv2 = None
+            self.resize_backend = "pil"
+
+    # Pads with white to a square of at least target_size, the image is centered with the odd pixel at the bottom and right
+    def make_square(self, image, target_size):
+        height, width = image.shape[:2]
+        size = max(height, width, target_size)
+        top, left = (size - height) // 2, (size - width) // 2
+        return np.pad(image, ((top, size - height - top), (left, size - width - left), (0, 0)), constant_values=255)
+
+    # Resizes an image that went through make_square, it is only made smaller or larger when it is not size already
+    def smart_resize(self, image, size):
+        if image.shape[0] == size:
+            return image
+        if self.cv2 is not None:
+            interpolation = self.cv2.INTER_AREA if image.shape[0] > size else self.cv2.INTER_CUBIC
+            return self.cv2.resize(image, (size, size), interpolation=interpolation)
+        resample = Image.BOX if image.shape[0] > size else Image.BICUBIC
+        return np.asarray(Image.fromarray(np.ascontiguousarray(image)).resize((size, size), resample))
+
+# Input size of a loaded ONNX WD tagger, the models take square images
+def wd_input_height(interrogator):
+    _, height, _, _ = interrogator.model.get_inputs()[0].shape
+    return height
+
+# Runs a loaded ONNX WD tagger on already preprocessed inputs stacked as (images, height, height, 3), returns one (rating, tags) pair per image
+def wd_run(interrogator, batch):
+    model = interrogator.model
+    model_input = model.get_inputs()[0]
+    confidents = model.run([model.get_outputs()[0].name], {model_input.name: batch})[0]
+    names = interrogator.tags["name"].tolist()
+    results = []
+    for row in confidents:
+        row = row.tolist()
+        results.append((dict(zip(names[:4], row[:4])), dict(zip(names[4:], row[4:]))))
+    return results
+
+# Runs a loaded ONNX WD tagger on several images in a single forward pass, returns one (rating, tags) pair per image
+def wd_batch_interrogate(interrogator, images, dbimutils):
+    height = wd_input_height(interrogator)
+    return wd_run(interrogator, np.stack([wd_preprocess(image, height, dbimutils) for image in images]))
@@ -0,0 +1,70 @@
+from .tags import TagList
+
+# Tokens of one CLIP conditioning chunk, every started chunk is a full text encoder pass
+CHUNK_TOKENS = 75
+# Tag priorities to trim by: the tagger confidence, or the order the interrogators were selected in
+TRIM_PRIORITIES = ("Confidence", "Source Order")
+
+# Chunks of a prompt of token_count tokens, an empty prompt still takes one
+def chunk_count(token_count, chunk_tokens=CHUNK_TOKENS):
+    return max(1, -(-token_count // chunk_tokens))
+
+# Sort key of every tag of an interrogation, None for empty pieces. Pinned tags come first, then by the trim priority.
+# Tags without a confidence in scores (everything but WD tags) get one from their position within their interrogator,
+# the first tag of an interrogator counts as the most confident
+def tag_priorities(tag_list, priority, pinned=frozenset(), scores=None):
+    scores = scores or {}
+    totals = tag_list.count_by_source()
+    positions = {}
+    source_ranks = {}
+    priorities = []
+    for tag, source in zip(tag_list.tags, tag_list.sources):
+        source_ranks.setdefault(source, len(source_ranks))
+        if not tag.text:
+            priorities.append(None)
+            continue
+        position = positions.get(source, 0)
+        positions[source] = position + 1
+        confidence = scores.get(tag.normalized)
+        if confidence is None:
+            confidence = 1.0 - position / totals[source]
+        primary = -source_ranks[source] if priority == "Source Order" else confidence
+        priorities.append((tag.normalized in pinned, primary, confidence))
+    return priorities
+
+class BudgetTrimmer:
+    """
+    Drops the lowest priority tags of an interrogation until fits(tag_list) is true, the kept tags stay in their order.
+        fits is expected to tokenize the whole assembled prompt, since the webui moves chunk boundaries to commas
+        the token count of single tags does not add up. The largest number of kept tags is found by a binary
+        search, so a long interrogation is tokenized a handful of times. Pinned tags are never dropped.
+    """
+
+    def __init__(self, fits):
+        self.fits = fits
+
+    # Tags of order[:count], in interrogation order
+    def subset(self, tag_list, order, count):
+        keep = set(order[:count])
+        tags, sources = [], []
+        for index, (tag, source) in enumerate(zip(tag_list.tags, tag_list.sources)):
+            if index in keep:
+                tags.append(tag.stripped())
+                sources.append(source)
+        return TagList.from_texts(tags, sources)
+
+    # Returns (kept TagList, dropped tag texts), the interrogation is returned as it is when it already fits
+    def trim(self, tag_list, priorities):
+        if self.fits(tag_list):
+            return tag_list, []
+        # sorted keeps the interrogation order among tags of equal priority, also with reverse
+        order = sorted((index for index, key in enumerate(priorities) if key is not None), key=lambda index: priorities[index], reverse=True)
+        low = sum(1 for index in order if priorities[index][0])
+        high = len(order) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.fits(self.subset(tag_list, order, middle)):
+                low = middle
+            else:
+                high = middle - 1
+        return self.subset(tag_list, order, low), [tag_list.tags[index].text for index in order[low:]]
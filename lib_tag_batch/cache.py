@@ -0,0 +1,133 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# Content hash of a PIL image, mode and size are part of the hash so equal bytes with a different layout do not collide
+def image_digest(image):
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("utf-8"))
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+# Cache key of a single interrogation: image content + model + model variant + mode
+def cache_key(digest, model, variant="", mode=""):
+    return f"{digest}|{model}|{variant}|{mode}"
+
+class InterrogationCache:
+    """
+    Persistent, content-addressed interrogation cache.
+        Entries are stored in a sqlite database and evicted least recently used first
+        once the total size of the stored values exceeds max_size_mb.
+        Values may be str or bytes, the caller is responsible for encoding them.
+        Hits only refresh the last use in memory, flush writes them in one transaction (at the end of a batch job, and before
+        every eviction so the least recently used order is right).
+    """
+
+    def __init__(self, path, max_size_mb=512):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.touched = {}
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.connection.commit()
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    # Membership test that does not count as a hit or a miss
+    def contains(self, key):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode("utf-8")) if isinstance(value, str) else len(value)
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_size -= row[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time())
+            )
+            self.total_size += size
+            self.touched.pop(key, None)
+            self.evict()
+            self.connection.commit()
+
+    # Writes the last use of the entries read since the previous flush, lock must be held. Does not commit
+    def write_touched(self):
+        if self.touched:
+            self.connection.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(used, key) for key, used in self.touched.items()])
+            self.touched = {}
+
+    def flush(self):
+        with self.lock:
+            if self.touched:
+                self.write_touched()
+                self.connection.commit()
+
+    # Drops least recently used entries until the cache fits in max_size, lock must be held
+    def evict(self):
+        if self.total_size > self.max_size:
+            self.write_touched()
+        while self.total_size > self.max_size:
+            rows = self.connection.execute("SELECT key, size FROM entries ORDER BY last_used ASC LIMIT 64").fetchall()
+            if not rows:
+                self.total_size = 0
+                break
+            for key, size in rows:
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.total_size -= size
+                if self.total_size <= self.max_size:
+                    break
+
+    def resize(self, max_size_mb):
+        with self.lock:
+            self.max_size = int(max_size_mb * 1024 * 1024)
+            self.evict()
+            self.connection.commit()
+
+    def purge(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries")
+            self.connection.commit()
+            self.touched = {}
+            self.connection.execute("VACUUM")
+            self.total_size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        entries = len(self)
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return f"{entries} entries, {self.total_size / (1024 * 1024):.1f}/{self.max_size / (1024 * 1024):.0f} MB, {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)"
+
+    def close(self):
+        with self.lock:
+            self.write_touched()
+            self.connection.commit()
+            self.connection.close()
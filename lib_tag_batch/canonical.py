@@ -0,0 +1,68 @@
+from .tags import WEIGHTED_TAG, TagList, make_tag
+
+# Canonical tag orders: alphabetical, or the order of the WD tagger vocabularies with the remaining tags alphabetical after them
+CANONICAL_ORDERS = ("Sorted", "Vocabulary")
+
+# Tag with its attention weight rounded to a multiple of step, "(smile:1.23)" becomes "(smile:1.25)" with a step of 0.05.
+# A weight that rounds to 1 drops the attention syntax, so the tag matches its unweighted form
+def quantize_weight(tag, step):
+    match = WEIGHTED_TAG.fullmatch(tag.text)
+    if match is None or not step:
+        return tag
+    weight = round(round(tag.weight / step) * step, 4)
+    if weight == 1.0:
+        return make_tag(match.group(1))
+    return make_tag(f"({match.group(1)}:{weight:g})")
+
+# Rank of every tag of the vocabularies, in order, keyed like Tag.normalized. A tag of several vocabularies keeps its first rank
+def vocabulary_ranks(vocabularies):
+    ranks = {}
+    for vocabulary in vocabularies:
+        for name in vocabulary:
+            ranks.setdefault(name, len(ranks))
+    return ranks
+
+class CanonicalOrder:
+    """
+    Emits the tags of an interrogation in a stable order, the same tag set renders to the same text whatever order
+    the interrogators, CLIP phrasing or dedupe produced it in, so the webui can reuse the conditioning of the previous prompt.
+        Ties are broken by the lowercased tag and then the tag itself, the result never depends on the input order.
+        Empty pieces are dropped, the tags keep their source.
+    """
+
+    def __init__(self, order="Sorted", ranks=None, weight_step=0.0):
+        self.order = order
+        self.ranks = ranks if order == "Vocabulary" and ranks else {}
+        self.weight_step = weight_step
+
+    def key(self, tag):
+        return (self.ranks.get(tag.normalized, len(self.ranks)), tag.folded, tag.text)
+
+    def apply(self, tag_list):
+        pieces = [(quantize_weight(tag.stripped(), self.weight_step), source) for tag, source in zip(tag_list.tags, tag_list.sources) if tag.text]
+        pieces.sort(key=lambda piece: self.key(piece[0]))
+        return TagList.from_texts([tag for tag, _ in pieces], [source for _, source in pieces])
+
+class PromptRepeats:
+    """
+    Counts the batches whose prompts are identical to the prompts of the previous batch.
+        The webui keeps the conditioning of the last batch and reuses it for identical prompts, every repeat is a text encoder pass saved.
+    """
+
+    def __init__(self):
+        self.previous = None
+        self.batches = 0
+        self.repeats = 0
+
+    # Returns True when the prompts are the same as last time
+    def observe(self, prompts):
+        prompts = tuple(prompts)
+        repeated = prompts == self.previous
+        self.previous = prompts
+        self.batches += 1
+        self.repeats += repeated
+        return repeated
+
+    def summary(self):
+        ratio = self.repeats / self.batches if self.batches else 0.0
+        return f"{self.repeats}/{self.batches} batch(es) repeated the prompts of the previous batch ({ratio:.1%}), their conditioning can be reused"
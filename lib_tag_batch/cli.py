@@ -0,0 +1,112 @@
+"""
+Captions a directory of images into sidecar .txt files without the webui.
+
+Usage (from the extension directory):
+    python -m lib_tag_batch.cli DIRECTORY --backend wd --wd-model-dir models/wd-v1-4-vit-tagger-v2
+    python -m lib_tag_batch.cli DIRECTORY --backend stub --workers 2            # dry run without models
+    python -m lib_tag_batch.cli DIRECTORY --backend my_package.taggers:MyTagger  # custom backend
+
+Images are split over a process pool, one process per core by default. Every process loads its
+backends once and then captions its share of the images, "image.png" is captioned to "image.txt".
+Images that already have a caption are skipped unless --overwrite is given.
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+from .engine import BACKENDS, CaptionEngine, caption_file, list_uncaptioned, resolve_backend
+
+# Engine of a pool process, created once by the pool initializer
+worker_engine = None
+
+def init_worker(options):
+    global worker_engine
+    worker_engine = CaptionEngine.from_options(options)
+
+def caption_worker(path):
+    return caption_file(worker_engine, path)
+
+def read_text_option(value):
+    # "@file.txt" reads the option from a file, e.g. the custom_filter.txt saved by the webui script
+    if value and value.startswith("@"):
+        with open(value[1:], "r", encoding="utf-8") as file:
+            return file.read()
+    return value or ""
+
+# Backend selection and backend options, shared with the interrogation worker (lib_tag_batch.worker)
+def add_backend_arguments(parser):
+    parser.add_argument("--backend", dest="backends", action="append", default=[],
+        help=f"interrogator backend, repeat for several in order: {', '.join(BACKENDS)} or package.module:ClassName")
+    parser.add_argument("--threads", type=int, default=1, help="inference threads per process")
+    parser.add_argument("--wd-model-dir", help="folder with model.onnx and selected_tags.csv of a WD14 tagger")
+    parser.add_argument("--wd-threshold", type=float, default=0.35)
+    parser.add_argument("--wd-character-threshold", type=float, default=None)
+    parser.add_argument("--keep-underscores", action="store_true", help="do not replace underscores in tags with spaces")
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="directory of images, searched recursively")
+    add_backend_arguments(parser)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="captioning processes, defaults to the number of cores")
+    parser.add_argument("--chunksize", type=int, default=16, help="images handed to a process at a time")
+    parser.add_argument("--decode-side", type=int, default=0,
+        help="decode images at reduced resolution, with a shortest side of at least this many pixels (JPEG draft mode), 0 decodes them in full")
+    parser.add_argument("--overwrite", action="store_true", help="caption images that already have a sidecar .txt")
+    parser.add_argument("--exaggeration-mode", action="store_true", help="keep duplicate tags from different backends")
+    parser.add_argument("--custom-filter", help="comma separated tags to remove, or @file")
+    parser.add_argument("--custom-replace-find", help="comma separated phrases to replace, or @file")
+    parser.add_argument("--custom-replace-replacements", help="comma separated replacements, or @file")
+    parser.add_argument("--rules-pack", dest="rules_packs", action="append", default=[],
+        help="rules pack file (one tag, or \"tag -> alias\", per line), repeat for several in order")
+    parser.add_argument("--no-puncuation-mode", action="store_true", help="remove punctuation except commas and text emoticons")
+    args = parser.parse_args(argv)
+    if not args.backends:
+        parser.error("at least one --backend is required")
+    return args
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    options = vars(args)
+    for name in ("custom_filter", "custom_replace_find", "custom_replace_replacements"):
+        options[name] = read_text_option(options[name])
+
+    try:
+        for spec in args.backends:
+            resolve_backend(spec)
+        for path in args.rules_packs:
+            if not os.path.isfile(path):
+                raise ValueError(f"Rules pack `{path}` not found")
+    except Exception as error:
+        print(f"[ERROR]: {error}", file=sys.stderr)
+        return 2
+
+    paths = list_uncaptioned(args.directory, args.overwrite)
+    if not paths:
+        print(f"Nothing to caption in {args.directory}")
+        return 0
+    workers = max(1, min(args.workers, len(paths)))
+    print(f"Captioning {len(paths)} image(s) with {', '.join(args.backends)} on {workers} process(es)")
+
+    started = time.perf_counter()
+    done = failed = 0
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(options,)) as pool:
+            for path, seconds, error in pool.map(caption_worker, paths, chunksize=max(1, args.chunksize)):
+                done += 1
+                if error is not None:
+                    failed += 1
+                    print(f"[ERROR]: {path}: {error}", file=sys.stderr)
+                if done % 500 == 0 or done == len(paths):
+                    elapsed = time.perf_counter() - started
+                    print(f"{done}/{len(paths)} images, {done / elapsed:.1f} images/s")
+    except concurrent.futures.process.BrokenProcessPool:
+        # The initializer raised, e.g. a backend could not load its model, the traceback is printed by the worker
+        print(f"[ERROR]: A captioning process failed to start its backends, {done}/{len(paths)} images were captioned", file=sys.stderr)
+        return 2
+    print(f"Done in {time.perf_counter() - started:.1f}s, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import os
+import threading
+
+# Modification time of a path, missing paths count as 0 so creating them later invalidates the cache
+def modification_time(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+class DiscoveryCache:
+    """
+    Runs an expensive scan once and serves later lookups from memory.
+        The scan is repeated after invalidate() (e.g. a refresh button), or when the modification
+        time of one of the watched paths changed since the last scan: an extension being installed
+        or removed changes the extensions directory, enabling or disabling one rewrites the config.
+    """
+
+    def __init__(self, scan_fn, watched_paths):
+        self.scan_fn = scan_fn
+        self.watched_paths = list(watched_paths)
+        self.lock = threading.Lock()
+        self.result = None
+        self.signature = None
+        self.scans = 0
+
+    def current_signature(self):
+        return tuple(modification_time(path) for path in self.watched_paths)
+
+    def get(self):
+        with self.lock:
+            signature = self.current_signature()
+            if self.result is None or signature != self.signature:
+                self.result = self.scan_fn()
+                self.signature = signature
+                self.scans += 1
+            return self.result
+
+    def invalidate(self):
+        with self.lock:
+            self.result = None
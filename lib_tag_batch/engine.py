@@ -0,0 +1,169 @@
+import csv
+import hashlib
+import importlib
+import os
+import time
+
+from .batching import IMAGE_EXTENSIONS, PortedDbimutils, wd_preprocess
+from .pipeline import post_processing_stages, replace_underscores, run_stages
+from .preprocess import decode_reduced
+from .rules import RulesIndex, RulesPack
+from .sidecar import sidecar_path, write_sidecar
+from .tags import TagList
+from .text import ReplaceEngineCache, TagFilterCache
+
+class StubBackend:
+    """
+    Deterministic stand-in interrogator for tests and dry runs, needs no model.
+        The tags are picked from a small vocabulary by a hash of the image content, so the same image always gets the same caption.
+    """
+
+    name = "stub"
+    vocabulary = ("1girl", "solo", "long_hair", "short_hair", "smile", "looking_at_viewer", "blue_eyes", "red_eyes", "dress",
+        "outdoors", "sky", "cloud", "tree", "holding", "flower", "open_mouth", "simple_background", "white_background")
+
+    def __init__(self, tags=6, underscore_fix=True):
+        self.tags = tags
+        self.underscore_fix = underscore_fix
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(underscore_fix=not options.get("keep_underscores", False))
+
+    def interrogate(self, image):
+        seed = hashlib.blake2b(image.tobytes(), digest_size=8).digest()
+        tags = [self.vocabulary[byte % len(self.vocabulary)] for byte in seed[:self.tags]]
+        if self.underscore_fix:
+            tags = [replace_underscores(tag) for tag in tags]
+        return ", ".join(dict.fromkeys(tags))
+
+class WDOnnxBackend:
+    """
+    WD14 tagger from a local model folder (model.onnx and selected_tags.csv, as downloaded from the SmilingWolf repositories),
+    run with onnxruntime on CPU without the webui or the WD EXT. Preprocessing is the one of the WD EXT (batching.wd_preprocess)
+    with a port of its dbimutils, the confidences only match the WD EXT exactly when OpenCV is installed, see PortedDbimutils.
+    preprocessing names the resize that is used, it is part of the worker signature.
+    """
+
+    name = "wd"
+
+    def __init__(self, model_dir, threshold=0.35, character_threshold=None, underscore_fix=True, threads=1):
+        import numpy as np
+        import onnxruntime
+        self.np = np
+        session_options = onnxruntime.SessionOptions()
+        # One process per core, each session keeps to its own core
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, "model.onnx"), session_options, providers=["CPUExecutionProvider"])
+        self.input = self.session.get_inputs()[0]
+        self.output_name = self.session.get_outputs()[0].name
+        self.height = self.input.shape[1]
+        self.dbimutils = PortedDbimutils()
+        self.preprocessing = f"dbimutils:{self.dbimutils.resize_backend}"
+        self.threshold = threshold
+        self.character_threshold = threshold if character_threshold is None else character_threshold
+        self.names, self.categories = [], []
+        with open(os.path.join(model_dir, "selected_tags.csv"), "r", encoding="utf-8") as file:
+            for row in csv.DictReader(file):
+                self.names.append(replace_underscores(row["name"]) if underscore_fix else row["name"])
+                self.categories.append(int(row["category"]))
+        # Ratings (category 9) come first in the model output and are not part of the caption
+        self.thresholds = np.array([
+            np.inf if category == 9 else self.character_threshold if category == 4 else threshold
+            for category in self.categories
+        ], dtype=np.float32)
+
+    @classmethod
+    def from_options(cls, options):
+        if not options.get("wd_model_dir"):
+            raise ValueError("The wd backend needs --wd-model-dir")
+        return cls(options["wd_model_dir"], options.get("wd_threshold", 0.35), options.get("wd_character_threshold"), not options.get("keep_underscores", False), options.get("threads", 1))
+
+    def preprocess(self, image):
+        return wd_preprocess(image, self.height, self.dbimutils)
+
+    def interrogate(self, image):
+        batch = self.np.ascontiguousarray(self.preprocess(image)[None])
+        confidences = self.session.run([self.output_name], {self.input.name: batch})[0][0]
+        return ", ".join(self.names[index] for index in self.np.flatnonzero(confidences > self.thresholds))
+
+# Built-in backends, anything else is loaded as "package.module:ClassName"
+BACKENDS = {"stub": StubBackend, "wd": WDOnnxBackend}
+
+# Backend class from its name or import path
+def resolve_backend(spec):
+    backend_class = BACKENDS.get(spec)
+    if backend_class is None:
+        if ":" not in spec:
+            raise ValueError(f"Unknown backend `{spec}`, use one of {', '.join(BACKENDS)} or package.module:ClassName")
+        module_name, class_name = spec.split(":", 1)
+        backend_class = getattr(importlib.import_module(module_name), class_name)
+    return backend_class
+
+# Creates a backend, backends with a from_options classmethod receive the engine options
+def load_backend(spec, options):
+    backend_class = resolve_backend(spec)
+    if hasattr(backend_class, "from_options"):
+        return backend_class.from_options(options)
+    return backend_class()
+
+class CaptionEngine:
+    """
+    Headless captioning pipeline: the model loop of process_batch followed by the same post-processing
+    (dedupe, find & replace, custom filter, punctuation removal), without the webui or Gradio.
+        Backends are objects with an interrogate(image) method returning a comma separated prompt fragment,
+        they run in the given order and their results are joined like the interrogators in process_batch.
+        With decode_side, caption_file decodes the images at reduced resolution, with a shortest side of at least decode_side.
+    """
+
+    def __init__(self, backends, exaggeration_mode=False, custom_replace_find="", custom_replace_replacements="", custom_filter="", no_puncuation_mode=False, decode_side=None, rules_index=None):
+        self.backends = backends
+        self.decode_side = decode_side
+        self.stages = post_processing_stages(
+            exaggeration_mode, bool(custom_replace_find), custom_replace_find, custom_replace_replacements, False, "",
+            False, "", bool(custom_filter), custom_filter, no_puncuation_mode, TagFilterCache(), ReplaceEngineCache(), rules_index
+        )
+
+    @classmethod
+    def from_options(cls, options):
+        backends = [load_backend(spec, options) for spec in options["backends"]]
+        rules_packs = [RulesPack.load(os.path.splitext(os.path.basename(path))[0], path) for path in options.get("rules_packs") or []]
+        return cls(
+            backends, options.get("exaggeration_mode", False), options.get("custom_replace_find", ""),
+            options.get("custom_replace_replacements", ""), options.get("custom_filter", ""), options.get("no_puncuation_mode", False),
+            options.get("decode_side") or None, RulesIndex(rules_packs) if rules_packs else None
+        )
+
+    def caption(self, image):
+        interrogation = TagList()
+        for backend in self.backends:
+            interrogation.add(backend.interrogate(image), getattr(backend, "name", type(backend).__name__))
+        return run_stages(interrogation, self.stages).render().rstrip(", ")
+
+# Lists the images of a directory tree that still need a caption
+def list_uncaptioned(directory, overwrite=False):
+    paths = []
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, filename)
+                if overwrite or not os.path.exists(sidecar_path(path)):
+                    paths.append(path)
+    return sorted(paths)
+
+# Captions one image file into its sidecar, returns (path, seconds, error)
+def caption_file(engine, path):
+    from PIL import Image
+    started = time.perf_counter()
+    try:
+        if engine.decode_side:
+            caption = engine.caption(decode_reduced(path, engine.decode_side))
+        else:
+            with Image.open(path) as image:
+                image.load()
+                caption = engine.caption(image.convert("RGB") if image.mode not in ("RGB", "RGBA") else image)
+        write_sidecar(sidecar_path(path), caption)
+        return path, time.perf_counter() - started, None
+    except Exception as error:
+        return path, time.perf_counter() - started, f"{type(error).__name__}: {error}"
@@ -0,0 +1,29 @@
+import threading
+
+class LazyLoader:
+    """
+    Runs load_fn once, on the first get(), and hands out its result afterwards.
+        Concurrent first calls (e.g. a dropdown event and process_batch) wait for the same load
+        instead of importing twice. A load that returned None, such as an extension that is not
+        installed, can be attempted again after retry().
+    """
+
+    def __init__(self, load_fn):
+        self.load_fn = load_fn
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.value = None
+
+    def get(self):
+        if self.loaded:
+            return self.value
+        with self.lock:
+            if not self.loaded:
+                self.value = self.load_fn()
+                self.loaded = True
+            return self.value
+
+    def retry(self):
+        with self.lock:
+            if self.value is None:
+                self.loaded = False
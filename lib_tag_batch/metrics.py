@@ -0,0 +1,136 @@
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+# Number of non-empty comma separated tags in a prompt fragment, or in a TagList
+def count_tags(text):
+    if not isinstance(text, str):
+        return len(text)
+    return sum(1 for tag in text.split(",") if tag.strip())
+
+# Nearest-rank percentile of an already sorted list
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class StageTimer:
+    """Context manager that adds the time spent in its block to a BatchMetrics stage."""
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.started)
+        return False
+
+class BatchMetrics:
+    """
+    Per-stage timings and counters of one batch run.
+        Every timed stage keeps its individual samples so the summary can report p50, p95 and max.
+        Counters accumulate, e.g. tags going in and out of each filter. With trace enabled, the stages
+        and tag counts of every image are also kept, only events from the thread that started the image
+        are traced so background interrogations do not end up in the wrong image.
+    """
+
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timings = {}
+        self.counters = {}
+        self.trace = [] if trace else None
+        self.image = None
+        self.image_thread = None
+        self.images = 0
+
+    def begin_image(self, name):
+        with self.lock:
+            self.images += 1
+            if self.trace is not None:
+                self.image = {"image": name, "stages": {}, "tags": {}}
+                self.image_thread = threading.current_thread()
+
+    def end_image(self):
+        with self.lock:
+            if self.image is not None:
+                self.trace.append(self.image)
+            self.image = None
+
+    def is_traced(self):
+        return self.image is not None and threading.current_thread() is self.image_thread
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+            if self.is_traced():
+                self.image["stages"][stage] = self.image["stages"].get(stage, 0.0) + seconds
+
+    def time(self, stage):
+        return StageTimer(self, stage)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Matches the record callback of pipeline.run_stages: time of the stage and tags before and after it
+    def record_stage(self, stage, seconds, before, after):
+        tags_in, tags_out = count_tags(before), count_tags(after)
+        self.add_time(stage, seconds)
+        self.count(f"{stage} tags in", tags_in)
+        self.count(f"{stage} tags out", tags_out)
+        with self.lock:
+            if self.is_traced():
+                self.image["tags"][stage] = [tags_in, tags_out]
+
+    # Matches the observer of ModelResidency: model load, inference and unload times
+    def record_model(self, name, kind, seconds):
+        self.add_time(f"{kind} {name}", seconds)
+
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for stage, samples in self.timings.items():
+                ordered = sorted(samples)
+                stages[stage] = {
+                    "count": len(ordered),
+                    "total": sum(ordered),
+                    "p50": percentile(ordered, 0.5),
+                    "p95": percentile(ordered, 0.95),
+                    "max": ordered[-1],
+                }
+            return {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "wall_time": time.time() - self.started,
+                "images": self.images,
+                "stages": stages,
+                "counters": dict(self.counters),
+            }
+
+    # Writes <prefix>.json and <prefix>.csv, plus <prefix>-trace.jsonl when tracing, returns the written paths
+    def write(self, directory, prefix):
+        os.makedirs(directory, exist_ok=True)
+        summary = self.summary()
+        base = os.path.join(directory, prefix)
+        paths = [f"{base}.json", f"{base}.csv"]
+        with open(paths[0], "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+        with open(paths[1], "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["stage", "count", "total", "p50", "p95", "max"])
+            for stage, values in summary["stages"].items():
+                writer.writerow([stage] + [values[column] for column in ("count", "total", "p50", "p95", "max")])
+        if self.trace is not None:
+            paths.append(f"{base}-trace.jsonl")
+            with open(paths[2], "w", encoding="utf-8") as file:
+                for image in self.trace:
+                    file.write(json.dumps(image) + "\n")
+        return paths
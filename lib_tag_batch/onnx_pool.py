@@ -0,0 +1,173 @@
+import concurrent.futures
+import csv
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+# Cores this process may run on
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+# Splits the cores into one disjoint set per session, None when there are not enough cores to give every session its own
+def partition_cores(sessions, threads, cores=None):
+    cores = available_cores() if cores is None else cores
+    if sessions * threads > len(cores):
+        return None
+    return [cores[index * threads:(index + 1) * threads] for index in range(sessions)]
+
+# Tag names and categories of a WD tagger, from its selected_tags.csv
+def read_selected_tags(tags_path):
+    names, categories = [], []
+    with open(tags_path, "r", encoding="utf-8") as file:
+        for row in csv.DictReader(file):
+            names.append(row["name"])
+            categories.append(int(row["category"]))
+    return names, categories
+
+class SessionStats:
+    def __init__(self, cores):
+        self.cores = cores
+        self.images = 0
+        self.batches = 0
+        self.busy = 0.0
+
+    def summary(self):
+        rate = self.images / self.busy if self.busy > 0 else 0.0
+        cores = f"cores {self.cores[0]}-{self.cores[-1]}" if self.cores else "unpinned"
+        return f"{self.images} image(s) in {self.batches} batch(es), {rate:.1f} images/s ({cores})"
+
+class WDSessionPool:
+    """
+    Pool of CPU ONNX sessions of one WD tagger, for nodes without a GPU.
+        Every session has its own worker thread, with explicit intra-op and inter-op thread counts and,
+        when there are enough cores, pinned to its own set of cores so the sessions do not oversubscribe
+        the CPU. Workers take up to batch_size queued images at a time and run them in one forward pass.
+        submit() accepts an already preprocessed input or an image, images are preprocessed on the worker
+        with preprocess_fn(image, height). Results are (rating, tags) pairs, like wd_ext_utils interrogators.
+    """
+
+    def __init__(self, model_path, tags_path, sessions=1, threads=1, batch_size=8, preprocess_fn=None, pin_cores=True):
+        import onnxruntime
+        self.onnxruntime = onnxruntime
+        self.model_path = model_path
+        self.names, self.categories = read_selected_tags(tags_path)
+        self.batch_size = max(1, int(batch_size))
+        self.threads = max(1, int(threads))
+        self.preprocess_fn = preprocess_fn
+        self.queue = queue.Queue()
+        self.closed = False
+        partitions = partition_cores(max(1, int(sessions)), self.threads) if pin_cores else None
+        self.pinned = partitions is not None and hasattr(os, "sched_setaffinity")
+        self.stats = [SessionStats(partitions[index] if self.pinned else None) for index in range(max(1, int(sessions)))]
+        self.height = None
+        self.errors = []
+        ready = [threading.Event() for _ in self.stats]
+        self.workers = [
+            threading.Thread(target=self.run, args=(stats, event), name=f"tag-batch-wd-session-{index}", daemon=True)
+            for index, (stats, event) in enumerate(zip(self.stats, ready))
+        ]
+        for worker in self.workers:
+            worker.start()
+        for event in ready:
+            event.wait()
+        if self.errors:
+            self.close()
+            raise RuntimeError(f"Could not create an ONNX session for {model_path}: {self.errors[0]}")
+
+    def create_session(self):
+        options = self.onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = self.onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        # Spinning threads would keep every pinned core busy while the session waits for images
+        options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+        return self.onnxruntime.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+
+    def run(self, stats, ready):
+        try:
+            # The session's own threads are created below and inherit the core set of this thread
+            if self.pinned:
+                os.sched_setaffinity(0, stats.cores)
+            session = self.create_session()
+        except Exception as error:
+            self.errors.append(error)
+            ready.set()
+            return
+        model_input = session.get_inputs()[0]
+        output_name = session.get_outputs()[0].name
+        self.height = model_input.shape[1]
+        ready.set()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                # Passes the stop signal on to the next worker
+                self.queue.put(None)
+                break
+            batch = [item]
+            # Micro-batch: whatever else is already queued, up to batch_size images
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Passes the stop signal on to the next worker once this batch is done
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            started = time.perf_counter()
+            futures, inputs = [], []
+            for future, image, array in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    inputs.append(array if array is not None else self.preprocess_fn(image, self.height))
+                    futures.append(future)
+                except Exception as error:
+                    future.set_exception(error)
+            if not futures:
+                continue
+            try:
+                confidences = session.run([output_name], {model_input.name: np.stack(inputs)})[0]
+                for future, row in zip(futures, confidences):
+                    future.set_result(self.to_result(row))
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+            stats.images += len(futures)
+            stats.batches += 1
+            stats.busy += time.perf_counter() - started
+
+    # Ratings are the first 4 entries of every WD tagger, as in wd_ext_utils
+    def to_result(self, row):
+        row = row.tolist()
+        return dict(zip(self.names[:4], row[:4])), dict(zip(self.names[4:], row[4:]))
+
+    def submit(self, image=None, array=None):
+        if self.closed:
+            raise RuntimeError("The WD session pool is closed")
+        future = concurrent.futures.Future()
+        self.queue.put((future, image, array))
+        return future
+
+    def interrogate(self, image=None, array=None):
+        return self.submit(image, array).result()
+
+    def interrogate_many(self, images):
+        return [future.result() for future in [self.submit(image) for image in images]]
+
+    def summary(self):
+        lines = [f"session {index}: {stats.summary()}" for index, stats in enumerate(self.stats)]
+        total = sum(stats.images for stats in self.stats)
+        return "\n".join([f"{len(self.stats)} session(s) x {self.threads} thread(s), {total} image(s)"] + lines)
+
+    def close(self):
+        self.closed = True
+        self.queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=60)
@@ -0,0 +1,84 @@
+import time
+
+from .tags import TagList
+
+# WD tags that are emoticons, their underscores are part of the face and are kept
+UNDERSCORE_EMOTICONS = frozenset([
+    "0_0", "(o)_(o)", "+_+", "+_-", "._.", "<o>_<o>", "<|>_<|>", "=_=", ">_<",
+    "3_3", "6_9", ">_o", "@_@", "^_^", "o_o", "u_u", "x_x", "|_|", "||_||"
+])
+
+# For WD Tagger, removes underscores from tags that should have spaces
+def replace_underscores(tag):
+    if tag in UNDERSCORE_EMOTICONS:
+        return tag
+    return tag.replace('_', ' ')
+
+# Strips whitespace, drops empty entries and removes duplicates while preserving order
+def clean_string(input_string):
+    unique_items = dict.fromkeys(item.strip() for item in input_string.split(','))
+    unique_items.pop("", None)
+    return ', '.join(unique_items)
+
+# Post-processing applied to the interrogation, as (stage name, function) pairs in the order process_batch applies them.
+# Every function takes and returns a TagList, see run_stages
+def post_processing_stages(
+    exaggeration_mode, use_custom_replace, custom_replace_find, custom_replace_replacements, use_positive_filter, prompt,
+    use_negative_filter, negative_prompt, use_custom_filter, custom_filter, no_puncuation_mode, tag_filters, replace_engines, rules_index=None
+):
+    stages = []
+    # Filter prevents overexaggeration of tags due to interrogation models having similar results
+    if not exaggeration_mode:
+        stages.append(("dedupe", TagList.dedupe))
+    # Find and Replace user defined words in the interrogation prompt
+    if use_custom_replace:
+        replace_engine = replace_engines.from_text(custom_replace_find, custom_replace_replacements)
+        stages.append(("replace", lambda tags: tags.replace(replace_engine)))
+    # Aliases and blocklists of the selected rules packs, see lib_tag_batch.rules
+    if rules_index is not None:
+        stages.append(("rules packs", rules_index.apply))
+    # Remove duplicate prompt content from interrogator prompt
+    if use_positive_filter:
+        positive_filter = tag_filters.get(prompt)
+        stages.append(("positive filter", lambda tags: tags.filter(positive_filter)))
+    # Remove negative prompt content from interrogator prompt
+    if use_negative_filter:
+        negative_filter = tag_filters.get(negative_prompt)
+        stages.append(("negative filter", lambda tags: tags.filter(negative_filter)))
+    # Remove custom prompt content from interrogator prompt
+    if use_custom_filter:
+        custom_tag_filter = tag_filters.get(custom_filter)
+        stages.append(("custom filter", lambda tags: tags.filter(custom_tag_filter)))
+    # Experimental tool for removing puncuations, but commas and a variety of emojis
+    if no_puncuation_mode:
+        stages.append(("punctuation", TagList.remove_punctuation))
+    return stages
+
+# Applies the stages in order, record(name, seconds, before, after) is called after each one when given.
+# A TagList is returned as a TagList, a string is parsed once and the result rendered once
+def run_stages(interrogation, stages, record=None):
+    if isinstance(interrogation, str):
+        return run_stages(TagList.parse(interrogation), stages, record).render()
+    for name, stage in stages:
+        if record is None:
+            interrogation = stage(interrogation)
+            continue
+        started = time.perf_counter()
+        result = stage(interrogation)
+        record(name, time.perf_counter() - started, interrogation, result)
+        interrogation = result
+    return interrogation
+
+# This will weight the interrogation, and also ensure that trailing commas to the interrogation are correctly placed
+def weight_interrogation(interrogation, prompt_weight_mode, prompt_weight):
+    if prompt_weight_mode:
+        return f"({interrogation.rstrip(', ')}:{prompt_weight}), "
+    return f"{interrogation.rstrip(', ')}, "
+
+# This will construct the prompt
+def assemble_prompt(prompt, interrogation, in_front):
+    if prompt == "":
+        return interrogation
+    if in_front == "Append to prompt":
+        return f"{prompt.rstrip(', ')}, {interrogation}"
+    return f"{interrogation}{prompt}"
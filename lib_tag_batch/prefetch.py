@@ -0,0 +1,82 @@
+import threading
+
+class LookaheadPrefetcher:
+    """
+    Background worker that interrogates upcoming batch images while the current one is being generated.
+        The main thread claims each image it processes by content hash, the worker stays at most
+        depth images ahead of the claimed ones and never works on an image that was already claimed.
+        If the main thread claims an image the worker is busy with, claim() waits for the worker to finish it.
+    """
+
+    def __init__(self, items, depth, work_fn, is_cancelled, on_cancel=None):
+        self.items = items
+        self.depth = max(1, int(depth))
+        self.work_fn = work_fn
+        self.is_cancelled = is_cancelled
+        self.on_cancel = on_cancel
+        self.condition = threading.Condition()
+        self.claimed = set()
+        self.in_flight = {}
+        self.stopped = False
+        self.prefetched = 0
+        self.thread = threading.Thread(target=self.run, name="tag-batch-lookahead", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def run(self):
+        cancelled = False
+        for index, item in enumerate(self.items):
+            with self.condition:
+                # Waits until the main thread is close enough to this item
+                while not self.stopped and not cancelled and index >= len(self.claimed) + self.depth:
+                    self.condition.wait(0.5)
+                    cancelled = self.is_cancelled()
+                cancelled = cancelled or self.is_cancelled()
+                if self.stopped or cancelled:
+                    self.stopped = True
+                    break
+            try:
+                self.work_fn(item)
+            except Exception as error:
+                print(f"[LookaheadPrefetcher]: Error prefetching {item}: {error}")
+        # Cancelled by the job, lets the owner discard results that will never be used
+        if cancelled and self.on_cancel is not None:
+            self.on_cancel()
+
+    # Worker side, returns False if the main thread already has this image
+    def begin(self, digest):
+        with self.condition:
+            if self.stopped or digest in self.claimed:
+                return False
+            self.in_flight[digest] = threading.Event()
+            return True
+
+    # Worker side, releases a main thread that may be waiting for this image
+    def finish(self, digest):
+        with self.condition:
+            event = self.in_flight.pop(digest, None)
+            self.prefetched += 1
+            self.condition.notify_all()
+        if event is not None:
+            event.set()
+
+    # Main thread side, marks the image as in progress and waits if the worker is still interrogating it
+    def claim(self, digest):
+        with self.condition:
+            self.claimed.add(digest)
+            event = self.in_flight.get(digest)
+            self.condition.notify_all()
+        if event is not None:
+            event.wait()
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
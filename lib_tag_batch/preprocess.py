@@ -0,0 +1,133 @@
+import math
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+from .batching import wd_preprocess
+
+# Shortest side an interrogator needs to get the same input from its own resize: Deepbooru fits the image into 512x512,
+# CLIP squashes it to 384x384 for BLIP and crops the shortest side to 224 (336 for the -336 CLIP models)
+REDUCED_SIDES = {
+    "Deepbooru (Native)": 512,
+    "CLIP (Native)": 384,
+    "CLIP (EXT)": 384,
+}
+
+# Shortest side of the reduced-resolution copy the interrogators work from, the largest input of Deepbooru, CLIP and the WD taggers
+DECODE_SIDE = 512
+# Modes reduced before the RGB conversion, the result is the same as reducing the RGB image. Other images are converted
+# first: reduce premultiplies alpha and the conversion of palette, CMYK or 32-bit images is not linear
+REDUCIBLE_MODES = ("L", "RGB")
+# EXIF orientations that swap width and height
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Size of an image file once its EXIF orientation is applied, read from the header without decoding the pixels
+def oriented_size(image):
+    width, height = image.size
+    if image.getexif().get(0x0112, 1) in ROTATED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+# Integer box reduction of a decoded image to a shortest side of at least side, then RGB. The result only depends on the
+# RGB content, so an image and its RGB conversion give the same copy and the same content hash
+def reduce_decoded(image, side):
+    factor = min(image.size) // side
+    if factor >= 2:
+        if image.mode not in REDUCIBLE_MODES:
+            image = image.convert("RGB")
+        image = image.reduce(factor)
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+# Decodes an image file for interrogation with a shortest side of at least side. JPEG files are decoded at 1/2, 1/4 or 1/8
+# scale by draft mode, other formats are decoded in full and reduced before the RGB conversion.
+# Returns None when the file does not have expected_size (e.g. it changed since the image was opened)
+def decode_reduced(path, side, expected_size=None):
+    with Image.open(path) as image:
+        if expected_size is not None and oriented_size(image) != tuple(expected_size):
+            return None
+        width, height = image.size
+        if image.format == "JPEG" and min(width, height) > side:
+            scale = side / min(width, height)
+            image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+        return reduce_decoded(ImageOps.exif_transpose(image), side)
+
+# Downscales an image so its shortest side is side, smaller images are returned as they are
+def reduce_image(image, side):
+    width, height = image.size
+    if min(width, height) <= side:
+        return image
+    scale = side / min(width, height)
+    size = (max(side, round(width * scale)), max(side, round(height * scale)))
+    # reducing_gap does most of the work with a fast integer box reduction, the last step is a full Lanczos resample
+    return image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+class PreparedImage:
+    """
+    Model inputs of the image being processed, each profile (RGB copy, downscaled copy per side, WD input per size)
+    is produced once and shared by every interrogator that needs it.
+        The RGB conversion is skipped for images that already are RGB, and release() drops the full
+        resolution copy and every input as soon as the interrogators are done with the image.
+        With decode, the interrogators get a reduced-resolution copy (see decode_small) and the full resolution image is
+        left to the diffusion. record(name, seconds) is called for every input that had
+        to be produced, when given.
+    """
+
+    def __init__(self, image, reduce=False, record=None, decode=False):
+        self.source = image
+        self.reduce = reduce
+        self.record = record
+        self.decode = decode
+        self.inputs = {}
+        self.lock = threading.RLock()
+
+    # Produces an input once, build_fn runs with the lock held so concurrent interrogators wait instead of building it twice
+    def get(self, profile, build_fn):
+        with self.lock:
+            if profile not in self.inputs:
+                started = time.perf_counter()
+                self.inputs[profile] = build_fn()
+                if self.record is not None:
+                    self.record(f"preprocess {profile[0]}", time.perf_counter() - started)
+            return self.inputs[profile]
+
+    # Full resolution RGB image, what the interrogators received before
+    def rgb(self):
+        if self.source.mode == "RGB":
+            return self.source
+        return self.get(("rgb",), lambda: self.source.convert("RGB"))
+
+    # RGB image the interrogators start from, the reduced-resolution copy with decode, otherwise the full resolution RGB image
+    def small(self):
+        if not self.decode:
+            return self.rgb()
+        return self.get(("decode", DECODE_SIDE), self.decode_small)
+
+    # Reduced-resolution copy. An image that is already decoded, which is every image the webui hands over, is reduced in memory,
+    # that is several times faster than decoding its file again. Only a lazily opened file whose pixels were not decoded yet
+    # (an Image.open result) is decoded from the file at reduced scale
+    def decode_small(self):
+        path = getattr(self.source, "filename", None)
+        if path and getattr(self.source, "tile", None):
+            try:
+                image = decode_reduced(path, DECODE_SIDE, self.source.size)
+                if image is not None:
+                    return image
+            except OSError:
+                pass
+        return reduce_decoded(self.source, DECODE_SIDE)
+
+    # Image handed to an interrogator, a downscaled copy for Deepbooru and CLIP when reduce is enabled
+    def for_model(self, model):
+        side = REDUCED_SIDES.get(model)
+        if not self.reduce or side is None:
+            return self.small()
+        return self.get(("reduced", side), lambda: reduce_image(self.small(), side))
+
+    # Padded, resized and BGR converted float input of a WD tagger, shared by every tagger with the same input size
+    def wd_input(self, height, dbimutils):
+        return self.get(("wd", height), lambda: wd_preprocess(self.small(), height, dbimutils))
+
+    def release(self):
+        with self.lock:
+            self.inputs = {}
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import OrderedDict
+
+class ModelResidency:
+    """
+    Keeps the most recently used interrogator models loaded within a memory budget.
+        A model is identified by name, models that share a group replace each other when loaded
+        (e.g. CLIP EXT only holds one CLIP model at a time). The memory of a model is measured with
+        memory_probe around its load and first inference, once the resident models exceed budget_mb
+        the least recently used ones are unloaded. Load, unload and inference times are recorded per model.
+    """
+
+    def __init__(self, budget_mb, memory_probe):
+        self.budget_mb = budget_mb
+        self.memory_probe = memory_probe
+        self.lock = threading.RLock()
+        self.resident = OrderedDict()
+        self.known_sizes = {}
+        self.timings = {}
+        # Optional observer(name, kind, seconds), e.g. the batch metrics
+        self.observer = None
+
+    def record(self, name, kind, seconds):
+        timings = self.timings.setdefault(name, {"load": [0, 0.0], "unload": [0, 0.0], "inference": [0, 0.0]})
+        timings[kind][0] += 1
+        timings[kind][1] += seconds
+        if self.observer is not None:
+            self.observer(name, kind, seconds)
+
+    def resident_size(self):
+        return sum(entry["size"] for entry in self.resident.values())
+
+    def unload(self, name):
+        entry = self.resident.pop(name)
+        started = time.perf_counter()
+        try:
+            entry["unload"]()
+        except Exception as error:
+            print(f"[ModelResidency]: Error unloading {name}: {error}")
+        self.record(name, "unload", time.perf_counter() - started)
+
+    # Unloads least recently used models until required_mb more fits in the budget, keep is never unloaded
+    def evict(self, required_mb=0.0, keep=None):
+        for name in list(self.resident):
+            if self.resident_size() + required_mb <= self.budget_mb:
+                break
+            if name != keep:
+                self.unload(name)
+
+    def run(self, name, group, load_fn, inference_fn, unload_fn):
+        with self.lock:
+            first_use = name not in self.resident
+            if first_use:
+                for other in [other for other, entry in self.resident.items() if entry["group"] == group]:
+                    self.unload(other)
+                self.evict(self.known_sizes.get(name, 0.0))
+                before = self.memory_probe()
+                started = time.perf_counter()
+                load_fn()
+                self.record(name, "load", time.perf_counter() - started)
+                self.resident[name] = {"group": group, "size": self.known_sizes.get(name, 0.0), "unload": unload_fn}
+            else:
+                self.resident.move_to_end(name)
+            started = time.perf_counter()
+            result = inference_fn()
+            self.record(name, "inference", time.perf_counter() - started)
+            if first_use:
+                # Some interrogators only load their weights on the first inference, so the size is measured after it
+                size = max(self.memory_probe() - before, 0.0)
+                self.known_sizes[name] = size
+                self.resident[name]["size"] = size
+                self.evict(keep=name)
+            return result
+
+    def resize(self, budget_mb):
+        with self.lock:
+            self.budget_mb = budget_mb
+            self.evict()
+
+    # Forgets models that were unloaded outside of the manager, e.g. by an "Unload All" button
+    def forget(self, prefix):
+        with self.lock:
+            for name in [name for name in self.resident if name.startswith(prefix)]:
+                del self.resident[name]
+
+    def unload_all(self):
+        with self.lock:
+            for name in list(self.resident):
+                self.unload(name)
+
+    def summary(self):
+        with self.lock:
+            lines = [f"Resident: {self.resident_size():.0f}/{self.budget_mb:.0f} MB"]
+            for name, timings in self.timings.items():
+                status = "loaded" if name in self.resident else "unloaded"
+                parts = [f"{name} [{status}, {self.known_sizes.get(name, 0.0):.0f} MB]"]
+                for kind in ("load", "inference", "unload"):
+                    count, seconds = timings[kind]
+                    if count:
+                        parts.append(f"{kind} {count}x avg {seconds / count:.2f}s")
+                lines.append(", ".join(parts))
+            return "\n".join(lines)
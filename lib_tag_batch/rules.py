@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+
+from .tags import TagList, make_tag
+from .text import remove_attention
+
+# Files of a rules pack directory, the pack name is the file name without the extension
+RULES_EXTENSION = ".txt"
+# " -> " separates a tag from its alias, without spaces arrows are part of emoticons such as "@}->--"
+ALIAS_SEPARATOR = " -> "
+# Bumped whenever the precompiled format changes, older cache files are parsed again
+CACHE_VERSION = 1
+
+# Parses a rules pack, one rule per line: "tag" removes the tag, "tag -> alias" renames it.
+# Empty lines and lines starting with "#" are ignored, "\#" escapes a tag starting with "#". Attention syntax is ignored like in the custom filter
+def parse_rules(text):
+    blocked, aliases = set(), {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("\\#"):
+            line = line[1:]
+        tag, separator, alias = line.partition(ALIAS_SEPARATOR)
+        if not separator:
+            blocked.add(remove_attention(line))
+            continue
+        tag, alias = remove_attention(tag.strip()), alias.strip()
+        # A rule without an alias would delete the tag, that is what a plain "tag" line is for
+        if tag and alias:
+            aliases[tag] = alias
+    blocked.discard("")
+    return blocked, aliases
+
+class RulesPack:
+    """
+    One rules pack file, parsed into a blocklist set and an alias dict.
+        load() reads the precompiled JSON of the pack from cache_directory when it was made from the same
+        file (path, modification time and size), otherwise it parses the file and writes a new one.
+    """
+
+    def __init__(self, name, path, signature, blocked, aliases):
+        self.name = name
+        self.path = path
+        self.signature = signature
+        self.blocked = blocked
+        self.aliases = aliases
+
+    @classmethod
+    def load(cls, name, path, cache_directory=None):
+        stat = os.stat(path)
+        signature = [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+        cache_path = os.path.join(cache_directory, name + ".json") if cache_directory else None
+        if cache_path is not None and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as file:
+                    data = json.load(file)
+                if data.get("version") == CACHE_VERSION and data.get("signature") == signature:
+                    return cls(name, path, signature, frozenset(data["blocked"]), data["aliases"])
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        with open(path, "r", encoding="utf-8") as file:
+            blocked, aliases = parse_rules(file.read())
+        if cache_path is not None:
+            try:
+                os.makedirs(cache_directory, exist_ok=True)
+                temp_path = cache_path + ".tmp"
+                with open(temp_path, "w", encoding="utf-8") as file:
+                    json.dump({"version": CACHE_VERSION, "signature": signature, "blocked": sorted(blocked), "aliases": aliases}, file, ensure_ascii=False)
+                os.replace(temp_path, cache_path)
+            except OSError as error:
+                print(f"[RulesPack]: Error writing the precompiled pack {cache_path}: {error}")
+        return cls(name, path, signature, frozenset(blocked), aliases)
+
+    def __len__(self):
+        return len(self.blocked) + len(self.aliases)
+
+class RulesIndex:
+    """
+    Blocklist and aliases of several rules packs merged into a single set and dict, applied to a TagList in one pass.
+        Every tag is looked up once: an alias replaces the tag, then the tag (or its alias) is removed when blocked.
+        A later pack overrides the alias of an earlier one.
+    """
+
+    def __init__(self, packs):
+        self.names = [pack.name for pack in packs]
+        self.blocked = frozenset().union(*[pack.blocked for pack in packs])
+        self.aliases = {}
+        for pack in packs:
+            self.aliases.update(pack.aliases)
+
+    def __len__(self):
+        return len(self.blocked) + len(self.aliases)
+
+    def apply(self, tag_list):
+        tags, sources = [], []
+        for tag, source in zip(tag_list.tags, tag_list.sources):
+            alias = self.aliases.get(tag.normalized)
+            if alias is not None:
+                tag = make_tag(alias)
+            if tag.normalized not in self.blocked:
+                tags.append(tag.stripped())
+                sources.append(source)
+        return TagList.from_texts(tags, sources)
+
+class RulesPackLibrary:
+    """
+    Named rules packs of a directory, loaded once and reloaded when their file changes.
+        index() only checks the modification time and size of the selected packs, a pack is parsed again
+        (or read from its precompiled JSON) only after its file was edited, and the merged index is
+        rebuilt only when one of the selected packs changed.
+    """
+
+    def __init__(self, directory, cache_directory=None):
+        self.directory = directory
+        self.cache_directory = cache_directory
+        self.packs = {}
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    # Pack names of the directory, sorted
+    def names(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.splitext(filename)[0] for filename in os.listdir(self.directory) if filename.endswith(RULES_EXTENSION))
+
+    # Pack by name, loaded again when its file changed since it was loaded
+    def get(self, name):
+        path = os.path.join(self.directory, name + RULES_EXTENSION)
+        stat = os.stat(path)
+        signature = [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+        with self.lock:
+            pack = self.packs.get(name)
+            if pack is None or pack.signature != signature:
+                pack = self.packs[name] = RulesPack.load(name, path, self.cache_directory)
+            return pack
+
+    # Merged index of the selected packs, packs that cannot be read are skipped with an error
+    def index(self, names):
+        packs = []
+        for name in names:
+            try:
+                packs.append(self.get(name))
+            except OSError as error:
+                print(f"[RulesPack]: Error loading the rules pack {name}: {error}")
+        key = tuple((pack.name, tuple(pack.signature)) for pack in packs)
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                # Only the current selection is kept, an edited pack makes the previous index useless
+                self.indexes = {key: RulesIndex(packs)}
+                index = self.indexes[key]
+            return index
+
+    def summary(self, names):
+        lines = []
+        for name in names:
+            try:
+                pack = self.get(name)
+            except OSError as error:
+                lines.append(f"{name}: {error}")
+                continue
+            lines.append(f"{name}: {len(pack.blocked)} blocked tag(s), {len(pack.aliases)} alias(es)")
+        return "\n".join(lines) if lines else "No rules pack selected."
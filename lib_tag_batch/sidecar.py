@@ -0,0 +1,145 @@
+import os
+import queue
+import threading
+
+from PIL import Image
+
+from .preprocess import oriented_size
+
+# Files read to find the source of one image, starting at the file after the last match
+MAX_SOURCE_CANDIDATES = 8
+
+# Caption files left next to an image by earlier tagging runs or training tools, checked in this order
+SIDECAR_EXTENSIONS = (".txt", ".caption")
+
+# Sidecar caption path of an image, "image.png" -> "image.txt", in directory instead of next to the image when given
+def sidecar_path(image_path, extension=".txt", directory=None):
+    stem = os.path.splitext(image_path)[0]
+    if directory:
+        stem = os.path.join(directory, os.path.basename(stem))
+    return stem + extension
+
+# First existing sidecar of an image, None if it has none
+def find_sidecar(image_path, extensions=SIDECAR_EXTENSIONS):
+    for extension in extensions:
+        path = sidecar_path(image_path, extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+# Caption of a sidecar file as a single comma separated line, None if it is empty
+def read_sidecar(path):
+    with open(path, "r", encoding="utf-8") as file:
+        lines = [line.strip() for line in file.read().splitlines()]
+    caption = ", ".join(line for line in lines if line)
+    return caption or None
+
+# Writes through a temporary file, a reader never sees a half written caption
+def write_sidecar(path, text):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(temp_path, path)
+
+class SidecarWriter:
+    """
+    Buffered background writer for sidecar captions.
+        write() only queues the caption, a daemon thread writes the files so the batch job never waits on disk.
+        flush() blocks until everything queued so far is on disk.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.written = 0
+        self.errors = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def write(self, path, text):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="tag-batch-sidecar-writer", daemon=True)
+                self.thread.start()
+        self.queue.put((path, text))
+
+    def run(self):
+        while True:
+            path, text = self.queue.get()
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                write_sidecar(path, text)
+                self.written += 1
+            except Exception as error:
+                self.errors += 1
+                print(f"[SidecarWriter]: Error writing {path}: {error}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+class SourcePaths:
+    """
+    Finds the file of the batch input directory an init image was read from. The img2img batch tab hands the script
+    EXIF-transposed copies without a filename, so the file is found by content hash.
+        The lookahead and pre-interrogation read every file anyway and remember() its hash, those are found directly.
+        Otherwise the files with the same size (read from the header) are read with read_digest(path), starting at the
+        file after the last match, since the batch tab processes the directory in order the first candidate is nearly
+        always the right one. At most MAX_SOURCE_CANDIDATES files are read per image, every file is read at most once.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.indexes = {path: index for index, path in enumerate(self.paths)}
+        self.sources = {}
+        self.read = set()
+        self.sizes = {}
+        self.cursor = 0
+        self.lock = threading.Lock()
+
+    # Content hash of a file that was read elsewhere
+    def remember(self, digest, path):
+        with self.lock:
+            self.sources.setdefault(digest, path)
+            self.read.add(path)
+
+    def size(self, path):
+        if path not in self.sizes:
+            try:
+                with Image.open(path) as image:
+                    self.sizes[path] = oriented_size(image)
+            except Exception:
+                self.sizes[path] = None
+        return self.sizes[path]
+
+    # Path of the image with this (width, height) and content hash, None when it is not in the directory
+    def find(self, size, digest, read_digest):
+        with self.lock:
+            path = self.sources.get(digest)
+            if path is not None:
+                self.cursor = self.indexes.get(path, self.cursor - 1) + 1
+                return path
+            candidates = 0
+            for offset in range(len(self.paths)):
+                if candidates >= MAX_SOURCE_CANDIDATES:
+                    break
+                index = (self.cursor + offset) % len(self.paths)
+                path = self.paths[index]
+                if path in self.read or self.size(path) != tuple(size):
+                    continue
+                candidates += 1
+                self.read.add(path)
+                try:
+                    path_digest = read_digest(path)
+                except Exception:
+                    continue
+                self.sources.setdefault(path_digest, path)
+                if path_digest == digest:
+                    self.cursor = index + 1
+                    return path
+            return None
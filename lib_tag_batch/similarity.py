@@ -0,0 +1,89 @@
+import collections
+import threading
+
+import numpy as np
+from PIL import Image
+
+# Grayscale thumbnail of an image, the only full image work of a perceptual hash
+def thumbnail(image, width, height):
+    return np.asarray(image.convert("L").resize((width, height), Image.BOX, reducing_gap=2.0), dtype=np.float32)
+
+# Packs a boolean array into an integer, first element is the highest bit
+def pack_bits(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+# aHash: pixels of an 8x8 thumbnail brighter than its mean
+def average_hash(image, size=8):
+    pixels = thumbnail(image, size, size)
+    return pack_bits(pixels > pixels.mean())
+
+# dHash: horizontal gradient signs of a 9x8 thumbnail, robust to brightness and contrast changes
+def difference_hash(image, size=8):
+    pixels = thumbnail(image, size + 1, size)
+    return pack_bits(pixels[:, 1:] > pixels[:, :-1])
+
+# DCT-II basis of a size x size transform
+def dct_matrix(size):
+    n = np.arange(size)
+    return np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+
+DCT_32 = dct_matrix(32)
+
+# pHash: low frequencies of the DCT of a 32x32 thumbnail above their median, the slowest but most tolerant to noise and rescaling
+def perceptual_hash(image, size=8):
+    pixels = thumbnail(image, 32, 32)
+    low = (DCT_32 @ pixels @ DCT_32.T)[:size, :size]
+    # The DC coefficient is the mean brightness, it would dominate the median
+    return pack_bits(low > np.median(low.ravel()[1:]))
+
+HASH_FUNCTIONS = {
+    "aHash": average_hash,
+    "dHash": difference_hash,
+    "pHash": perceptual_hash,
+}
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+class RecentFrames:
+    """
+    Index of the perceptual hashes of the most recently interrogated frames, their interrogations and the WD confidences of their tags.
+        find() returns (distance, interrogation, scores) of the closest recent frame within max_distance bits, or (None, None, None).
+        The scores are a copy, the caller may change them.
+        Only interrogated frames are added, a frame that reused an interrogation is not, so a slow pan
+        cannot drift away from the frame the interrogation came from.
+    """
+
+    def __init__(self, capacity=8, max_distance=4):
+        self.frames = collections.deque(maxlen=max(1, int(capacity)))
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.reused = 0
+
+    def find(self, frame_hash):
+        with self.lock:
+            self.lookups += 1
+            best = None
+            # Most recent first, the closest frame wins and the most recent one on a tie
+            for stored_hash, interrogation, scores in reversed(self.frames):
+                distance = hamming_distance(frame_hash, stored_hash)
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, interrogation, scores)
+            if best is None:
+                return None, None, None
+            self.reused += 1
+            distance, interrogation, scores = best
+            return distance, interrogation, dict(scores)
+
+    def add(self, frame_hash, interrogation, scores=None):
+        with self.lock:
+            self.frames.append((frame_hash, interrogation, dict(scores or {})))
+
+    def summary(self):
+        with self.lock:
+            ratio = self.reused / self.lookups if self.lookups else 0.0
+            return f"{self.reused}/{self.lookups} frame(s) reused an earlier interrogation ({ratio:.1%}), {self.lookups - self.reused} interrogated"
@@ -0,0 +1,151 @@
+import re
+import sys
+from functools import lru_cache
+
+from .text import EMOTICONS, remove_attention, remove_punctuation
+
+# Single tag with attention weight, "(long hair:1.2)"
+WEIGHTED_TAG = re.compile(r"\((.*):(\d+(?:\.\d+)?)\)")
+# Start of the emoticons that hold a comma, ":-," or "',:-|", a piece ending with one can join the next piece
+COMMA_EMOTICON_PREFIXES = tuple(sorted({emoticon[:emoticon.index(",")] for emoticon in EMOTICONS if "," in emoticon}))
+
+class Tag:
+    """
+    One comma separated piece of an interrogation, with its surrounding whitespace.
+        Tags are created through make_tag and shared by every occurrence of the same piece, so the
+        stripped text, the normalized form (attention removed) used by the filters, the lowercased
+        form and the attention weight are computed once per distinct tag instead of once per stage.
+    """
+
+    __slots__ = ("raw", "text", "normalized", "folded", "weight", "bare", "spaced")
+
+    def __init__(self, raw):
+        self.raw = sys.intern(raw)
+        self.text = sys.intern(raw.strip())
+        self.normalized = sys.intern(remove_attention(self.text))
+        self.folded = sys.intern(self.normalized.lower())
+        match = WEIGHTED_TAG.fullmatch(self.text)
+        self.weight = float(match.group(2)) if match else 1.0
+        self.bare = self if self.raw == self.text else None
+        self.spaced = None
+
+    # Same tag without the surrounding whitespace
+    def stripped(self):
+        if self.bare is None:
+            self.bare = make_tag(self.text)
+        return self.bare
+
+    # Same tag preceded by the space of a ", " separator
+    def after_separator(self):
+        if self.spaced is None:
+            self.spaced = make_tag(" " + self.text)
+        return self.spaced
+
+@lru_cache(maxsize=65536)
+def make_tag(raw):
+    return Tag(raw)
+
+# No Puncuation Mode of a single piece, tags repeat across a batch
+@lru_cache(maxsize=65536)
+def remove_piece_punctuation(raw):
+    return remove_punctuation(raw)
+
+class TagList:
+    """
+    Interrogation carried from stage to stage as a list of tags, rendered to a string once at the end.
+        The pieces are exactly the text split at every comma, render() joins them back with commas, so a
+        TagList renders to the same string the stages produced when they worked on the joined text.
+        Every tag keeps the name of the interrogator it came from in sources.
+        Stages return a new TagList, add() is the only method that changes a list.
+    """
+
+    def __init__(self, tags=None, sources=None):
+        self.tags = tags if tags is not None else []
+        self.sources = sources if sources is not None else [None] * len(self.tags)
+
+    @classmethod
+    def parse(cls, text, source=None):
+        tags = [make_tag(piece) for piece in text.split(",")]
+        return cls(tags, [source] * len(tags))
+
+    # Tidy list, the texts joined with ", "
+    @classmethod
+    def from_texts(cls, tags, sources):
+        if tags:
+            tags = [tags[0]] + [tag.after_separator() for tag in tags[1:]]
+        return cls(tags, sources)
+
+    # Same as interrogation += f"{text}, " on the joined text
+    def add(self, text, source=None):
+        if self.tags:
+            # The piece after the last comma continues with the new text
+            text = self.tags.pop().raw + text
+            self.sources.pop()
+        for piece in f"{text}, ".split(","):
+            self.tags.append(make_tag(piece))
+            self.sources.append(source)
+        return self
+
+    def render(self):
+        return ",".join([tag.raw for tag in self.tags])
+
+    def __str__(self):
+        return self.render()
+
+    # Number of non-empty tags
+    def __len__(self):
+        return sum(1 for tag in self.tags if tag.text)
+
+    def count_by_source(self):
+        counts = {}
+        for tag, source in zip(self.tags, self.sources):
+            if tag.text:
+                counts[source] = counts.get(source, 0) + 1
+        return counts
+
+    # Strips whitespace, drops empty entries and removes duplicates while preserving order, like pipeline.clean_string
+    def dedupe(self):
+        seen = set()
+        tags, sources = [], []
+        for tag, source in zip(self.tags, self.sources):
+            if tag.text and tag.text not in seen:
+                seen.add(tag.text)
+                tags.append(tag.stripped())
+                sources.append(source)
+        return TagList.from_texts(tags, sources)
+
+    # Removes the tags of a text.TagFilter, like TagFilter.apply
+    def filter(self, tag_filter):
+        tags, sources = [], []
+        for tag, source in zip(self.tags, self.sources):
+            if tag.normalized not in tag_filter.tags:
+                tags.append(tag.stripped())
+                sources.append(source)
+        return TagList.from_texts(tags, sources)
+
+    # Find & replace of a text.ReplaceEngine, finds never hold a comma so every piece can be replaced on its own
+    def replace(self, engine):
+        tags, sources = [], []
+        for tag, source in zip(self.tags, self.sources):
+            result = engine.apply_tag(tag.raw)
+            if result == tag.raw:
+                tags.append(tag)
+                sources.append(source)
+                continue
+            for piece in result.split(","):
+                tags.append(make_tag(piece))
+                sources.append(source)
+        return TagList(tags, sources)
+
+    # No Puncuation Mode, like text.remove_punctuation
+    def remove_punctuation(self):
+        # An emoticon such as ":-," spans two pieces, the joined text is needed to keep it
+        if any(tag.raw.endswith(COMMA_EMOTICON_PREFIXES) for tag in self.tags[:-1]):
+            return TagList.parse(remove_punctuation(self.render()))
+        tags, sources = [], []
+        for tag, source in zip(self.tags, self.sources):
+            text = remove_piece_punctuation(tag.raw)
+            if text:
+                tags.append(make_tag(text))
+                sources.append(source)
+        return TagList.from_texts(tags, sources)
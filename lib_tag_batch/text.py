@@ -0,0 +1,261 @@
+import re
+import string
+from functools import lru_cache
+
+# Attention suffix such as ":1.2"
+ATTENTION_WEIGHT = re.compile(r":\d+(\.\d+)?")
+# Parentheses that are not escaped with a backslash
+ATTENTION_PARENTHESES = re.compile(r"(?<!\\)[()]")
+
+# Removes attention syntax from a tag: ":##.##" suffixes and unescaped parentheses, escaped "\(" and "\)" are kept
+@lru_cache(maxsize=65536)
+def remove_attention(words):
+    words = ATTENTION_WEIGHT.sub("", words)
+    words = ATTENTION_PARENTHESES.sub("", words)
+    return words.strip()
+
+class TagFilter:
+    """
+    Precompiled tag filter.
+        The comma separated filter text is normalized once into a hash set, apply() then
+        removes matching tags from a prompt in a single pass with O(1) lookups.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tags = frozenset(remove_attention(word.strip()) for word in text.split(","))
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, word):
+        return remove_attention(word) in self.tags
+
+    def apply(self, prompt):
+        words = [word.strip() for word in prompt.split(",")]
+        return ", ".join(word for word in words if remove_attention(word) not in self.tags)
+
+class TagFilterCache:
+    """Keeps the compiled filters of the last few filter texts, a filter is only rebuilt when its text changes."""
+
+    def __init__(self, max_filters=8):
+        self.max_filters = max_filters
+        self.filters = {}
+
+    def get(self, text):
+        if text is None:
+            text = ""
+        tag_filter = self.filters.get(text)
+        if tag_filter is None:
+            if len(self.filters) >= self.max_filters:
+                # Drops the oldest filter, dicts keep insertion order
+                del self.filters[next(iter(self.filters))]
+            tag_filter = TagFilter(text)
+            self.filters[text] = tag_filter
+        return tag_filter
+
+def is_word_character(character):
+    return character.isalnum() or character == "_"
+
+# Text emoticons kept by No Puncuation Mode
+EMOTICONS = ("'s", "...", ":-)", ":)", ":-]", ":]", ":->", ":>", "8-)", "8)", ":-}", ":}", ":^)", "=]", "=)", ":-D", ":D", "8-D", "8D", "=D", "=3", "B^D",
+    "c:", "C:", "x-D", "X-D", ":-))", ":))", ":-(", ":(", ":-c", ":c", ":-<", ":<", ":-[", ":[", ":-||", ":{", ":@", ";(", ":'-(", ":'(", ":=(", ":'-)",
+    ":')", ">:(", ">:[", "D-':", "D:<", "D:", "D;", "D=", ":-O", ":O", ":-o", ":o", ":-0", ":0", "8-0", ">:O", "=O", "=o", "=0", ":-3", ":3", ">:3",
+    ":-*", ":*", ":x", ";-)", ";)", "*-)", "*)", ";-]", ";]", ";^)", ";>", ":-,", ";D", ";3", ":-P", ":P", "X-P", "x-p", ":-p", ":p", ":-Þ", ":Þ", ":-þ",
+    ":þ", ":-b", ":b", "d:", "=p", ">:P", ":-/", ":/", ":-.", ">:/", "=/", ":L", "=L", ":S", ":-|", ":|", ":$", "://)", "://3", ":-X", ":X", ":-#", ":#",
+    ":-&", ":&", "O:-)", "O:)", "0:-3", "0:3", "0:-)", "0:)", "0;^)", ">:-)", ">:)", "}:-)", "}:)", "3:-)", "3:)", ">;-)", ">;)", ">;3", "|;-)", "|-O",
+    "B-)", ":-J", "#-)", "%-)", "%)", ":-###..", ":###..", "<:-|", "',:-|", "',:-l", ":E", "8-X", "8=X", "x-3", "x=3", "~:>", "@};-", "@}->--", "@}-;-'---",
+    "@>-->--", "8====D", "8===D", "8=D", "3=D", "8=>", "8===D~~~", "*<|:-)", "</3", "<\\3", "<3", "><>", "<><", "<*)))-{", "><(((*>", "\\o/", "*\\0/*", "o7",
+    "v.v", "._.", "._.;", "X_X", "x_x", "+_+", "X_x", "x_X", "<_<", ">_>", "<.<", ">.>", "O_O", "o_o", "O-O", "o-o", "O_o", "o_O", ">.<", ">_<", "^5", "o/\\o",
+    ">_>^ ^<_<", "V.v.V")
+
+# Builds a regex that matches any of the words, branching like a trie so every character is tested once per position.
+# Longer continuations are tried first, so the longest word starting at a position wins
+def trie_pattern(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for character in word:
+            node = node.setdefault(character, {})
+        node[""] = {}
+    def build(node):
+        branches = [re.escape(character) + build(child) for character, child in sorted(node.items()) if character]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return build(trie)
+
+# Builds the single scan pattern: one branch per emoticon first character and per ASCII punctuation character.
+# Every branch starts with a literal, which lets re skip over the text between candidates without entering the pattern.
+# A match longer than one character is an emoticon, a single character is punctuation to drop, a comma ends a tag
+def punctuation_pattern(emoticons):
+    rests = {}
+    for emoticon in emoticons:
+        rests.setdefault(emoticon[0], []).append(emoticon[1:])
+    branches = []
+    for character in sorted(set(rests) | set(string.punctuation)):
+        if character == "_":
+            continue
+        tails = [tail for tail in rests.get(character, []) if tail]
+        if not tails:
+            branches.append(re.escape(character))
+        elif is_word_character(character):
+            branches.append(re.escape(character) + f"(?:{trie_pattern(tails)})")
+        else:
+            # Punctuation on its own when no emoticon continues from it
+            branches.append(re.escape(character) + f"(?:{trie_pattern(tails)})?")
+    return re.compile("|".join(branches))
+
+PUNCTUATION_TOKENS = punctuation_pattern(EMOTICONS)
+# Emoticons such as ":-," hold a comma that must not split a tag
+COMMA_EMOTICONS = re.compile("|".join(re.escape(emoticon) for emoticon in EMOTICONS if "," in emoticon))
+# Punctuation outside printable ASCII, no emoticon contains any so it is dropped after the scan
+OTHER_PUNCTUATION = re.compile(r"[^\w\s!-~]")
+
+def keep_emoticon(match):
+    text = match.group()
+    return text if len(text) > 1 or text == "," else ""
+
+# Removes punctuation except commas and known emoticons, then tidies the tags, in a single pass over the text
+def remove_punctuation(text):
+    if not COMMA_EMOTICONS.search(text):
+        # No kept emoticon can contain a comma, so every comma left ends a tag
+        tags = OTHER_PUNCTUATION.sub("", PUNCTUATION_TOKENS.sub(keep_emoticon, text)).split(",")
+    else:
+        tags = []
+        tag = []
+        position = 0
+        for match in PUNCTUATION_TOKENS.finditer(text):
+            tag.append(text[position:match.start()])
+            token = match.group()
+            if token == ",":
+                tags.append(OTHER_PUNCTUATION.sub("", "".join(tag)))
+                tag = []
+            elif len(token) > 1:
+                tag.append(token)
+            position = match.end()
+        tag.append(text[position:])
+        tags.append(OTHER_PUNCTUATION.sub("", "".join(tag)))
+    return ", ".join(tag for tag in (tag.strip() for tag in tags) if tag)
+
+# Offsets of a string where a regex \b can match, the two ends always count since a \b delimited match starts and ends there
+def word_boundaries(text):
+    boundaries = {0, len(text)}
+    for offset in range(1, len(text)):
+        if is_word_character(text[offset - 1]) != is_word_character(text[offset]):
+            boundaries.add(offset)
+    return boundaries
+
+# True if \b delimited matches of a and b can overlap in some text: one inside the other, or a suffix of one being a prefix of the other, at word boundaries
+def matches_can_overlap(a, a_boundaries, b, b_boundaries):
+    if not a or not b:
+        return False
+    for outer, outer_boundaries, inner in ((a, a_boundaries, b), (b, b_boundaries, a)):
+        start = outer.find(inner)
+        while start != -1:
+            if start in outer_boundaries and start + len(inner) in outer_boundaries:
+                return True
+            start = outer.find(inner, start + 1)
+    for first, first_boundaries, second, second_boundaries in ((a, a_boundaries, b, b_boundaries), (b, b_boundaries, a, a_boundaries)):
+        for offset in first_boundaries:
+            shared = len(first) - offset
+            if 0 < offset < len(first) and shared < len(second) and shared in second_boundaries and second.startswith(first[offset:]):
+                return True
+    return False
+
+class ReplaceEngine:
+    """
+    Compiled find & replace pairs, same output as applying re.sub(r'\\b' + re.escape(old) + r'\\b', new, text) for every pair in order.
+        Consecutive pairs are grouped into runs that can be applied in one scan with a single alternation regex:
+        within a run no two finds can overlap, and no replacement can create or break a match of a later find.
+        Pairs that could interact start a new run, so the pairs are still applied left to right where order matters.
+    """
+
+    def __init__(self, replace_pairs):
+        self.pairs = list(replace_pairs.items())
+        self.memo = {}
+        self.runs = []
+        run = []
+        for old, new in self.pairs:
+            old_boundaries = word_boundaries(old)
+            if run and (not old or not self.fits_run(run, old, old_boundaries)):
+                self.runs.append(run)
+                run = []
+            run.append((old, new, old_boundaries, word_boundaries(new)))
+            # An empty find matches every word boundary, and deletions join their neighbours, both end the run
+            if not old or not self.keeps_boundaries(old, new):
+                self.runs.append(run)
+                run = []
+        if run:
+            self.runs.append(run)
+        self.runs = [self.compile_run([(old, new) for old, new, _, _ in run]) for run in self.runs]
+
+    # A replacement keeps the word boundaries around it if its first and last characters are of the same kind as the find's
+    def keeps_boundaries(self, old, new):
+        if not new:
+            return False
+        return is_word_character(old[0]) == is_word_character(new[0]) and is_word_character(old[-1]) == is_word_character(new[-1])
+
+    # A find joins the run if no earlier find in the run can overlap its matches, and no earlier replacement can create one
+    def fits_run(self, run, old, old_boundaries):
+        for run_old, run_new, run_old_boundaries, run_new_boundaries in run:
+            if matches_can_overlap(run_old, run_old_boundaries, old, old_boundaries) or matches_can_overlap(run_new, run_new_boundaries, old, old_boundaries):
+                return False
+        return True
+
+    def compile_run(self, run):
+        if len(run) == 1 and not run[0][0]:
+            # Empty find, kept as a plain re.sub so its template is applied at every boundary exactly like before
+            old, new = run[0]
+            return re.compile(r'\b' + re.escape(old) + r'\b'), new
+        # Templates are expanded once, the match is always the literal find so the result is the same for every match
+        replacements = {old: re.compile(re.escape(old)).sub(new, old) for old, new in run}
+        pattern = re.compile(r'\b(?:' + "|".join(re.escape(old) for old, _ in run) + r')\b')
+        return pattern, lambda match: replacements[match.group(0)]
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def apply(self, text):
+        for pattern, replacement in self.runs:
+            text = pattern.sub(replacement, text)
+        return text
+
+    # Memoized apply for short texts that repeat across a batch, such as single tags
+    def apply_tag(self, text):
+        result = self.memo.get(text)
+        if result is None:
+            if len(self.memo) >= 65536:
+                self.memo.clear()
+            result = self.memo[text] = self.apply(text)
+        return result
+
+# Parses the Find and Replace textboxes into ordered pairs, extra entries without a counterpart are ignored
+def parse_replace_pairs(custom_replace_find, custom_replace_replacements):
+    old_list = [phrase.strip() for phrase in custom_replace_find.split(',')]
+    new_list = [phrase.strip() for phrase in custom_replace_replacements.split(',')]
+    min_length = min(len(old_list), len(new_list))
+    return {old_list[i]: new_list[i] for i in range(min_length)}
+
+class ReplaceEngineCache:
+    """Keeps the compiled engines of the last few find & replace texts, the textboxes are only parsed when they change."""
+
+    def __init__(self, max_engines=4):
+        self.max_engines = max_engines
+        self.engines = {}
+
+    def get(self, key, build):
+        engine = self.engines.get(key)
+        if engine is None:
+            if len(self.engines) >= self.max_engines:
+                del self.engines[next(iter(self.engines))]
+            engine = build()
+            self.engines[key] = engine
+        return engine
+
+    def from_text(self, custom_replace_find, custom_replace_replacements):
+        return self.get((custom_replace_find, custom_replace_replacements), lambda: ReplaceEngine(parse_replace_pairs(custom_replace_find, custom_replace_replacements)))
+
+    def from_pairs(self, replace_pairs):
+        return self.get(tuple(replace_pairs.items()), lambda: ReplaceEngine(replace_pairs))
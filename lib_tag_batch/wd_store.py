@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+from .onnx_pool import read_selected_tags
+
+# Category ids used by the selected_tags.csv files that ship with the WD tagger models
+WD_CATEGORIES = {0: "general", 1: "artist", 3: "copyright", 4: "character", 5: "meta", 9: "rating"}
+# Bytes of the vocabulary hash stored in front of every vector
+VOCABULARY_HASH_SIZE = 8
+
+# Content hash of a vocabulary, its ratings and tags in order
+def vocabulary_hash(ratings, tags):
+    return hashlib.blake2b(json.dumps([list(ratings), list(tags)]).encode("utf-8"), digest_size=VOCABULARY_HASH_SIZE).hexdigest()
+
+# Vocabulary of a WD tagger from its selected_tags.csv as (ratings, tags, category names), the first 4 rows are the ratings like in wd_ext_utils
+def selected_tags_vocabulary(tags_path):
+    names, categories = read_selected_tags(tags_path)
+    return names[:4], names[4:], [WD_CATEGORIES.get(category, "general") for category in categories[4:]]
+
+class TagConfidenceStore:
+    """
+    Compact store for raw WD tagger confidences.
+        Every WD model gets a vocabulary (its ratings followed by its tags, in the order the tagger reports them),
+        an image is then a single float32 vector indexed by that vocabulary. Thresholds, ratings, underscore fix,
+        per-category thresholds and top-k are applied to the vector with NumPy instead of a loop over every tag.
+        The vocabularies are saved to a JSON file, the vectors themselves are stored by the interrogation cache.
+        Every vector starts with the content hash of its vocabulary, which is also part of the cache mode of its model,
+        so a changed vocabulary only invalidates the vectors of that model and a vector is never read with other tags.
+        register() sets the vocabulary before the first interrogation, otherwise the cache mode of a new model changes
+        with its first encode().
+    """
+
+    def __init__(self, path, replace_underscores):
+        self.path = path
+        self.replace_underscores = replace_underscores
+        self.lock = threading.Lock()
+        self.models = {}
+        # Vocabulary hashes already in the JSON file, it is only written again for a new vocabulary
+        self.saved = set()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            for model, vocabulary in data["models"].items():
+                self.set_vocabulary(model, vocabulary["ratings"], vocabulary["tags"], vocabulary.get("categories"))
+                self.saved.add(self.models[model]["hash"])
+        except FileNotFoundError:
+            pass
+        except Exception as error:
+            print(f"[TagConfidenceStore]: Discarding unreadable vocabulary file {self.path}: {error}")
+
+    def save(self):
+        data = {
+            "models": {
+                model: {"ratings": vocabulary["ratings"], "tags": vocabulary["tags"], "categories": vocabulary["category_names"]}
+                for model, vocabulary in self.models.items()
+            }
+        }
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(temp_path, self.path)
+
+    def set_vocabulary(self, model, ratings, tags, category_names=None):
+        if category_names is None or len(category_names) != len(tags):
+            category_names = ["general"] * len(tags)
+        self.models[model] = {
+            "ratings": list(ratings),
+            "tags": list(tags),
+            "category_names": list(category_names),
+            "tag_names": np.array(tags, dtype=object),
+            "spaced_names": np.array([self.replace_underscores(tag) for tag in tags], dtype=object),
+            "categories": np.array(category_names, dtype=object),
+            "hash": vocabulary_hash(ratings, tags),
+        }
+
+    # Cache mode for the vectors of a model, it changes with the vocabulary of that model only
+    def cache_mode(self, model):
+        vocabulary = self.models.get(model)
+        return f"confidences:{vocabulary['hash'] if vocabulary is not None else 'new'}"
+
+    # Reads tag categories from a loaded WD EXT interrogator, if it exposes its selected_tags.csv table
+    def read_categories(self, interrogator, tags):
+        table = getattr(interrogator, "tags", None)
+        if table is None or not hasattr(table, "columns") or "category" not in table.columns or "name" not in table.columns:
+            return None
+        lookup = dict(zip(table["name"], table["category"]))
+        return [WD_CATEGORIES.get(int(lookup.get(tag, 0)), "general") for tag in tags]
+
+    # Creates or rebuilds the vocabulary of a model if it differs, lock must be held
+    def update_vocabulary(self, model, rating_names, tag_names, categories=None):
+        vocabulary = self.models.get(model)
+        if vocabulary is None or vocabulary["ratings"] != rating_names or vocabulary["tags"] != tag_names:
+            # New model, or the model changed in place: vectors stored with the previous vocabulary no longer decode
+            self.set_vocabulary(model, rating_names, tag_names, categories)
+            if self.models[model]["hash"] not in self.saved:
+                self.saved.add(self.models[model]["hash"])
+                self.save()
+        elif categories is not None and vocabulary["category_names"] != categories:
+            self.set_vocabulary(model, rating_names, tag_names, categories)
+            self.save()
+
+    # Sets the vocabulary of a model before it is interrogated, so its cache mode is final before any cache key is made
+    def register(self, model, ratings, tags, categories=None):
+        with self.lock:
+            self.update_vocabulary(model, list(ratings), list(tags), categories)
+
+    # Turns one rating/tags interrogation into a float32 vector, the model vocabulary is created or rebuilt if needed
+    def encode(self, model, rating, tags, categories=None):
+        rating_names = list(rating.keys())
+        tag_names = list(tags.keys())
+        with self.lock:
+            self.update_vocabulary(model, rating_names, tag_names, categories)
+            prefix = bytes.fromhex(self.models[model]["hash"])
+        vector = np.fromiter(
+            (float(value) for value in list(rating.values()) + list(tags.values())),
+            dtype=np.float32,
+            count=len(rating_names) + len(tag_names)
+        )
+        return prefix + vector.tobytes()
+
+    # Reads a stored vector back, returns None if it was not made with the current model vocabulary
+    def decode(self, model, blob):
+        vocabulary = self.models.get(model)
+        if vocabulary is None or not isinstance(blob, bytes) or blob[:VOCABULARY_HASH_SIZE] != bytes.fromhex(vocabulary["hash"]):
+            return None
+        vector = np.frombuffer(blob, dtype=np.float32, offset=VOCABULARY_HASH_SIZE)
+        if vector.shape[0] != len(vocabulary["ratings"]) + len(vocabulary["tags"]):
+            return None
+        return vector
+
+    # Applies threshold, per-category thresholds, top-k and underscore fix to a vector, returns the tag list and rating confidences
+    # Selected tag names and the ratings, with_scores also returns the confidence of every selected tag
+    def select(self, model, vector, threshold, underscore_fix=True, category_thresholds=None, top_k=0, with_scores=False):
+        vocabulary = self.models[model]
+        rating_count = len(vocabulary["ratings"])
+        ratings = dict(zip(vocabulary["ratings"], vector[:rating_count].tolist()))
+        confidences = vector[rating_count:]
+
+        if category_thresholds:
+            thresholds = np.full(confidences.shape, threshold, dtype=np.float32)
+            for category, category_threshold in category_thresholds.items():
+                thresholds[vocabulary["categories"] == category] = category_threshold
+            selected = np.flatnonzero(confidences > thresholds)
+        else:
+            selected = np.flatnonzero(confidences > threshold)
+
+        # Keeps the k most confident tags, in the order the tagger reports them
+        if top_k and selected.shape[0] > top_k:
+            strongest = np.argpartition(-confidences[selected], top_k - 1)[:top_k]
+            selected = np.sort(selected[strongest])
+
+        names = vocabulary["spaced_names"] if underscore_fix else vocabulary["tag_names"]
+        if with_scores:
+            return names[selected].tolist(), ratings, confidences[selected].tolist()
+        return names[selected].tolist(), ratings
+
+# Parses "category:threshold" pairs separated by commas, e.g. "character:0.85, general:0.35"
+def parse_category_thresholds(text):
+    thresholds = {}
+    for entry in (text or "").split(","):
+        if ":" not in entry:
+            continue
+        category, value = entry.rsplit(":", 1)
+        try:
+            thresholds[category.strip().lower()] = float(value)
+        except ValueError:
+            print(f"[TagConfidenceStore]: Ignoring invalid category threshold `{entry.strip()}`")
+    return thresholds
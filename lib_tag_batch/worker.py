@@ -0,0 +1,251 @@
+"""
+Local interrogation worker: keeps the interrogator backends loaded in their own process and serves
+interrogations to the webui script (and any other client) over a local TCP socket.
+
+Usage (from the extension directory):
+    python -m lib_tag_batch.worker --backend wd --wd-model-dir models/wd-v1-4-vit-tagger-v2
+    python -m lib_tag_batch.worker --backend stub                                # stub worker, no models
+    python -m lib_tag_batch.worker --backend my_package.taggers:MyTagger --address 127.0.0.1:7871
+
+Every client connection is kept open and may send several requests before reading the responses,
+the responses come back in request order. Several webui instances can share one worker, the backends
+are loaded once per machine and run one request at a time.
+
+Protocol: every message is a frame, a 4 byte big-endian header length, a JSON header and header["size"]
+bytes of payload. Requests are {"id", "op": "info"} or {"id", "op": "interrogate", "mode", "width", "height", "size"}
+with the raw image bytes as payload, responses are {"id", ...} with "error" set when the request failed.
+"""
+import argparse
+import hashlib
+import json
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+from .cli import add_backend_arguments
+from .engine import load_backend, resolve_backend
+
+PROTOCOL_VERSION = 1
+DEFAULT_ADDRESS = "127.0.0.1:7870"
+# Headers are small JSON objects, anything larger is a broken or foreign client
+MAX_HEADER_SIZE = 1 << 20
+HEADER_LENGTH = struct.Struct(">I")
+
+class WorkerError(RuntimeError):
+    """Request the worker could not serve, or a worker that cannot be reached."""
+
+# "host:port" or "port" to a (host, port) pair, the host defaults to the loopback interface
+def parse_address(address):
+    host, _, port = (address or DEFAULT_ADDRESS).strip().rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+def encode_frame(header, payload=b""):
+    header = dict(header, size=len(payload))
+    data = json.dumps(header).encode("utf-8")
+    return HEADER_LENGTH.pack(len(data)) + data + payload
+
+def read_exact(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise EOFError("Connection closed")
+    return data
+
+# Reads one frame from a binary file object, raises EOFError when the connection closed
+def read_frame(file):
+    (length,) = HEADER_LENGTH.unpack(read_exact(file, HEADER_LENGTH.size))
+    if length > MAX_HEADER_SIZE:
+        raise WorkerError(f"Header of {length} bytes is too large")
+    header = json.loads(read_exact(file, length).decode("utf-8"))
+    payload = read_exact(file, header.get("size", 0)) if header.get("size") else b""
+    return header, payload
+
+class InterrogationWorker:
+    """
+    Backends served by the worker. Every request runs all backends in order, like the headless engine,
+    the raw interrogation is returned and the post-processing is left to the client.
+        signature identifies the backends and their options, clients use it in their cache keys.
+    """
+
+    def __init__(self, backends, signature=""):
+        self.backends = backends
+        self.names = [getattr(backend, "name", type(backend).__name__) for backend in backends]
+        self.signature = signature
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def info(self):
+        return {"version": PROTOCOL_VERSION, "backends": self.names, "signature": self.signature, "requests": self.requests}
+
+    def interrogate(self, image):
+        # Backends are not thread safe, connections take turns
+        with self.lock:
+            self.requests += 1
+            return [[name, backend.interrogate(image)] for name, backend in zip(self.names, self.backends)]
+
+    def handle(self, header, payload):
+        from PIL import Image
+        response = {"id": header.get("id")}
+        try:
+            if header.get("op") == "info":
+                response.update(self.info())
+            elif header.get("op") == "interrogate":
+                image = Image.frombytes(header["mode"], (header["width"], header["height"]), payload)
+                response["results"] = self.interrogate(image)
+            else:
+                response["error"] = f"Unknown operation {header.get('op')}"
+        except Exception as error:
+            response["error"] = f"{type(error).__name__}: {error}"
+        return response
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+    # One thread per connection, requests of a connection are answered in order
+    def handle(self):
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                header, payload = read_frame(self.rfile)
+            except (EOFError, OSError, ValueError, WorkerError):
+                return
+            self.wfile.write(encode_frame(self.server.worker.handle(header, payload)))
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, worker):
+        self.worker = worker
+        super().__init__(parse_address(address), WorkerRequestHandler)
+
+class WorkerClient:
+    """
+    Persistent connection to an interrogation worker.
+        The connection is opened on first use and reused, a dropped connection is opened again once per call.
+        interrogate_many() pipelines the requests: up to depth requests are sent before the first response is
+        read, so the worker never waits for the next image. Calls from several threads take turns.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, depth=8, timeout=300):
+        self.address = address
+        self.depth = max(1, int(depth))
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connection = None
+        self.file = None
+        self.next_id = 0
+        # Backend signature of the worker, known after the first info()
+        self.signature = None
+
+    def connect(self):
+        self.connection = socket.create_connection(parse_address(self.address), timeout=self.timeout)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.connection.makefile("rb")
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+    def disconnect(self):
+        if self.connection is not None:
+            try:
+                self.file.close()
+                self.connection.close()
+            except OSError:
+                pass
+        self.connection = None
+        self.file = None
+
+    # Sends the requests (header, payload) with at most depth of them in flight, returns the response headers in order
+    def exchange(self, requests):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.connect()
+                    return self.pipeline(requests)
+                except WorkerError:
+                    self.disconnect()
+                    raise
+                except (OSError, EOFError) as error:
+                    self.disconnect()
+                    if attempt:
+                        raise WorkerError(f"Interrogation worker at {self.address} is not reachable: {error}") from error
+
+    def pipeline(self, requests):
+        responses = []
+        ids = []
+        sent = 0
+        while len(responses) < len(requests):
+            while sent < len(requests) and sent - len(responses) < self.depth:
+                header, payload = requests[sent]
+                self.next_id += 1
+                ids.append(self.next_id)
+                self.connection.sendall(encode_frame(dict(header, id=self.next_id), payload))
+                sent += 1
+            response, _ = read_frame(self.file)
+            if response.get("id") != ids[len(responses)]:
+                raise EOFError(f"Response {response.get('id')} out of order, expected {ids[len(responses)]}")
+            responses.append(response)
+        return responses
+
+    def info(self):
+        response = self.exchange([({"op": "info"}, b"")])[0]
+        if "error" in response:
+            raise WorkerError(response["error"])
+        self.signature = response.get("signature")
+        return response
+
+    # Raw interrogation of every image, the results of the worker backends joined in order
+    def interrogate_many(self, images):
+        requests = []
+        for image in images:
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            requests.append(({"op": "interrogate", "mode": image.mode, "width": image.width, "height": image.height}, image.tobytes()))
+        results = []
+        for response in self.exchange(requests):
+            if "error" in response:
+                raise WorkerError(f"Interrogation worker at {self.address} failed: {response['error']}")
+            results.append(", ".join(text for _, text in response["results"]))
+        return results
+
+    def interrogate(self, image):
+        return self.interrogate_many([image])[0]
+
+# Identifies the backends, their preprocessing and the options that change their output
+def backend_signature(options, backends=()):
+    relevant = {name: options.get(name) for name in ("backends", "wd_model_dir", "wd_threshold", "wd_character_threshold", "keep_underscores")}
+    relevant["preprocessing"] = [getattr(backend, "preprocessing", None) for backend in backends]
+    return hashlib.blake2b(json.dumps(relevant, sort_keys=True).encode("utf-8"), digest_size=6).hexdigest()
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_backend_arguments(parser)
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help=f"host:port to listen on, defaults to {DEFAULT_ADDRESS}")
+    args = parser.parse_args(argv)
+    if not args.backends:
+        parser.error("at least one --backend is required")
+    return args
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    options = vars(args)
+    try:
+        for spec in args.backends:
+            resolve_backend(spec)
+        backends = [load_backend(spec, options) for spec in args.backends]
+    except Exception as error:
+        print(f"[ERROR]: {error}", file=sys.stderr)
+        return 2
+    worker = InterrogationWorker(backends, backend_signature(options, backends))
+    with WorkerServer(args.address, worker) as server:
+        print(f"Interrogation worker with {', '.join(worker.names)} listening on {args.address}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,48 @@
 import gradio as gr
 import re
-from modules import scripts, deepbooru, script_callbacks, shared
+from modules import scripts, deepbooru, devices, shared
 from modules.ui_components import InputAccordion
 from modules.processing import process_images
 from modules.shared import state
+import concurrent.futures
+import contextlib
+import gc
+import os
 import sys
+import time
+import threading
 import importlib.util
+import psutil
+import torch
+from PIL import Image, ImageOps
+from lib_tag_batch.budget import TRIM_PRIORITIES, BudgetTrimmer, chunk_count, tag_priorities
+from lib_tag_batch.canonical import CANONICAL_ORDERS, CanonicalOrder, PromptRepeats, vocabulary_ranks
+from lib_tag_batch.cache import InterrogationCache, cache_key, image_digest
+from lib_tag_batch.discovery import DiscoveryCache
+from lib_tag_batch.lazy import LazyLoader
+from lib_tag_batch.metrics import BatchMetrics
+from lib_tag_batch.onnx_pool import WDSessionPool
+from lib_tag_batch.pipeline import assemble_prompt, clean_string, post_processing_stages, replace_underscores, run_stages, weight_interrogation
+from lib_tag_batch.batching import chunked, distinct_items, list_images, wd_batch_interrogate, wd_input_height, wd_preprocess, wd_run
+from lib_tag_batch.prefetch import LookaheadPrefetcher
+from lib_tag_batch.preprocess import DECODE_SIDE, PreparedImage, reduce_decoded
+from lib_tag_batch.residency import ModelResidency
+from lib_tag_batch.rules import RulesPackLibrary
+from lib_tag_batch.similarity import HASH_FUNCTIONS, RecentFrames
+from lib_tag_batch.tags import TagList
+from lib_tag_batch.sidecar import SidecarWriter, SourcePaths, find_sidecar, read_sidecar, sidecar_path
+from lib_tag_batch.text import ReplaceEngineCache, TagFilterCache, parse_replace_pairs, remove_attention, remove_punctuation
+from lib_tag_batch.worker import DEFAULT_ADDRESS, WorkerClient, WorkerError
+from lib_tag_batch.wd_store import WD_CATEGORIES, TagConfidenceStore, parse_category_thresholds, selected_tags_vocabulary
 
 NAME = "Img2img Batch Interrogator"
+# Interrogators that do not touch shared.state, CLIP (Native) and CLIP (EXT) reset the job state and must stay on the main thread
+BACKGROUND_MODELS = ("Deepbooru (Native)", "WD (EXT)", "Interrogation Worker")
+CACHE_PATH = "extensions/sd-Img2img-batch-interrogator/interrogation_cache.sqlite"
+WD_VOCABULARY_PATH = "extensions/sd-Img2img-batch-interrogator/wd_vocabulary.json"
+METRICS_DIRECTORY = "extensions/sd-Img2img-batch-interrogator/metrics"
+RULES_DIRECTORY = "extensions/sd-Img2img-batch-interrogator/rules"
+RULES_CACHE_DIRECTORY = "extensions/sd-Img2img-batch-interrogator/rules_cache"
 
 """
 
@@ -31,12 +66,15 @@ def get_extensions_list():
             })
     return ext_list
 
+# Extention scan is cached, installing, removing, enabling or disabling an extension changes the extensions directory or the webui config
+extension_discovery = DiscoveryCache(
+    lambda: {ext["name"]: ext["enabled"] for ext in get_extensions_list()},
+    ["extensions", getattr(shared.cmd_opts, "ui_settings_file", None) or "config.json"]
+)
+
 # Extention Checker
 def is_interrogator_enabled(interrogator):
-    for ext in get_extensions_list():
-        if ext["name"] == interrogator:
-            return ext["enabled"]
-    return False
+    return extension_discovery.get().get(interrogator, False)
 
 # EXT Importer
 def import_module(module_name, file_path):
@@ -51,6 +89,47 @@ class Script(scripts.ScriptBuiltinUI):
     clip_ext = None
     first = True
     prompt_contamination = ""
+    contaminated_prompt = None
+    wd_ext_models = None
+    interrogation_cache = None
+    wd_tag_store = None
+    # Cache mode of every WD model for the current batch job, fixed at its first use so every pass keys the model the same way
+    wd_cache_modes = {}
+    active_cache = None
+    precomputed = {}
+    prefetcher = None
+    # Guards replacing Script.prefetcher, the lookahead worker only sets lookahead_cancelled and the main thread stops it
+    lookahead_lock = threading.Lock()
+    lookahead_cancelled = threading.Event()
+    residency = None
+    metrics = None
+    sidecar_writer = SidecarWriter()
+    # Reduced-Resolution Decoding of the current batch, the lookahead and pre-interrogation read files the same way
+    reduced_decoding = False
+    # Files of the batch input directory by content, to find the source file of an init image, see get_source_path
+    source_paths = None
+    recent_frames = None
+    # Batches that repeated the prompts of the previous batch, one counter per batch job
+    prompt_repeats = PromptRepeats()
+    # Tag ranks of the Vocabulary canonical order, (key, ranks) of the last selection of WD models
+    vocabulary_ranks = (None, {})
+    tag_filters = TagFilterCache()
+    replace_engines = ReplaceEngineCache()
+    # Rules packs are loaded once and reloaded when their file changes, see lib_tag_batch.rules
+    rules_packs = RulesPackLibrary(RULES_DIRECTORY, RULES_CACHE_DIRECTORY)
+    # Integrations with other extensions are imported once, on first use, see load_clip_ext_module and load_wd_ext_module
+    clip_ext_loader = LazyLoader(lambda: Script.import_clip_ext_module())
+    wd_ext_loader = LazyLoader(lambda: Script.import_wd_ext_module())
+    # Interrogators are not thread safe, every call to a model holds its lock, different models may run at the same time
+    model_locks = {}
+    model_locks_guard = threading.Lock()
+    interrogation_pool = None
+    # CPU session pools of the WD taggers, (sessions, threads, batch size) when enabled, see get_wd_session_pool
+    wd_pool_options = None
+    wd_session_pools = {}
+    wd_session_pools_lock = threading.Lock()
+    # Connection to the local interrogation worker, see lib_tag_batch.worker
+    worker_client = None
 
     def title(self):
         # "Img2img Batch Interrogator"
@@ -59,36 +138,41 @@ class Script(scripts.ScriptBuiltinUI):
     def show(self, is_img2img):
         return scripts.AlwaysVisible if is_img2img else False
  
-    # Checks for CLIP EXT to see if it is installed and enabled
+    # Checks for CLIP EXT to see if it is installed and enabled, runs once through clip_ext_loader
     @classmethod
-    def load_clip_ext_module(cls):
+    def import_clip_ext_module(cls):
         if is_interrogator_enabled('clip-interrogator-ext'):
-            cls.clip_ext = import_module("clip-interrogator-ext", "extensions/clip-interrogator-ext/scripts/clip_interrogator_ext.py")
-            print(f"[{NAME} LOADER]: `clip-interrogator-ext` found...")
-            return cls.clip_ext
+            started = time.perf_counter()
+            module = import_module("clip-interrogator-ext", "extensions/clip-interrogator-ext/scripts/clip_interrogator_ext.py")
+            print(f"[{NAME} LOADER]: `clip-interrogator-ext` found, imported in {time.perf_counter() - started:.2f}s...")
+            return module
         print(f"[{NAME} LOADER]: `clip-interrogator-ext` NOT found!")
         return None
 
-    # Initiates extenion check at startup for CLIP EXT
+    # Imports CLIP EXT the first time a batch or dropdown needs it, instead of at webui startup
     @classmethod
-    def load_clip_ext_module_wrapper(cls, *args, **kwargs):
-        return cls.load_clip_ext_module()
+    def load_clip_ext_module(cls):
+        cls.clip_ext = cls.clip_ext_loader.get()
+        return cls.clip_ext
 
-    # Checks for WD EXT to see if it is installed and enabled
+    # Checks for WD EXT to see if it is installed and enabled, runs once through wd_ext_loader
     @classmethod
-    def load_wd_ext_module(cls):
+    def import_wd_ext_module(cls):
         if is_interrogator_enabled('stable-diffusion-webui-wd14-tagger'):
-            sys.path.append('extensions/stable-diffusion-webui-wd14-tagger')
-            cls.wd_ext_utils = import_module("utils", "extensions/stable-diffusion-webui-wd14-tagger/tagger/utils.py")
-            print(f"[{NAME} LOADER]: `stable-diffusion-webui-wd14-tagger` found...")
-            return cls.wd_ext_utils
+            started = time.perf_counter()
+            if 'extensions/stable-diffusion-webui-wd14-tagger' not in sys.path:
+                sys.path.append('extensions/stable-diffusion-webui-wd14-tagger')
+            module = import_module("utils", "extensions/stable-diffusion-webui-wd14-tagger/tagger/utils.py")
+            print(f"[{NAME} LOADER]: `stable-diffusion-webui-wd14-tagger` found, imported in {time.perf_counter() - started:.2f}s...")
+            return module
         print(f"[{NAME} LOADER]: `stable-diffusion-webui-wd14-tagger` NOT found!")
         return None
     
-    # Initiates extenion check at startup for WD EXT
+    # Imports WD EXT the first time a batch or dropdown needs it, instead of at webui startup
     @classmethod
-    def load_wd_ext_module_wrapper(cls, *args, **kwargs):
-        return cls.load_wd_ext_module()
+    def load_wd_ext_module(cls):
+        cls.wd_ext_utils = cls.wd_ext_loader.get()
+        return cls.wd_ext_utils
         
     # Initiates prompt reset on image save
     @classmethod
@@ -103,46 +187,195 @@ class Script(scripts.ScriptBuiltinUI):
     def debug_print(self, debug_mode, message):
         if debug_mode:
             print(f"[{NAME} DEBUG]: {message}")
+
+    # Times a block as a batch metrics stage, does nothing when batch metrics are disabled
+    def measure(self, stage):
+        if Script.metrics is None:
+            return contextlib.nullcontext()
+        return Script.metrics.time(stage)
+
+    # Writes the metrics of the previous batch run (if any) and starts collecting new ones when enabled
+    def start_metrics(self, use_batch_metrics, batch_metrics_trace, debug_mode):
+        self.write_metrics(debug_mode)
+        if use_batch_metrics:
+            Script.metrics = BatchMetrics(trace=batch_metrics_trace)
+        if Script.residency is not None:
+            Script.residency.observer = Script.metrics.record_model if Script.metrics is not None else None
+
+    # Writes the batch summary as JSON and CSV (and the per-image trace) to the metrics folder
+    def write_metrics(self, debug_mode):
+        if Script.metrics is None:
+            return
+        metrics = Script.metrics
+        Script.metrics = None
+        if Script.residency is not None:
+            Script.residency.observer = None
+        try:
+            prefix = time.strftime("batch-%Y%m%d-%H%M%S", time.localtime(metrics.started))
+            paths = metrics.write(METRICS_DIRECTORY, prefix)
+            print(f"[{NAME}]: Batch metrics of {metrics.images} image(s) written to {', '.join(paths)}")
+        except Exception as error:
+            print(f"[{NAME} ERROR]: Error writing batch metrics: {error}")
+
+    # Index of the batch input directory for the sidecar options, one per batch job
+    def start_source_paths(self, use_sidecars, batch_input_directory):
+        Script.source_paths = None
+        if not use_sidecars:
+            return
+        if not batch_input_directory:
+            print(f"[{NAME} ERROR]: Sidecar captions need the batch input directory to find the file of every image.")
+            return
+        Script.source_paths = SourcePaths(list_images(batch_input_directory))
+    
+    # File the init image was read from. The img2img batch tab passes EXIF-transposed copies that lost their filename,
+    # those are looked up by content in the batch input directory
+    def get_source_path(self, init_image, digest):
+        path = getattr(init_image, "filename", None)
+        if path or Script.source_paths is None or digest is None:
+            return path or None
+        with self.measure("source path"):
+            return Script.source_paths.find(init_image.size, digest, lambda path: image_digest(self.read_pre_interrogation_image(path)))
+    
+    # Existing caption of the image being processed as (sidecar path, caption), (None, None) when there is none to use
+    def get_sidecar_caption(self, image_path):
+        path = find_sidecar(image_path) if image_path else None
+        if path is None:
+            return None, None
+        try:
+            caption = read_sidecar(path)
+        except Exception as error:
+            print(f"[{NAME} ERROR]: Error reading the sidecar caption `{path}`, interrogating instead: {error}")
+            return None, None
+        # An empty caption file is treated as no caption
+        return (path, caption) if caption is not None else (None, None)
+
+    # Queues the final interrogation of an image for the background sidecar writer
+    def export_sidecar(self, image_path, interrogation, export_directory, source_path, debug_mode):
+        if not image_path:
+            self.debug_print(debug_mode, "[Sidecar Export]: The file of the image was not found in the batch input directory, nothing to export")
+            return
+        path = sidecar_path(image_path, ".txt", export_directory)
+        # Never replace the caption that was just used with its filtered version
+        if source_path is not None and os.path.abspath(path) == os.path.abspath(source_path):
+            return
+        Script.sidecar_writer.write(path, interrogation.rstrip(", "))
+        self.debug_print(debug_mode, f"[Sidecar Export]: Queued {path}")
+
+    # Near-duplicate frame index of a batch job, a new one per batch job so frames of different jobs are never matched
+    def start_frame_reuse(self, use_frame_reuse, frame_window, frame_distance):
+        Script.recent_frames = RecentFrames(frame_window, frame_distance) if use_frame_reuse else None
+
+    # Prints how many frames of the batch job reused an interrogation
+    def report_frame_reuse(self):
+        if Script.recent_frames is not None:
+            print(f"[{NAME}]: [Near-Duplicate Frames]: {Script.recent_frames.summary()}")
+
+    # Prints how many batches of the batch job repeated the prompts of the previous batch
+    def report_prompt_repeats(self):
+        print(f"[{NAME}]: [Canonical Tag Order]: {Script.prompt_repeats.summary()}")
     
+    # Writes the access times of the cache hits so far, at the end of the batch job or when it is interrupted
+    def flush_interrogation_cache(self):
+        if Script.interrogation_cache is not None:
+            Script.interrogation_cache.flush()
+
+    # Waits for the background sidecar writer, at the end of the batch job
+    def flush_sidecars(self, debug_mode):
+        if Script.sidecar_writer.pending():
+            Script.sidecar_writer.flush()
+        self.debug_print(debug_mode, f"[Sidecar Export]: {Script.sidecar_writer.written} caption(s) written, {Script.sidecar_writer.errors} error(s)")
+
+    # Lock of one interrogator, CLIP EXT holds a single CLIP model at a time so all its models share one lock
+    def get_model_lock(self, model, variant):
+        name = f"{model}:{variant}" if model == "WD (EXT)" else model
+        with Script.model_locks_guard:
+            lock = Script.model_locks.get(name)
+            if lock is None:
+                lock = Script.model_locks[name] = threading.RLock()
+            return lock
+
+    # Runs interrogate_fn, unless the result for this image, model, variant and mode was pre-interrogated or is in the interrogation cache
+    def cached_interrogation(self, digest, model, variant, mode, interrogate_fn):
+        model_lock = self.get_model_lock(model, variant)
+        if digest is None:
+            with model_lock:
+                return interrogate_fn()
+        key = cache_key(digest, model, variant, mode)
+        # Pre-interrogation results are only needed once, dropping them keeps memory bounded
+        result = Script.precomputed.pop(key, None)
+        if result is not None:
+            return result
+        if self.active_cache is None:
+            with model_lock:
+                return interrogate_fn()
+        result = self.active_cache.get(key)
+        if result is None:
+            with model_lock:
+                result = interrogate_fn()
+            self.active_cache.put(key, result)
+        return result
+
+    # Thread pool of the concurrent interrogation mode, recreated when the worker count changes
+    def get_interrogation_pool(self, workers):
+        workers = max(1, int(workers))
+        if Script.interrogation_pool is not None and Script.interrogation_pool[0] != workers:
+            Script.interrogation_pool[1].shutdown(wait=True)
+            Script.interrogation_pool = None
+        if Script.interrogation_pool is None:
+            Script.interrogation_pool = (workers, concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tag-batch-interrogator"))
+        return Script.interrogation_pool[1]
+
+    # Concurrent mode: Deepbooru (Native) and WD (EXT) units go to the worker pool, CLIP units run on the main thread meanwhile.
+    # Returns a future per (model, variant), process_batch collects them in the selected order so the prompt stays the same
+    def start_concurrent_interrogation(self, units, digest, image, workers, unload_clip_models_afterwords, unload_wd_models_afterwords):
+        background_units = [unit for unit in units if unit[0] in BACKGROUND_MODELS]
+        # Nothing to overlap with a single interrogation
+        if len(units) < 2 or not background_units:
+            return {}
+        pool = self.get_interrogation_pool(workers)
+        futures = {}
+        for model, variant, mode in background_units:
+            name = f"{model}:{variant}" if model == "WD (EXT)" else model
+            def interrogate(model=model, variant=variant, mode=mode, name=name):
+                with self.measure(f"concurrent {name}"):
+                    return self.cached_interrogation(digest, model, variant, mode, lambda: self.interrogate_unit(model, variant, mode, image, unload_clip_models_afterwords, unload_wd_models_afterwords))
+            futures[(model, variant)] = pool.submit(interrogate)
+        for model, variant, mode in units:
+            if model in BACKGROUND_MODELS:
+                continue
+            if state.interrupted or state.skipped:
+                break
+            name = f"{model}:{variant}" if model == "CLIP (EXT)" else model
+            # CLIP resets the state.job system during runtime...
+            job, job_no, job_count = state.job, state.job_no, state.job_count
+            with self.measure(f"concurrent {name}"):
+                result = self.cached_interrogation(digest, model, variant, mode, lambda: self.interrogate_unit(model, variant, mode, image, unload_clip_models_afterwords, unload_wd_models_afterwords))
+            state.job, state.job_no, state.job_count = job, job_no, job_count
+            futures[(model, variant)] = concurrent.futures.Future()
+            futures[(model, variant)].set_result(result)
+        return futures
+
+    # Result of a unit started by start_concurrent_interrogation, otherwise interrogates now
+    def concurrent_or_cached(self, futures, digest, model, variant, mode, interrogate_fn):
+        future = futures.pop((model, variant), None)
+        if future is not None:
+            return future.result()
+        return self.cached_interrogation(digest, model, variant, mode, interrogate_fn)
+
     # Function to clean the custom_filter
     def clean_string(self, input_string):
-        # Split the string into a list
-        items = input_string.split(',')
-        # Clean up each item: strip whitespace and convert to lowercase
-        cleaned_items = [item.strip() for item in items if item.strip()]
-        # Remove duplicates while preserving order
-        unique_items = []
-        seen = set()
-        for item in cleaned_items:
-            if item not in seen:
-                seen.add(item)
-                unique_items.append(item)
-        # Join the cleaned, unique items back into a string
-        return ', '.join(unique_items)
+        # Strips, drops empty entries and removes duplicates while preserving order
+        return clean_string(input_string)
     
     # Custom replace function to replace phrases with associated pair
     def custom_replace(self, text, replace_pairs):
-        for old, new in replace_pairs.items():
-            text = re.sub(r'\b' + re.escape(old) + r'\b', new, text)
-        return text
+        # Pairs are compiled once into a single pass engine, and only recompiled when they change
+        return Script.replace_engines.from_pairs(replace_pairs).apply(text)
 
     # Tag filtering, removes negative tags from prompt
     def filter_words(self, prompt, negative):
-        # Corrects a potential error where negative is nonetype
-        if negative is None:
-            negative = ""
-        
-        # Split prompt and negative strings into lists of words
-        prompt_words = [word.strip() for word in prompt.split(",")]
-        negative_words = [self.remove_attention(word.strip()) for word in negative.split(",")]
-        
-        # Filter out words from prompt that are in negative
-        filtered_words = [word for word in prompt_words if self.remove_attention(word) not in negative_words]
-        
-        # Join filtered words back into a string
-        filtered_prompt = ", ".join(filtered_words)
-        
-        return filtered_prompt
+        # Negative is compiled into a hash set once, and only rebuilt when its text changes
+        return Script.tag_filters.get(negative).apply(prompt)
 
     # Initial Model Options generator, only add supported interrogators, support may vary depending on client
     def get_initial_model_options(self):
@@ -151,24 +384,247 @@ class Script(scripts.ScriptBuiltinUI):
             options.insert(0, "CLIP (EXT)")
         if is_interrogator_enabled('stable-diffusion-webui-wd14-tagger'):
             options.append("WD (EXT)")
+        # Served by a separate process, see lib_tag_batch.worker
+        options.append("Interrogation Worker")
         return options
         
-    # Gets a list of WD models from WD EXT
-    def get_WD_EXT_models(self):
-        if self.wd_ext_utils is not None:
+    # Opens the persistent interrogation cache on first use, later calls apply the size limit from the UI
+    def get_interrogation_cache(self, cache_size):
+        if Script.interrogation_cache is None:
+            try:
+                Script.interrogation_cache = InterrogationCache(CACHE_PATH, cache_size)
+            except Exception as error:
+                print(f"[{NAME} ERROR]: Error opening interrogation cache: {error}")
+                return None
+        elif Script.interrogation_cache.max_size != int(cache_size * 1024 * 1024):
+            Script.interrogation_cache.resize(cache_size)
+        return Script.interrogation_cache
+
+    # Deepbooru (Native) and CLIP (Native) results depend on webui settings, so those settings are part of their cache key
+    def get_native_variant(self, model):
+        if model == "Deepbooru (Native)":
+            names = ["interrogate_deepbooru_score_threshold", "deepbooru_sort_alpha", "deepbooru_use_spaces", "deepbooru_escape", "deepbooru_filter_tags"]
+        else:
+            names = ["interrogate_clip_num_beams", "interrogate_clip_min_length", "interrogate_clip_max_length", "interrogate_clip_dict_limit", "interrogate_clip_skip_categories"]
+        return ";".join(str(getattr(shared.opts, name, "")) for name in names)
+
+    # Expands the model selection into (model, variant, mode) units, the same triples used for cache keys
+    def get_interrogation_units(self, model_selection, clip_ext_model, clip_ext_mode, wd_ext_model):
+        units = []
+        for model in model_selection:
+            if model in ("Deepbooru (Native)", "CLIP (Native)"):
+                units.append((model, self.get_native_variant(model), ""))
+            elif model == "CLIP (EXT)" and self.clip_ext is not None:
+                units.extend((model, clip_model, clip_ext_mode) for clip_model in clip_ext_model)
+            elif model == "WD (EXT)" and self.wd_ext_utils is not None:
+                units.extend((model, wd_model, self.wd_cache_mode(wd_model)) for wd_model in wd_ext_model)
+            elif model == "Interrogation Worker" and Script.worker_client is not None:
+                units.append((model, self.get_worker_variant(), ""))
+        return units
+
+    # Memory in use by interrogators, VRAM and process RAM are added up since taggers may run on either
+    def get_memory_usage_mb(self):
+        usage = psutil.Process().memory_info().rss
+        if torch.cuda.is_available():
+            usage += torch.cuda.memory_allocated()
+        return usage / (1024 * 1024)
+
+    # Creates, resizes or shuts down the model residency manager depending on the UI options
+    def get_residency(self, use_residency_manager, residency_budget):
+        if not use_residency_manager:
+            if Script.residency is not None:
+                Script.residency.unload_all()
+                Script.residency = None
+            return None
+        if Script.residency is None:
+            Script.residency = ModelResidency(residency_budget, self.get_memory_usage_mb)
+        elif Script.residency.budget_mb != residency_budget:
+            Script.residency.resize(residency_budget)
+        return Script.residency
+
+    # Load, inference and unload functions of an interrogator for the residency manager: (name, group, load_fn, inference_fn, unload_fn)
+    def get_residency_handlers(self, model, variant, mode, prepared=None):
+        if model == "Deepbooru (Native)":
+            return model, model, deepbooru.model.start, deepbooru.model.tag_multi, self.released(self.release_deepbooru)
+        elif model == "CLIP (Native)":
+            return model, model, shared.interrogator.load, self.interrogate_clip_native_resident, self.released(self.release_clip_native)
+        elif model == "CLIP (EXT)":
+            # CLIP EXT only holds one CLIP model at a time, every CLIP EXT model shares one group
+            load_fn = lambda: self.clip_ext.load(variant) if hasattr(self.clip_ext, "load") else None
+            return f"{model}:{variant}", model, load_fn, lambda image: self.clip_ext.image_to_prompt(image, mode, variant), self.released(self.clip_ext.unload)
+        interrogator = self.wd_ext_utils.interrogators[variant]
+        return f"{model}:{variant}", f"{model}:{variant}", interrogator.load, lambda image: self.interrogate_wd_ext(image, variant, False, prepared), self.released(interrogator.unload)
+
+    # True if the model residency manager loads and unloads this model, the interrogation worker and pooled WD taggers manage their own models
+    def uses_residency(self, model):
+        return Script.residency is not None and model != "Interrogation Worker" and not self.uses_wd_session_pool(model)
+
+    # Client of the interrogation worker of a batch job, the connection is reused until the address or pipeline depth change.
+    # The worker signature (its backends and their options) is read again at the start of every batch job
+    def configure_worker(self, worker_address, worker_pipeline_depth, refresh):
+        client = Script.worker_client
+        if client is None or client.address != worker_address or client.depth != int(worker_pipeline_depth):
+            if client is not None:
+                client.close()
+            client = Script.worker_client = WorkerClient(worker_address, worker_pipeline_depth)
+            refresh = True
+        if refresh:
+            try:
+                client.info()
+            except WorkerError as error:
+                print(f"[{NAME} ERROR]: {error}")
+
+    # Variant of the interrogation worker unit, results of workers with other backends or options get other cache keys
+    def get_worker_variant(self):
+        return Script.worker_client.signature or Script.worker_client.address
+
+    # Used for user visualization of the interrogation worker
+    def worker_status(self, worker_address):
+        client = WorkerClient(worker_address, timeout=10)
+        try:
+            info = client.info()
+        except (WorkerError, ValueError) as error:
+            return str(error)
+        finally:
+            client.close()
+        return f"Connected to {worker_address}: {', '.join(info['backends'])} (signature {info['signature']}), {info['requests']} request(s) served"
+
+    # Number of CLIP chunks of a prompt, as the webui tokenizes it. Extra network syntax is removed like for prompts[i]
+    def count_prompt_chunks(self, prompt):
+        from modules import sd_hijack
+        token_count, _ = sd_hijack.model_hijack.get_prompt_lengths(re.sub("[<].*[>]", "", prompt))
+        return chunk_count(token_count)
+    
+    # Drops the lowest priority tags until the assembled prompt fits token_budget_chunks chunks, returns the kept tags
+    def fit_token_budget(self, tag_list, scores, original_prompt, prompt_weight_mode, prompt_weight, in_front, token_budget_chunks, trim_priority, pinned_tags, debug_mode):
+        def fits(tags):
+            prompt = assemble_prompt(original_prompt, weight_interrogation(tags.render(), prompt_weight_mode, prompt_weight), in_front)
+            return self.count_prompt_chunks(prompt) <= token_budget_chunks
+        try:
+            pinned = Script.tag_filters.get(pinned_tags).tags
+            with self.measure("token budget"):
+                kept, dropped = BudgetTrimmer(fits).trim(tag_list, tag_priorities(tag_list, trim_priority, pinned, scores))
+        except Exception as error:
+            print(f"[{NAME} ERROR]: Unable to fit the interrogation to the token budget, keeping all tags: {error}")
+            return tag_list
+        if dropped:
+            self.debug_print(debug_mode, f"[Token Budget]: Dropped {len(dropped)} tag(s) to fit {token_budget_chunks} chunk(s): {', '.join(dropped)}")
+            if Script.metrics is not None:
+                Script.metrics.count("trimmed tags", len(dropped))
+        return kept
+    
+    # Tag ranks of the Vocabulary canonical order: the tags of the WD (EXT) models in the selected order, each followed by its ratings.
+    # Only models interrogated at least once have a vocabulary, the ranks are rebuilt when a vocabulary changes
+    def get_vocabulary_ranks(self, wd_ext_model, wd_underscore_fix):
+        store = self.get_wd_tag_store()
+        models = [wd_model for wd_model in (wd_ext_model or []) if wd_model in store.models]
+        key = (tuple(models), wd_underscore_fix, tuple(id(store.models[wd_model]) for wd_model in models))
+        if Script.vocabulary_ranks[0] != key:
+            vocabularies = []
+            for wd_model in models:
+                vocabulary = store.models[wd_model]
+                names = vocabulary["spaced_names"] if wd_underscore_fix else vocabulary["tag_names"]
+                vocabularies.append([remove_attention(name) for name in names.tolist()] + vocabulary["ratings"])
+            Script.vocabulary_ranks = (key, vocabulary_ranks(vocabularies))
+        return Script.vocabulary_ranks[1]
+    
+    # Applies the CPU session pool settings of a batch job, pools built with other settings are closed
+    def configure_wd_session_pools(self, use_wd_session_pool, wd_pool_sessions, wd_pool_threads, wd_pool_batch_size):
+        options = (int(wd_pool_sessions), int(wd_pool_threads), int(wd_pool_batch_size)) if use_wd_session_pool else None
+        with Script.wd_session_pools_lock:
+            Script.wd_pool_options = options
+            for wd_model, (pool_options, pool, _) in list(Script.wd_session_pools.items()):
+                if pool_options != options:
+                    if pool is not None:
+                        pool.close()
+                    del Script.wd_session_pools[wd_model]
+
+    # CPU session pool of a WD tagger as (pool, tag categories), (None, None) when the pool is disabled or the tagger is not an ONNX WD tagger
+    def get_wd_session_pool(self, wd_model):
+        with Script.wd_session_pools_lock:
+            if Script.wd_pool_options is None:
+                return None, None
+            entry = Script.wd_session_pools.get(wd_model)
+            if entry is not None:
+                return entry[1], entry[2]
+            interrogator = self.wd_ext_utils.interrogators[wd_model]
+            pool, categories = None, None
+            if type(interrogator).__name__ == "WaifuDiffusionInterrogator" and hasattr(interrogator, "download"):
+                try:
+                    from tagger import dbimutils
+                    model_path, tags_path = interrogator.download()
+                    sessions, threads, batch_size = Script.wd_pool_options
+                    pool = WDSessionPool(str(model_path), str(tags_path), sessions, threads, batch_size, lambda image, height: wd_preprocess(image, height, dbimutils))
+                    categories = [WD_CATEGORIES.get(category, "general") for category in pool.categories[4:]]
+                    print(f"[{NAME}]: CPU session pool for {wd_model}: {sessions} session(s) x {threads} thread(s){', pinned to their own cores' if pool.pinned else ''}")
+                except Exception as error:
+                    print(f"[{NAME} ERROR]: Could not create the CPU session pool for {wd_model}, using the tagger as it is: {error}")
+            else:
+                print(f"[{NAME}]: {wd_model} is not an ONNX WD tagger, it does not use the CPU session pool")
+            # A tagger without a pool is remembered too, so the pool is not retried for every image
+            Script.wd_session_pools[wd_model] = (Script.wd_pool_options, pool, categories)
+            return pool, categories
+
+    # True if this unit runs on a CPU session pool, the pool keeps its own sessions outside of the residency manager
+    def uses_wd_session_pool(self, model):
+        return model == "WD (EXT)" and Script.wd_pool_options is not None
+
+    # Used for user visualization of the CPU session pools, one line per running pool
+    def wd_session_pool_stats(self):
+        with Script.wd_session_pools_lock:
+            pools = [(wd_model, pool) for wd_model, (_, pool, _) in Script.wd_session_pools.items() if pool is not None]
+        if not pools:
+            return "No CPU session pool is running."
+        return "\n".join(f"{wd_model}: {pool.summary()}" for wd_model, pool in pools)
+
+    # Loads the WD confidence vocabularies on first use
+    def get_wd_tag_store(self):
+        if Script.wd_tag_store is None:
+            Script.wd_tag_store = TagConfidenceStore(WD_VOCABULARY_PATH, self.replace_underscores)
+        return Script.wd_tag_store
+
+    # Cache mode of a WD model, the same for the whole batch job even if its vocabulary is only learned by its first interrogation
+    def wd_cache_mode(self, wd_model):
+        if wd_model not in Script.wd_cache_modes:
+            Script.wd_cache_modes[wd_model] = self.get_wd_tag_store().cache_mode(wd_model)
+        return Script.wd_cache_modes[wd_model]
+
+    # Registers the vocabularies of WD models that were never interrogated from their selected_tags.csv, at the start of a batch job
+    # before any cache key is made. Taggers that are not ONNX WD taggers are learned by their first interrogation
+    def register_wd_vocabularies(self, wd_ext_model, debug_mode):
+        Script.wd_cache_modes = {}
+        store = self.get_wd_tag_store()
+        for wd_model in wd_ext_model:
+            interrogator = self.wd_ext_utils.interrogators.get(wd_model)
+            if wd_model in store.models or type(interrogator).__name__ != "WaifuDiffusionInterrogator" or not hasattr(interrogator, "download"):
+                continue
+            try:
+                with self.measure(f"register vocabulary {wd_model}"):
+                    _, tags_path = interrogator.download()
+                    store.register(wd_model, *selected_tags_vocabulary(str(tags_path)))
+                self.debug_print(debug_mode, f"[WD Vocabulary]: Registered {len(store.models[wd_model]['tags'])} tags of {wd_model}")
+            except Exception as error:
+                print(f"[{NAME} ERROR]: Could not read the tags of {wd_model}, its vocabulary is learned by its first interrogation: {error}")
+
+    # Gets a list of WD models from WD EXT, the tagger only rescans its model folders on the first call or with refresh
+    def get_WD_EXT_models(self, refresh=False):
+        if self.load_wd_ext_module() is not None:
+            if Script.wd_ext_models and not refresh:
+                return Script.wd_ext_models
             try:
                 self.wd_ext_utils.refresh_interrogators()
                 models = list(self.wd_ext_utils.interrogators.keys())
                 if not models:
-                    raise Exception("[{NAME} DEBUG]: No WD Tagger models found.")
+                    raise Exception(f"[{NAME} DEBUG]: No WD Tagger models found.")
+                Script.wd_ext_models = models
                 return models
-            except Exception as errorrror:
+            except Exception as error:
                 print(f"[{NAME} ERROR]: Error accessing WD Tagger: {error}")
         return []
     
     # Function to load CLIP models list into CLIP model selector
     def load_clip_models(self):
-        if self.clip_ext is not None:
+        if self.load_clip_ext_module() is not None:
             models = self.clip_ext.get_models()
             return gr.Dropdown.update(choices=models if models else None)
         return gr.Dropdown.update(choices=None)
@@ -207,6 +663,14 @@ class Script(scripts.ScriptBuiltinUI):
                 self.save_custom_replace("", "")
             return "", ""
     
+    # Refresh the rules pack dropdown, packs added to the rules folder show up without a restart
+    def refresh_rules_packs(self):
+        return gr.Dropdown.update(choices=Script.rules_packs.names())
+    
+    # Used for user visualization of the selected rules packs
+    def rules_pack_stats(self, rules_packs):
+        return Script.rules_packs.summary(rules_packs or [])
+    
     # Function used to prep find and replace environment with previously saved configuration
     def load_custom_replace_on_start(self):
         old, new = self.load_custom_replace()
@@ -214,85 +678,373 @@ class Script(scripts.ScriptBuiltinUI):
         
     # Function to load WD models list into WD model selector
     def load_wd_models(self):
-        if self.wd_ext_utils is not None:
+        if self.load_wd_ext_module() is not None:
             models = self.get_WD_EXT_models()
             return gr.Dropdown.update(choices=models if models else None)
         return gr.Dropdown.update(choices=None)
     
     # Parse two strings to display pairs
     def parse_replace_pairs(self, custom_replace_find, custom_replace_replacements):
-        old_list = [phrase.strip() for phrase in custom_replace_find.split(',')]
-        new_list = [phrase.strip() for phrase in custom_replace_replacements.split(',')]
-        
-        # Ensure both lists have the same length
-        min_length = min(len(old_list), len(new_list))
-        return {old_list[i]: new_list[i] for i in range(min_length)}
+        return parse_replace_pairs(custom_replace_find, custom_replace_replacements)
     
+    # Empties the interrogation cache, both on disk and its hit/miss counters
+    def purge_interrogation_cache(self):
+        if Script.interrogation_cache is None:
+            try:
+                Script.interrogation_cache = InterrogationCache(CACHE_PATH)
+            except Exception as error:
+                print(f"[{NAME} ERROR]: Error opening interrogation cache: {error}")
+                return ""
+        Script.interrogation_cache.purge()
+        print(f"[{NAME}]: Interrogation cache purged.")
+        return self.interrogation_cache_stats()
+
+    # Used for user visualization of the interrogation cache
+    def interrogation_cache_stats(self):
+        if Script.interrogation_cache is None:
+            return "Interrogation cache has not been opened yet."
+        return Script.interrogation_cache.stats()
+
+    # Runs CLIP (Native) without letting it unload itself afterwards, the residency manager unloads it
+    def interrogate_clip_native_resident(self, image):
+        keep_models_in_memory = shared.opts.interrogate_keep_models_in_memory
+        shared.opts.interrogate_keep_models_in_memory = True
+        try:
+            return shared.interrogator.interrogate(image)
+        finally:
+            shared.opts.interrogate_keep_models_in_memory = keep_models_in_memory
+
+    # Runs CLIP EXT on a single image, returns the prompt text
+    def interrogate_clip_ext(self, image, clip_ext_mode, clip_model, unload_clip_models_afterwords):
+        result = self.clip_ext.image_to_prompt(image, clip_ext_mode, clip_model)
+        if unload_clip_models_afterwords:
+            with self.measure("unload CLIP (EXT)"):
+                self.clip_ext.unload()
+        return result
+
+    # Runs a WD EXT tagger on a single image, returns the raw rating and tag confidences as a compact vector
+    def interrogate_wd_ext(self, image, wd_model, unload_wd_models_afterwords, prepared=None):
+        interrogator = self.wd_ext_utils.interrogators[wd_model]
+        pool, categories = self.get_wd_session_pool(wd_model)
+        if pool is not None:
+            # The pool keeps its sessions loaded, Unload Tagger After Use does not apply to it
+            if prepared is not None:
+                from tagger import dbimutils
+                rating, tags = pool.interrogate(array=prepared.wd_input(pool.height, dbimutils))
+            else:
+                rating, tags = pool.interrogate(image=image)
+            return self.get_wd_tag_store().encode(wd_model, rating, tags, categories)
+        # ONNX taggers with the same input size share one preprocessed input, the result is the same as interrogator.interrogate
+        if prepared is not None and type(interrogator).__name__ == "WaifuDiffusionInterrogator":
+            if getattr(interrogator, "model", None) is None:
+                interrogator.load()
+            from tagger import dbimutils
+            rating, tags = wd_run(interrogator, prepared.wd_input(wd_input_height(interrogator), dbimutils)[None])[0]
+        else:
+            rating, tags = interrogator.interrogate(image)
+        # Tag categories are only readable while the tagger is loaded
+        store = self.get_wd_tag_store()
+        categories = store.read_categories(interrogator, tags)
+        if unload_wd_models_afterwords:
+            with self.measure(f"unload WD (EXT):{wd_model}"):
+                interrogator.unload()
+        return store.encode(wd_model, rating, tags, categories)
+
+    # Runs a WD EXT tagger on several images, ONNX WD taggers get a single batched forward pass
+    def interrogate_wd_ext_batch(self, images, wd_model, unload_wd_models_afterwords):
+        interrogator = self.wd_ext_utils.interrogators[wd_model]
+        # The CPU session pool spreads the images over its sessions, each running micro-batches
+        pool, categories = self.get_wd_session_pool(wd_model)
+        if pool is not None:
+            store = self.get_wd_tag_store()
+            return [store.encode(wd_model, rating, tags, categories) for rating, tags in pool.interrogate_many(images)]
+        if len(images) > 1 and type(interrogator).__name__ == "WaifuDiffusionInterrogator":
+            try:
+                if getattr(interrogator, "model", None) is None:
+                    interrogator.load()
+                from tagger import dbimutils
+                results = wd_batch_interrogate(interrogator, images, dbimutils)
+                store = self.get_wd_tag_store()
+                categories = store.read_categories(interrogator, results[0][1])
+                if unload_wd_models_afterwords:
+                    interrogator.unload()
+                return [store.encode(wd_model, rating, tags, categories) for rating, tags in results]
+            except Exception as error:
+                print(f"[{NAME} ERROR]: Batched WD interrogation failed, falling back to one image at a time: {error}")
+        return [self.interrogate_wd_ext(image, wd_model, unload_wd_models_afterwords) for image in images]
+
+    # Interrogates every WD (EXT) unit once for all distinct images of a multi-image batch, ONNX WD taggers in a single forward pass,
+    # and sends all images to the interrogation worker in one pipelined exchange. Returns {(model, variant): [result per image]}, process_batch hands the results to the interrogation loop of each image
+    def interrogate_batch_images(self, prepared_images, digests, units, unload_wd_models_afterwords, debug_mode):
+        batched = {}
+        for model, variant, mode in units:
+            if model not in ("WD (EXT)", "Interrogation Worker") or state.interrupted:
+                continue
+            keys = [cache_key(digest, model, variant, mode) for digest in digests]
+            # Pre-interrogated and cached results are used as they are, only the other images go into the batch
+            results = [Script.precomputed.pop(key, None) for key in keys]
+            if self.active_cache is not None:
+                results = [result if result is not None else self.active_cache.get(key) for key, result in zip(keys, results)]
+            pending = [index for index, result in enumerate(results) if result is None]
+            if pending:
+                started = time.perf_counter()
+                images = [prepared_images[index].for_model(model) for index in pending]
+                with self.get_model_lock(model, variant):
+                    if model == "Interrogation Worker":
+                        pending_results = Script.worker_client.interrogate_many(images)
+                    elif self.uses_residency(model):
+                        name, group, load_fn, inference_fn, unload_fn = self.get_residency_handlers(model, variant, mode)
+                        pending_results = Script.residency.run(name, group, load_fn, lambda: self.interrogate_wd_ext_batch(images, variant, False), unload_fn)
+                    else:
+                        pending_results = self.interrogate_wd_ext_batch(images, variant, unload_wd_models_afterwords)
+                for index, result in zip(pending, pending_results):
+                    results[index] = result
+                    if self.active_cache is not None:
+                        self.active_cache.put(keys[index], result)
+                if Script.metrics is not None:
+                    Script.metrics.add_time(f"batched {model}:{variant}", time.perf_counter() - started)
+                self.debug_print(debug_mode, f"[Batched Interrogation]: [{model} ({variant})]: {len(pending)} image(s) in {time.perf_counter() - started:.2f}s")
+            batched[(model, variant)] = results
+        return batched
+
+    # Pre-interrogation pass, runs every selected interrogator over a whole directory, one model at a time
+    def pre_interrogate_directory(self, directory, batch_size, units, unload_clip_models_afterwords, unload_wd_models_afterwords, skip_captioned, debug_mode):
+        paths = list_images(directory)
+        # Images with a sidecar caption are not interrogated
+        if skip_captioned:
+            paths = [path for path in paths if find_sidecar(path) is None]
+        if not paths:
+            print(f"[{NAME} ERROR]: Pre-interrogation found no images in `{directory}`.")
+            return
+        print(f"[{NAME}]: Pre-interrogating {len(paths)} image(s) with {len(units)} interrogator(s)...")
+        digests = {}
+        for model, variant, mode in units:
+            if state.interrupted:
+                break
+            # Interrogators reset the state.job system during runtime...
+            job = state.job
+            job_no = state.job_no
+            job_count = state.job_count
+            started = time.time()
+            interrogated = 0
+            # Each model is loaded once for the whole directory
+            if self.uses_residency(model):
+                name, group, load_fn, inference_fn, unload_fn = self.get_residency_handlers(model, variant, mode)
+                if model == "WD (EXT)":
+                    batch_fn = lambda batch: self.interrogate_wd_ext_batch(batch, variant, False)
+                else:
+                    batch_fn = lambda batch: [inference_fn(image) for image in batch]
+                interrogate_batch = lambda batch: Script.residency.run(name, group, load_fn, lambda: batch_fn(batch), unload_fn)
+            elif model == "Deepbooru (Native)":
+                deepbooru.model.start()
+                interrogate_batch = lambda batch: [deepbooru.model.tag_multi(image) for image in batch]
+            elif model == "CLIP (Native)":
+                keep_models_in_memory = shared.opts.interrogate_keep_models_in_memory
+                shared.opts.interrogate_keep_models_in_memory = True
+                interrogate_batch = lambda batch: [shared.interrogator.interrogate(image) for image in batch]
+            elif model == "CLIP (EXT)":
+                interrogate_batch = lambda batch: [self.interrogate_clip_ext(image, mode, variant, False) for image in batch]
+            elif model == "Interrogation Worker":
+                # The whole chunk is pipelined to the worker over one connection
+                interrogate_batch = lambda batch: Script.worker_client.interrogate_many(batch)
+            else:
+                interrogate_batch = lambda batch: self.interrogate_wd_ext_batch(batch, variant, False)
+            try:
+                for chunk in chunked(paths, batch_size):
+                    if state.interrupted:
+                        break
+                    batch = []
+                    keys = []
+                    for path in chunk:
+                        key = cache_key(digests[path], model, variant, mode) if path in digests else None
+                        if key is not None and self.is_precomputed(key):
+                            continue
+                        try:
+                            image = self.read_pre_interrogation_image(path)
+                        except Exception as error:
+                            print(f"[{NAME} ERROR]: Pre-interrogation could not read `{path}`: {error}")
+                            continue
+                        if path not in digests:
+                            digests[path] = image_digest(image)
+                            if Script.source_paths is not None:
+                                Script.source_paths.remember(digests[path], path)
+                            key = cache_key(digests[path], model, variant, mode)
+                            if self.is_precomputed(key):
+                                continue
+                        batch.append(image)
+                        keys.append(key)
+                    if batch:
+                        for key, result in zip(keys, interrogate_batch(batch)):
+                            self.store_precomputed(key, result)
+                        interrogated += len(batch)
+            finally:
+                if Script.residency is not None or self.uses_wd_session_pool(model):
+                    pass
+                elif model == "Deepbooru (Native)":
+                    deepbooru.model.stop()
+                elif model == "CLIP (Native)":
+                    shared.opts.interrogate_keep_models_in_memory = keep_models_in_memory
+                    shared.interrogator.unload()
+                elif model == "CLIP (EXT)" and unload_clip_models_afterwords:
+                    self.clip_ext.unload()
+                elif model == "WD (EXT)" and unload_wd_models_afterwords:
+                    self.wd_ext_utils.interrogators[variant].unload()
+                state.job = job
+                state.job_no = job_no
+                state.job_count = job_count
+            self.debug_print(debug_mode, f"[Pre-Interrogation]: [{model} ({variant}:{mode})]: {interrogated} image(s) interrogated in {time.time() - started:.2f}s")
+        print(f"[{NAME}]: Pre-interrogation finished.")
+
+    # Runs a single (model, variant, mode) unit on an image, returns the value stored for its cache key
+    def interrogate_unit(self, model, variant, mode, image, unload_clip_models_afterwords, unload_wd_models_afterwords):
+        # process_batch hands over a PreparedImage, pre-interrogation and lookahead plain images
+        prepared = image if isinstance(image, PreparedImage) else None
+        if prepared is not None:
+            image = prepared.for_model(model)
+        # The residency manager decides when models are unloaded, the Unload After Use options do not apply
+        if self.uses_residency(model):
+            name, group, load_fn, inference_fn, unload_fn = self.get_residency_handlers(model, variant, mode, prepared)
+            return Script.residency.run(name, group, load_fn, lambda: inference_fn(image), unload_fn)
+        if model == "Deepbooru (Native)":
+            return deepbooru.model.tag(image)
+        elif model == "CLIP (Native)":
+            return shared.interrogator.interrogate(image)
+        elif model == "CLIP (EXT)":
+            return self.interrogate_clip_ext(image, mode, variant, unload_clip_models_afterwords)
+        elif model == "Interrogation Worker":
+            return Script.worker_client.interrogate(image)
+        return self.interrogate_wd_ext(image, variant, unload_wd_models_afterwords, prepared)
+
+    # Lookahead worker job, interrogates one upcoming batch image
+    def prefetch_image(self, path, units, unload_wd_models_afterwords, debug_mode):
+        image = self.read_pre_interrogation_image(path)
+        digest = image_digest(image)
+        if Script.source_paths is not None:
+            Script.source_paths.remember(digest, path)
+        prefetcher = Script.prefetcher
+        if prefetcher is None or not prefetcher.begin(digest):
+            return
+        try:
+            started = time.time()
+            for model, variant, mode in units:
+                if state.interrupted:
+                    break
+                key = cache_key(digest, model, variant, mode)
+                if self.is_precomputed(key):
+                    continue
+                with self.get_model_lock(model, variant):
+                    result = self.interrogate_unit(model, variant, mode, image, False, unload_wd_models_afterwords)
+                self.store_precomputed(key, result)
+            self.debug_print(debug_mode, f"[Lookahead]: Prefetched {path} in {time.time() - started:.2f}s")
+        finally:
+            prefetcher.finish(digest)
+
+    # Starts the lookahead worker for the batch input directory
+    def start_lookahead(self, directory, depth, units, unload_wd_models_afterwords, skip_captioned, debug_mode):
+        units = [unit for unit in units if unit[0] in BACKGROUND_MODELS]
+        paths = list_images(directory)
+        # Images with a sidecar caption are not interrogated
+        if skip_captioned:
+            paths = [path for path in paths if find_sidecar(path) is None]
+        if not units or not paths:
+            print(f"[{NAME}]: Lookahead interrogation has nothing to do, it only runs Deepbooru (Native) and WD (EXT) on images of `{directory}`.")
+            return
+        prefetcher = LookaheadPrefetcher(
+            paths, depth,
+            lambda path: self.prefetch_image(path, units, unload_wd_models_afterwords, debug_mode),
+            lambda: state.interrupted,
+            Script.lookahead_cancelled.set
+        )
+        with Script.lookahead_lock:
+            Script.lookahead_cancelled.clear()
+            Script.prefetcher = prefetcher
+        prefetcher.start()
+        self.debug_print(debug_mode, f"[Lookahead]: Started for {len(paths)} image(s) with depth {depth}")
+
+    # Stops the lookahead worker, any lookahead result that was not used yet is discarded. Main thread only, the worker
+    # signals a cancelled job through lookahead_cancelled instead
+    def stop_lookahead(self, debug_mode):
+        with Script.lookahead_lock:
+            prefetcher = Script.prefetcher
+            Script.prefetcher = None
+            Script.lookahead_cancelled.clear()
+        if prefetcher is None:
+            return
+        prefetcher.stop(timeout=60)
+        self.debug_print(debug_mode, f"[Lookahead]: Stopped after prefetching {prefetcher.prefetched} image(s), discarding {len(Script.precomputed)} unused result(s)")
+        Script.precomputed = {}
+
+    # True if a result for this key is waiting in memory or in the interrogation cache
+    def is_precomputed(self, key):
+        return key in Script.precomputed or (self.active_cache is not None and self.active_cache.contains(key))
+
+    # Keeps a pre-interrogation result, on disk when the interrogation cache is enabled, otherwise in memory
+    def store_precomputed(self, key, result):
+        if self.active_cache is not None:
+            self.active_cache.put(key, result)
+        else:
+            Script.precomputed[key] = result
+
+    # Opens an image the same way the img2img batch tab does, so its content hash matches the PreparedImage of p.init_images[0].
+    # With reduced decoding this is the reduced copy, the interrogators and the content hash only see that copy
+    def read_pre_interrogation_image(self, path):
+        with Image.open(path) as image:
+            image = ImageOps.exif_transpose(image)
+        if Script.reduced_decoding:
+            return reduce_decoded(image, DECODE_SIDE)
+        return image.convert("RGB")
+
+    # Unload function for the residency manager, the budget counts RAM + VRAM so a model only counts as unloaded once
+    # its last reference is gone and the memory is collected
+    def released(self, unload_fn):
+        def release():
+            unload_fn()
+            gc.collect()
+            devices.torch_gc()
+        return release
+
+    # Drops CLIP (Native) regardless of the webui keep models in memory setting, moving it to RAM would keep it in the budget.
+    # shared.interrogator.load() loads the models again from disk when they are None
+    def release_clip_native(self):
+        shared.interrogator.clip_model = None
+        shared.interrogator.clip_preprocess = None
+        shared.interrogator.blip_model = None
+
+    # Drops Deepbooru (Native), deepbooru.model.start() loads it again from disk when it is None
+    def release_deepbooru(self):
+        deepbooru.model.model = None
+
+    # Used for user visualization of the model residency manager
+    def residency_stats(self):
+        if Script.residency is None:
+            return "Model residency manager is not enabled."
+        return Script.residency.summary()
+
     # Refresh the model_selection dropdown
     def refresh_model_options(self):
+        # The refresh button rescans extensions and tagger models, even if their modification times did not change
+        extension_discovery.invalidate()
+        Script.wd_ext_models = None
+        # Extensions that were not found are looked up again on their next use
+        Script.clip_ext_loader.retry()
+        Script.wd_ext_loader.retry()
         new_options = self.get_initial_model_options()
         return gr.Dropdown.update(choices=new_options)
     
     # Required to parse information from a string that is between () or has :##.## suffix
     def remove_attention(self, words):
-        # Define a regular expression pattern to match attention-related suffixes
-        pattern = r":\d+(\.\d+)?"
-        # Remove attention-related suffixes using regex substitution
-        words = re.sub(pattern, "", words)
-        
-        # Replace escaped left parenthesis with temporary placeholder
-        words = re.sub(r"\\\(", r"TEMP_LEFT_PLACEHOLDER", words)
-        # Replace escaped right parenthesis with temporary placeholder
-        words = re.sub(r"\\\)", r"TEMP_RIGHT_PLACEHOLDER", words)
-        # Define a regular expression pattern to match parentheses and their content
-        pattern = r"(\(|\))"
-        # Remove parentheses using regex substitution
-        words = re.sub(pattern, "", words)
-        # Restore escaped left parenthesis
-        words = re.sub(r"TEMP_LEFT_PLACEHOLDER", r"\\(", words)
-        # Restore escaped right parenthesis
-        words = re.sub(r"TEMP_RIGHT_PLACEHOLDER", r"\\)", words)
-        
-        return words.strip()
+        # Precompiled and memoized, tags repeat across a batch
+        return remove_attention(words)
     
     # Experimental Tool, removes puncutation, but tries to keep a variety of known emojis
     def remove_punctuation(self, text):
-        # List of text emojis to preserve
-        skipables = ["'s", "...", ":-)", ":)", ":-]", ":]", ":->", ":>", "8-)", "8)", ":-}", ":}", ":^)", "=]", "=)", ":-D", ":D", "8-D", "8D", "=D", "=3", "B^D", 
-            "c:", "C:", "x-D", "X-D", ":-))", ":))", ":-(", ":(", ":-c", ":c", ":-<", ":<", ":-[", ":[", ":-||", ":{", ":@", ":(", ";(", ":'-(", ":'(", ":=(", ":'-)", 
-            ":')", ">:(", ">:[", "D-':", "D:<", "D:", "D;", "D=", ":-O", ":O", ":-o", ":o", ":-0", ":0", "8-0", ">:O", "=O", "=o", "=0", ":-3", ":3", "=3", ">:3", 
-            ":-*", ":*", ":x", ";-)", ";)", "*-)", "*)", ";-]", ";]", ";^)", ";>", ":-,", ";D", ";3", ":-P", ":P", "X-P", "x-p", ":-p", ":p", ":-Þ", ":Þ", ":-þ", 
-            ":þ", ":-b", ":b", "d:", "=p", ">:P", ":-/", ":/", ":-.", ">:/", "=/", ":L", "=L", ":S", ":-|", ":|", ":$", "://)", "://3", ":-X", ":X", ":-#", ":#", 
-            ":-&", ":&", "O:-)", "O:)", "0:-3", "0:3", "0:-)", "0:)", "0;^)", ">:-)", ">:)", "}:-)", "}:)", "3:-)", "3:)", ">;-)", ">;)", ">:3", ">;3", "|;-)", "|-O", 
-            "B-)", ":-J", "#-)", "%-)", "%)", ":-###..", ":###..", "<:-|", "',:-|", "',:-l", ":E", "8-X", "8=X", "x-3", "x=3", "~:>", "@};-", "@}->--", "@}-;-'---", 
-            "@>-->--", "8====D", "8===D", "8=D", "3=D", "8=>", "8===D~~~", "*<|:-)", "</3", "<\3", "<3", "><>", "<><", "<*)))-{", "><(((*>", "\o/", "*\0/*", "o7", 
-            "v.v", "._.", "._.;", "X_X", "x_x", "+_+", "X_x", "x_X", "<_<", ">_>", "<.<", ">.>", "O_O", "o_o", "O-O", "o-o", "O_o", "o_O", ">.<", ">_<", "^5", "o/\o", 
-            ">_>^ ^<_<", "V.v.V"] # Maybe I should remove emojis with parenthesis () in them...
-        # Temporarily replace text emojis with placeholders
-        for i, noticables in enumerate(skipables):
-            text = text.replace(noticables, f"SKIP_PLACEHOLDER_{i}")
-        # Remove punctuation except commas
-        text = re.sub(r'[^\w\s,]', '', text)
-        # Split the text into tags
-        tags = [tag.strip() for tag in text.split(',')]
-        # Remove empty tags
-        tags = [tag for tag in tags if tag]
-        # Rejoin the tags
-        text = ', '.join(tags)
-        # Restore text emojis
-        for i, noticables in enumerate(skipables):
-            text = text.replace(f"SKIP_PLACEHOLDER_{i}", noticables)
-        return text
+        # Emoticons are recognized in the same scan that strips the punctuation, see lib_tag_batch.text.EMOTICONS
+        return remove_punctuation(text)
     
     # For WD Tagger, removes underscores from tags that should have spaces
     def replace_underscores(self, tag):
-        skipable = [
-            "0_0", "(o)_(o)", "+_+", "+_-", "._.", "<o>_<o>", "<|>_<|>", "=_=", ">_<", 
-            "3_3", "6_9", ">_o", "@_@", "^_^", "o_o", "u_u", "x_x", "|_|", "||_||"
-        ]
-        if tag in skipable:
-            return tag
-        return tag.replace('_', ' ')
+        # Underscore emoticons such as "o_o" are kept as they are
+        return replace_underscores(tag)
 
     # Resets the prompt_contamination string, prompt_contamination is used to clean the p.prompt after it has been modified by a previous batch job
     def reset_prompt_contamination(self, debug_mode):
@@ -304,6 +1056,14 @@ class Script(scripts.ScriptBuiltinUI):
         """
         self.debug_print(debug_mode, f"Reset was Called! The following prompt will be removed from the prompt_contamination cleaner: {self.prompt_contamination}")
         self.prompt_contamination = ""
+        self.contaminated_prompt = None
+
+    # Removes the previous image's interrogation from a prompt. A prompt that is still exactly the one assembled for the previous
+    # image gets its original text back, one that was changed since (e.g. by another script) falls back to removing the interrogation text
+    def remove_contamination(self, prompt):
+        if self.contaminated_prompt is not None and prompt == self.contaminated_prompt[0]:
+            return self.contaminated_prompt[1]
+        return prompt.replace(self.prompt_contamination, "")
     
     # Function to save custom filter from file
     def save_custom_filter(self, custom_filter):
@@ -340,6 +1100,13 @@ class Script(scripts.ScriptBuiltinUI):
             except:
                 return gr.Accordion.update(visible=False), gr.Dropdown.update()
     
+    # Shows the interrogation worker options when the worker is selected
+    def update_worker_visibility(self, model_selection):
+        try:
+            return gr.update(visible="Interrogation Worker" in model_selection)
+        except:
+            return gr.Accordion.update(visible="Interrogation Worker" in model_selection)
+    
     # Updates the visibility of group with input bool making it dynamically visible
     def update_group_visibility(self, user_defined_visibility):
         try:
@@ -398,6 +1165,8 @@ class Script(scripts.ScriptBuiltinUI):
     def unload_clip_models(self):
         if self.clip_ext is not None:
             self.clip_ext.unload()
+            if Script.residency is not None:
+                Script.residency.forget("CLIP (EXT)")
 
     #Unloads WD Models
     def unload_wd_models(self):
@@ -406,6 +1175,15 @@ class Script(scripts.ScriptBuiltinUI):
             for interrogator in self.wd_ext_utils.interrogators.values():
                 if interrogator.unload(): 
                     unloaded_models = unloaded_models + 1
+            if Script.residency is not None:
+                Script.residency.forget("WD (EXT)")
+            # Pools are recreated on their next use
+            with Script.wd_session_pools_lock:
+                for _, pool, _ in Script.wd_session_pools.values():
+                    if pool is not None:
+                        pool.close()
+                        unloaded_models = unloaded_models + 1
+                Script.wd_session_pools = {}
             print(f"Unloaded {unloaded_models} Tagger Model(s).")
     
     def ui(self, is_img2img):
@@ -434,15 +1212,35 @@ class Script(scripts.ScriptBuiltinUI):
                 unload_clip_models_afterwords = gr.Checkbox(label="Unload CLIP Interrogator After Use", value=True)
                 unload_clip_models_button = gr.Button(value="Unload All CLIP Interrogators")
                 
+            # Interrogation Worker Options
+            worker_accordion = gr.Accordion("Interrogation Worker Options:", visible=False)
+            with worker_accordion:
+                worker_address = gr.Textbox(label="Worker Address", value=DEFAULT_ADDRESS, info="[Interrogation Worker]: host:port of a worker started with `python -m lib_tag_batch.worker` from the extension directory.")
+                worker_pipeline_depth = gr.Slider(1, 64, value=8, step=1, label="Pipelined Requests", info="Images sent to the worker before waiting for the first result, used by Pre-Interrogation and multi-image batches.")
+                with gr.Row():
+                    worker_statistics = gr.Textbox(label="Interrogation Worker Status", interactive=False)
+                    refresh_worker_statistics_button = gr.Button("🔄", elem_classes="tool")
+                
             # WD EXT Options
             wd_ext_accordion = gr.Accordion("WD EXT Options:", visible=False)
             with wd_ext_accordion:
                 wd_ext_model = gr.Dropdown(choices=[], value='wd-v1-4-moat-tagger.v2', label="WD Extension Model(s):", multiselect=True)
                 wd_threshold = gr.Slider(0.0, 1.0, value=0.35, step=0.01, label="Tag Sensitivity Threshold")
+                wd_category_thresholds = gr.Textbox(label="Per-Category Sensitivity Thresholds", placeholder="Optional category:threshold pairs separated by commas, e.g. character:0.85, general:0.35")
+                wd_top_k = gr.Slider(0, 200, value=0, step=1, label="Maximum Tags per Tagger (0 = unlimited)")
                 wd_underscore_fix = gr.Checkbox(label="Remove Underscores from Tags", value=True)
                 wd_append_ratings = gr.Checkbox(label="Append Interpreted Rating(s)", value=False)
                 wd_ratings = gr.Slider(0.0, 1.0, value=0.5, step=0.01, label="Rating(s) Sensitivity Threshold", visible=False) 
                 unload_wd_models_afterwords = gr.Checkbox(label="Unload Tagger After Use", value=True)
+                use_wd_session_pool = gr.Checkbox(label="Use CPU Session Pool", value=False, info="[CPU Session Pool]: For nodes without a GPU, ONNX taggers run on several CPU sessions, each with its own threads and cores, queued images are run in micro-batches.")
+                wd_session_pool_group = gr.Group(visible=False)
+                with wd_session_pool_group:
+                    wd_pool_sessions = gr.Slider(1, 64, value=4, step=1, label="Sessions")
+                    wd_pool_threads = gr.Slider(1, 32, value=4, step=1, label="Threads per Session")
+                    wd_pool_batch_size = gr.Slider(1, 32, value=8, step=1, label="Micro-Batch Size")
+                    with gr.Row():
+                        wd_pool_statistics = gr.Textbox(label="CPU Session Pool Statistics", interactive=False, lines=4)
+                        refresh_wd_pool_statistics_button = gr.Button("🔄", elem_classes="tool")
                 unload_wd_models_button = gr.Button(value="Unload All Tagger Models")
                     
             filtering_tools = gr.Accordion("Filtering tools:")
@@ -472,16 +1270,18 @@ class Script(scripts.ScriptBuiltinUI):
                 # Find and Replace
                 use_custom_replace = gr.Checkbox(label="Find & Replace User Defined Pairs in the Interrogation")
                 custom_replace_group = gr.Group(visible=False)
+                # The saved pairs are read once for both textboxes
+                custom_replace_on_start = self.load_custom_replace_on_start()
                 with custom_replace_group:
                     with gr.Row():
                         custom_replace_find = gr.Textbox(
-                            value=self.load_custom_replace_on_start()[0],
+                            value=custom_replace_on_start[0],
                             label="Find:",
                             placeholder="Enter phrases to replace, separated by commas",
                             show_copy_button=True
                         )
                         custom_replace_replacements = gr.Textbox(
-                            value=self.load_custom_replace_on_start()[1],
+                            value=custom_replace_on_start[1],
                             label="Replace:",
                             placeholder="Enter replacement phrases, separated by commas",
                             show_copy_button=True
@@ -501,8 +1301,68 @@ class Script(scripts.ScriptBuiltinUI):
                         with gr.Row():
                             cancel_save_custom_replace_button = gr.Button(value="Cancel")
                             confirm_save_custom_replace_button = gr.Button(value="Save", variant="stop")
-                    
                 
+                # Rules Packs
+                use_rules_packs = gr.Checkbox(label="Apply Rules Packs to the Interrogation", info="[Rules Packs]: Large blocklists and tag aliases, one rule per line, from the files of the rules folder of this extension.")
+                rules_packs_group = gr.Group(visible=False)
+                with rules_packs_group:
+                    with gr.Row():
+                        rules_packs = gr.Dropdown(label="Rules Packs", choices=Script.rules_packs.names(), multiselect=True)
+                        refresh_rules_packs_button = gr.Button("🔄", elem_classes="tool")
+                    with gr.Row():
+                        rules_packs_statistics = gr.Textbox(label="Rules Pack Statistics", interactive=False, lines=2)
+                        refresh_rules_packs_statistics_button = gr.Button("🔄", elem_classes="tool")
+                
+                # Token Budget
+                use_token_budget = gr.Checkbox(label="Fit the Prompt to a Token Budget", info="[Token Budget]: Drops the lowest priority tags of the interrogation until the final prompt fits the set number of 75 token chunks.")
+                token_budget_group = gr.Group(visible=False)
+                with token_budget_group:
+                    token_budget_chunks = gr.Slider(1, 8, value=1, step=1, label="Token Budget (75 Token Chunks)")
+                    trim_priority = gr.Radio(label="Trim Priority", choices=list(TRIM_PRIORITIES), value="Confidence", info="Confidence: WD tags by tagger confidence, other tags by their position. Source Order: tags of the last selected interrogator are dropped first.")
+                    pinned_tags = gr.Textbox(label="Pinned Tags", placeholder="Comma separated tags that are never dropped")
+
+
+            performance_tools = gr.Accordion("Performance tools:", open=False)
+            with performance_tools:
+                use_interrogation_cache = gr.Checkbox(label="Enable Interrogation Cache", value=False, info="[Interrogation Cache]: Interrogations are stored on disk by image content, model and mode, and reused on later runs.")
+                interrogation_cache_size = gr.Slider(16, 4096, value=512, step=16, label="Interrogation Cache Size Limit (MB)")
+                with gr.Row():
+                    interrogation_cache_stats = gr.Textbox(label="Interrogation Cache Statistics", interactive=False)
+                    refresh_interrogation_cache_stats_button = gr.Button("🔄", elem_classes="tool")
+                purge_interrogation_cache_button = gr.Button(value="Purge Interrogation Cache", variant="stop")
+                batch_input_directory = gr.Textbox(label="Batch Input Directory", placeholder="Same directory as the img2img batch Input directory, used by Pre-Interrogation, Lookahead Interrogation and the sidecar caption options")
+                use_pre_interrogation = gr.Checkbox(label="Enable Pre-Interrogation Pass", value=False, info="[Pre-Interrogation]: When a batch job starts, every image in the directory is interrogated one model at a time, each model is loaded only once.")
+                pre_interrogation_batch_size = gr.Slider(1, 64, value=8, step=1, label="Pre-Interrogation Batch Size", visible=False)
+                use_lookahead = gr.Checkbox(label="Enable Lookahead Interrogation", value=False, info="[Lookahead Interrogation]: A background thread interrogates the next image(s) of the batch while the current image is being generated.")
+                lookahead_depth = gr.Slider(1, 8, value=2, step=1, label="Lookahead Depth", visible=False)
+                use_residency_manager = gr.Checkbox(label="Enable Model Residency Manager", value=False, info="[Model Residency]: Keeps the most recently used interrogators loaded within a memory budget, overrides the Unload After Use options.")
+                residency_group = gr.Group(visible=False)
+                with residency_group:
+                    residency_budget = gr.Slider(256, 32768, value=4096, step=256, label="Interrogator Memory Budget (MB, RAM + VRAM)")
+                    with gr.Row():
+                        residency_statistics = gr.Textbox(label="Model Residency Statistics", interactive=False, lines=4)
+                        refresh_residency_statistics_button = gr.Button("🔄", elem_classes="tool")
+                use_batch_metrics = gr.Checkbox(label="Enable Batch Metrics Export", value=False, info="[Batch Metrics]: Per-stage timings (p50/p95/max), model load/unload times and tag counts of each batch job are written to the metrics folder of this extension.")
+                batch_metrics_trace = gr.Checkbox(label="Include Per-Image Trace", value=False, visible=False)
+                use_concurrent_interrogation = gr.Checkbox(label="Enable Concurrent Interrogation", value=False, info="[Concurrent Interrogation]: Deepbooru (Native) and WD (EXT) models run on worker threads while the CLIP interrogators run, results are merged in the selected order.")
+                concurrent_workers = gr.Slider(1, 8, value=2, step=1, label="Concurrent Interrogation Workers", visible=False)
+                use_shared_preprocessing = gr.Checkbox(label="Enable Shared Downscaling", value=False, info="[Shared Downscaling]: Large images are downscaled once to the size Deepbooru and CLIP need, instead of every interrogator resizing the full resolution image.")
+                use_reduced_decoding = gr.Checkbox(label="Enable Reduced-Resolution Decoding", value=False, info="[Reduced-Resolution Decoding]: The interrogators get a small copy of the image, decoded again from its file at reduced resolution (JPEG), the full resolution image is only used for generation.")
+                use_canonical_order = gr.Checkbox(label="Enable Canonical Tag Order", value=False, info="[Canonical Tag Order]: The interrogated tags are emitted in a fixed order, the same tags give the same prompt and the webui reuses the conditioning of the previous prompt instead of encoding it again.")
+                canonical_order_group = gr.Group(visible=False)
+                with canonical_order_group:
+                    canonical_order = gr.Radio(choices=list(CANONICAL_ORDERS), value="Sorted", label="Tag Order", info="Sorted: alphabetical. Vocabulary: the order of the selected WD (EXT) models, other tags alphabetical after them.")
+                    weight_quantization = gr.Slider(0, 0.5, value=0, step=0.05, label="Weight Quantization Step", info="Attention weights of the tags are rounded to a multiple of this step, 0 keeps them as they are.")
+                use_frame_reuse = gr.Checkbox(label="Enable Near-Duplicate Frame Reuse", value=False, info="[Near-Duplicate Frames]: Frames that look almost the same as a recently interrogated frame (e.g. consecutive video frames) reuse its interrogation instead of running the interrogators.")
+                frame_reuse_group = gr.Group(visible=False)
+                with frame_reuse_group:
+                    frame_hash_method = gr.Radio(choices=list(HASH_FUNCTIONS), value="dHash", label="Frame Hash")
+                    frame_distance = gr.Slider(0, 16, value=4, step=1, label="Maximum Hash Distance (bits out of 64)")
+                    frame_window = gr.Slider(1, 64, value=8, step=1, label="Recent Frames Compared")
+                use_sidecar_captions = gr.Checkbox(label="Use Existing Sidecar Captions", value=False, info="[Sidecar Captions]: Images with a .txt or .caption file next to them use that caption instead of being interrogated, it goes through the same filters as an interrogation.")
+                export_sidecar_captions = gr.Checkbox(label="Export Interrogations to Sidecar Files", value=False, info="[Sidecar Export]: The filtered interrogation of every image is written to a .txt file, in the background.")
+                sidecar_export_directory = gr.Textbox(label="Sidecar Export Directory", placeholder="Optional, leave empty to write the .txt files next to the images", visible=False)
+
             experimental_tools = gr.Accordion("Experamental tools:", open=False)
             with experimental_tools:
                 debug_mode = gr.Checkbox(label="Enable Debug Mode", info="[Debug Mode]: DEBUG statements will be printed to console log.")
@@ -516,6 +1376,8 @@ class Script(scripts.ScriptBuiltinUI):
             # Listeners
             model_selection.change(fn=self.update_clip_ext_visibility, inputs=[model_selection], outputs=[clip_ext_accordion, clip_ext_model])
             model_selection.change(fn=self.update_wd_ext_visibility, inputs=[model_selection], outputs=[wd_ext_accordion, wd_ext_model])
+            model_selection.change(fn=self.update_worker_visibility, inputs=[model_selection], outputs=[worker_accordion])
+            refresh_worker_statistics_button.click(fn=self.worker_status, inputs=[worker_address], outputs=[worker_statistics])
             unload_clip_models_button.click(self.unload_clip_models, inputs=None, outputs=None)
             unload_wd_models_button.click(self.unload_wd_models, inputs=None, outputs=None)
             prompt_weight_mode.change(fn=self.update_slider_visibility, inputs=[prompt_weight_mode], outputs=[prompt_weight])
@@ -535,170 +1397,349 @@ class Script(scripts.ScriptBuiltinUI):
             refresh_models_button.click(fn=self.refresh_model_options, inputs=[], outputs=[model_selection])
             use_custom_filter.change(fn=self.update_group_visibility, inputs=[use_custom_filter], outputs=[custom_filter_group])
             use_custom_replace.change(fn=self.update_group_visibility, inputs=[use_custom_replace], outputs=[custom_replace_group])
-                                    
+            use_rules_packs.change(fn=self.update_group_visibility, inputs=[use_rules_packs], outputs=[rules_packs_group])
+            refresh_rules_packs_button.click(fn=self.refresh_rules_packs, inputs=[], outputs=[rules_packs])
+            refresh_rules_packs_statistics_button.click(fn=self.rules_pack_stats, inputs=[rules_packs], outputs=[rules_packs_statistics])
+            use_token_budget.change(fn=self.update_group_visibility, inputs=[use_token_budget], outputs=[token_budget_group])
+            refresh_interrogation_cache_stats_button.click(fn=self.interrogation_cache_stats, inputs=[], outputs=[interrogation_cache_stats])
+            purge_interrogation_cache_button.click(fn=self.purge_interrogation_cache, inputs=[], outputs=[interrogation_cache_stats])
+            use_pre_interrogation.change(fn=self.update_slider_visibility, inputs=[use_pre_interrogation], outputs=[pre_interrogation_batch_size])
+            use_lookahead.change(fn=self.update_slider_visibility, inputs=[use_lookahead], outputs=[lookahead_depth])
+            use_residency_manager.change(fn=self.update_group_visibility, inputs=[use_residency_manager], outputs=[residency_group])
+            refresh_residency_statistics_button.click(fn=self.residency_stats, inputs=[], outputs=[residency_statistics])
+            use_batch_metrics.change(fn=self.update_group_visibility, inputs=[use_batch_metrics], outputs=[batch_metrics_trace])
+            use_concurrent_interrogation.change(fn=self.update_slider_visibility, inputs=[use_concurrent_interrogation], outputs=[concurrent_workers])
+            use_wd_session_pool.change(fn=self.update_group_visibility, inputs=[use_wd_session_pool], outputs=[wd_session_pool_group])
+            refresh_wd_pool_statistics_button.click(fn=self.wd_session_pool_stats, inputs=[], outputs=[wd_pool_statistics])
+            use_canonical_order.change(fn=self.update_group_visibility, inputs=[use_canonical_order], outputs=[canonical_order_group])
+            use_frame_reuse.change(fn=self.update_group_visibility, inputs=[use_frame_reuse], outputs=[frame_reuse_group])
+            export_sidecar_captions.change(fn=self.update_group_visibility, inputs=[export_sidecar_captions], outputs=[sidecar_export_directory])
+
         ui = [
             tag_batch_enabled, model_selection, debug_mode, in_front, prompt_weight_mode, prompt_weight, reverse_mode, exaggeration_mode, prompt_output, use_positive_filter, use_negative_filter, 
             use_custom_filter, custom_filter, use_custom_replace, custom_replace_find, custom_replace_replacements, clip_ext_model, clip_ext_mode, wd_ext_model, wd_threshold, wd_underscore_fix, wd_append_ratings, wd_ratings, 
-            unload_clip_models_afterwords, unload_wd_models_afterwords, no_puncuation_mode
+            unload_clip_models_afterwords, unload_wd_models_afterwords, no_puncuation_mode, use_interrogation_cache, interrogation_cache_size, wd_category_thresholds, wd_top_k,
+            batch_input_directory, use_pre_interrogation, pre_interrogation_batch_size, use_lookahead, lookahead_depth, use_residency_manager, residency_budget,
+            use_batch_metrics, batch_metrics_trace, use_concurrent_interrogation, concurrent_workers, use_sidecar_captions, export_sidecar_captions, sidecar_export_directory,
+            use_shared_preprocessing, use_frame_reuse, frame_hash_method, frame_distance, frame_window,
+            use_wd_session_pool, wd_pool_sessions, wd_pool_threads, wd_pool_batch_size, use_reduced_decoding, use_rules_packs, rules_packs,
+            worker_address, worker_pipeline_depth, use_token_budget, token_budget_chunks, trim_priority, pinned_tags,
+            use_canonical_order, canonical_order, weight_quantization
             ]
         return ui
 
+    # An interruption during generation ends the img2img batch before the next process_batch, the cache hits of the job are written here
+    def postprocess(self, p, processed, *args):
+        if state.interrupted:
+            self.flush_interrogation_cache()
+
     def process_batch(
         self, p, tag_batch_enabled, model_selection, debug_mode, in_front, prompt_weight_mode, prompt_weight, reverse_mode, exaggeration_mode, prompt_output, use_positive_filter, use_negative_filter, 
         use_custom_filter, custom_filter, use_custom_replace, custom_replace_find, custom_replace_replacements, clip_ext_model, clip_ext_mode, wd_ext_model, wd_threshold, wd_underscore_fix, wd_append_ratings, wd_ratings, 
-        unload_clip_models_afterwords, unload_wd_models_afterwords, no_puncuation_mode, batch_number, prompts, seeds, subseeds):
+        unload_clip_models_afterwords, unload_wd_models_afterwords, no_puncuation_mode, use_interrogation_cache, interrogation_cache_size, wd_category_thresholds, wd_top_k,
+        batch_input_directory, use_pre_interrogation, pre_interrogation_batch_size, use_lookahead, lookahead_depth, use_residency_manager, residency_budget,
+        use_batch_metrics, batch_metrics_trace, use_concurrent_interrogation, concurrent_workers, use_sidecar_captions, export_sidecar_captions, sidecar_export_directory,
+        use_shared_preprocessing, use_frame_reuse, frame_hash_method, frame_distance, frame_window,
+        use_wd_session_pool, wd_pool_sessions, wd_pool_threads, wd_pool_batch_size, use_reduced_decoding, use_rules_packs, rules_packs,
+        worker_address, worker_pipeline_depth, use_token_budget, token_budget_chunks, trim_priority, pinned_tags,
+        use_canonical_order, canonical_order, weight_quantization, batch_number, prompts, seeds, subseeds):
             
         if not tag_batch_enabled:
             return
         
         self.debug_print(debug_mode, f"process_batch called. batch_number={batch_number}, state.job_no={state.job_no}, state.job_count={state.job_count}, state.job_count={state.job}")
         if model_selection and not batch_number:
+            # CLIP EXT and WD EXT are imported the first time a batch uses them
+            if "CLIP (EXT)" in model_selection:
+                self.load_clip_ext_module()
+            if "WD (EXT)" in model_selection:
+                self.load_wd_ext_module()
+            if "Interrogation Worker" in model_selection:
+                self.configure_worker(worker_address, worker_pipeline_depth, state.job_no <= 0)
             # Calls reset_prompt_contamination to prep for multiple p.prompts
             if state.job_no <= 0:
                 self.debug_print(debug_mode, f"Condition met for reset, calling reset_prompt_contamination")
                 self.reset_prompt_contamination(debug_mode)
+                self.stop_lookahead(debug_mode)
+                Script.precomputed = {}
+            # The lookahead worker was cancelled by an interrupted job, its results will never be used
+            if Script.lookahead_cancelled.is_set():
+                self.stop_lookahead(debug_mode)
+                self.flush_interrogation_cache()
+            self.active_cache = self.get_interrogation_cache(interrogation_cache_size) if use_interrogation_cache else None
+            self.get_residency(use_residency_manager, residency_budget)
+            Script.reduced_decoding = use_reduced_decoding
+            self.configure_wd_session_pools(use_wd_session_pool and "WD (EXT)" in model_selection, wd_pool_sessions, wd_pool_threads, wd_pool_batch_size)
+            # Batch metrics cover one batch job, the previous job's metrics are written when the next one starts at the latest
+            if state.job_no <= 0:
+                self.start_metrics(use_batch_metrics, batch_metrics_trace, debug_mode)
+                self.start_frame_reuse(use_frame_reuse, frame_window, frame_distance)
+                self.start_source_paths(use_sidecar_captions or export_sidecar_captions, batch_input_directory)
+                Script.prompt_repeats = PromptRepeats()
+                # Before pre-interrogation and lookahead make their cache keys
+                if "WD (EXT)" in model_selection and self.wd_ext_utils is not None:
+                    self.register_wd_vocabularies(wd_ext_model, debug_mode)
+            if (use_pre_interrogation or use_lookahead) and state.job_no <= 0:
+                if not batch_input_directory:
+                    print(f"[{NAME} ERROR]: Pre-interrogation and lookahead interrogation need the batch input directory.")
+                else:
+                    units = self.get_interrogation_units(model_selection, clip_ext_model, clip_ext_mode, wd_ext_model)
+                    # Batched pre-interrogation of the whole input directory, once at the start of the batch job
+                    if use_pre_interrogation:
+                        self.pre_interrogate_directory(batch_input_directory, pre_interrogation_batch_size, units, unload_clip_models_afterwords, unload_wd_models_afterwords, use_sidecar_captions, debug_mode)
+                    # Lookahead interrogation of the next images, overlapping with generation of the current one
+                    if use_lookahead:
+                        self.start_lookahead(batch_input_directory, lookahead_depth, units, unload_wd_models_afterwords, use_sidecar_captions, debug_mode)
             #self.debug_print(debug_mode, f"prompt_contamination: {self.prompt_contamination}")
             # Experimental reverse mode cleaner
             if not reverse_mode:
-                # Remove contamination from previous batch job from negative prompt
-                p.prompt = p.prompt.replace(self.prompt_contamination, "")
+                # Remove contamination from previous batch job from prompt
+                p.prompt = self.remove_contamination(p.prompt)
             else:
                 # Remove contamination from previous batch job from negative prompt
-                p.negative_prompt = p.prompt.replace(self.prompt_contamination, "")
+                p.negative_prompt = self.remove_contamination(p.negative_prompt)
             
             # local variable preperations
             self.debug_print(debug_mode, f"Initial p.prompt: {p.prompt}")
-            preliminary_interrogation = ""
-            interrogation = ""
             
-            # fix alpha channel
-            init_image = p.init_images[0]
-            p.init_images[0] = p.init_images[0].convert("RGB")
+            # Every distinct init image of the batch gets its own interrogation. A1111 fills a batch from a single image by
+            # repeating the same image object, image_slots maps every entry of p.init_images to its distinct image
+            first_images, image_slots = distinct_items(p.init_images, key=id)
+            batch_images = [p.init_images[index] for index in first_images]
+            # Model inputs are produced once per image and shared by the interrogators, the RGB conversion fixes the alpha channel
+            prepared_images = [PreparedImage(image, use_shared_preprocessing, Script.metrics.add_time if Script.metrics is not None else None, use_reduced_decoding) for image in batch_images]
+
+            # Per-category WD thresholds, parsed once per image instead of once per model
+            category_thresholds = parse_category_thresholds(wd_category_thresholds)
+
+            # Read once, an interruption may stop the lookahead worker while this batch runs
+            prefetcher = Script.prefetcher
+            # Content hash for the interrogation cache, pre-interrogation and batched interrogation, computed once per image and shared by every model.
+            # With reduced decoding the reduced copy is hashed, the interrogators never see the full resolution image
+            digests = [None] * len(prepared_images)
+            if len(prepared_images) > 1 or self.active_cache is not None or Script.precomputed or prefetcher is not None or Script.source_paths is not None:
+                digests = [image_digest(prepared.small()) for prepared in prepared_images]
+                # Different image objects with the same content are interrogated once
+                first_images, digest_slots = distinct_items(digests)
+                image_slots = [digest_slots[slot] for slot in image_slots]
+                batch_images = [batch_images[index] for index in first_images]
+                prepared_images = [prepared_images[index] for index in first_images]
+                digests = [digests[index] for index in first_images]
             
-            # Interrogator interrogation loop
-            for model in model_selection:
-                # Check for skipped job
-                if state.skipped:
-                    print("Job skipped.")
-                    state.skipped = False
-                    continue
-                    
-                # Check for interruption
-                if state.interrupted:
-                    print("Job interrupted. Ending process.")
-                    state.interrupted = False
-                    break
+            # Post-processing stages only depend on the prompts, they are shared by every image of the batch
+            # Dedupe, find and replace, filters and punctuation removal, see lib_tag_batch.pipeline
+            stages = post_processing_stages(
+                exaggeration_mode, use_custom_replace, custom_replace_find, custom_replace_replacements, use_positive_filter, p.prompt,
+                use_negative_filter, p.negative_prompt, use_custom_filter, custom_filter, no_puncuation_mode, Script.tag_filters, Script.replace_engines,
+                Script.rules_packs.index(rules_packs) if use_rules_packs and rules_packs else None
+            )
+            
+            # Multi-image batches run the WD (EXT) taggers once for all images, ONNX WD taggers in a single forward pass
+            batched = {}
+            if len(prepared_images) > 1 and model_selection:
+                units = self.get_interrogation_units(model_selection, clip_ext_model, clip_ext_mode, wd_ext_model)
+                batched = self.interrogate_batch_images(prepared_images, digests, units, unload_wd_models_afterwords, debug_mode)
+            
+            interrogations = []
+            # Post-processed tags and WD confidences of every image, for the token budget
+            tag_lists = []
+            for image_index, (init_image, prepared, digest) in enumerate(zip(batch_images, prepared_images, digests)):
+                if Script.metrics is not None:
+                    Script.metrics.begin_image(getattr(init_image, "filename", None) or f"image {state.job_no + 1}")
+                preliminary_interrogation = ""
+                # Tags of every interrogator with their source, carried through the post-processing and rendered once, see lib_tag_batch.tags
+                interrogation = TagList()
+                # Confidence of every WD tag by tag, the trim priority of the token budget
+                scores = {}
+                
+                # Waits for the lookahead worker if it is still interrogating this very image
+                if prefetcher is not None:
+                    prefetcher.claim(digest)
+                
+                # An existing sidecar caption replaces the interrogation, none of the models run for this image
+                image_path = self.get_source_path(init_image, digest) if use_sidecar_captions or export_sidecar_captions else None
+                sidecar_source, sidecar_caption = self.get_sidecar_caption(image_path) if use_sidecar_captions else (None, None)
+                models = model_selection
+                if sidecar_caption is not None:
+                    self.debug_print(debug_mode, f"[Sidecar Captions]: [Result]: {sidecar_caption}")
+                    interrogation.add(sidecar_caption, "Sidecar")
+                    models = []
+                    if Script.metrics is not None:
+                        Script.metrics.count("sidecar captions")
+            
+                # Near-duplicate frames (e.g. consecutive video frames) reuse the interrogation of a recent similar frame
+                frame_hash = None
+                if Script.recent_frames is not None and models:
+                    with self.measure("frame hash"):
+                        frame_hash = HASH_FUNCTIONS[frame_hash_method](prepared.small())
+                    distance, reused_interrogation, reused_scores = Script.recent_frames.find(frame_hash)
+                    if reused_interrogation is not None:
+                        self.debug_print(debug_mode, f"[Near-Duplicate Frames]: {distance} bit(s) from a recent frame, reusing its interrogation")
+                        # The WD confidences come along, the token budget trims the reused tags like the original ones
+                        interrogation, scores = reused_interrogation, reused_scores
+                        models = []
+                        frame_hash = None
+                        if Script.metrics is not None:
+                            Script.metrics.count("reused frames")
+            
+                # Concurrent interrogation, started before the loop so the loop below only collects the results in order
+                futures = {}
+                if use_concurrent_interrogation and models:
+                    units = [unit for unit in self.get_interrogation_units(model_selection, clip_ext_model, clip_ext_mode, wd_ext_model) if unit[:2] not in batched]
+                    futures = self.start_concurrent_interrogation(units, digest, prepared, concurrent_workers, unload_clip_models_afterwords, unload_wd_models_afterwords)
+            
+                # Results of the batched interrogation of this image
+                for unit, results in batched.items():
+                    futures[unit] = concurrent.futures.Future()
+                    futures[unit].set_result(results[image_index])
+                
+                # Interrogator interrogation loop
+                for model in models:
+                    # Check for skipped job
+                    if state.skipped:
+                        print("Job skipped.")
+                        state.skipped = False
+                        continue
                     
-                # Should add the interrogators in the order determined by the model_selection list
-                if model == "Deepbooru (Native)":
-                    preliminary_interrogation = deepbooru.model.tag(p.init_images[0]) 
-                    self.debug_print(debug_mode, f"[Deepbooru (Native)]: [Result]: {preliminary_interrogation}")
-                    interrogation += f"{preliminary_interrogation}, "
-                elif model == "CLIP (Native)":
-                    preliminary_interrogation = shared.interrogator.interrogate(p.init_images[0]) 
-                    self.debug_print(debug_mode, f"[CLIP (Native)]: [Result]: {preliminary_interrogation}")
-                    interrogation += f"{preliminary_interrogation}, "
-                elif model == "CLIP (EXT)":
-                    if self.clip_ext is not None:
-                        for clip_model in clip_ext_model:
-                            # Clip-Ext resets state.job system during runtime...
-                            job = state.job
-                            job_no = state.job_no
-                            job_count = state.job_count
-                            # Check for skipped job
-                            if state.skipped:
-                                print("Job skipped.")
-                                state.skipped = False
-                                continue
-                            # Check for interruption
-                            if state.interrupted:
-                                print("Job interrupted. Ending process.")
-                                state.interrupted = False
-                                break
-                            preliminary_interrogation = self.clip_ext.image_to_prompt(p.init_images[0], clip_ext_mode, clip_model) 
-                            if unload_clip_models_afterwords:
-                                self.clip_ext.unload()
-                            self.debug_print(debug_mode, f"[CLIP ({clip_model}:{clip_ext_mode})]: [Result]: {preliminary_interrogation}")
-                            interrogation += f"{preliminary_interrogation}, "
-                            # Redeclare variables for state.job system
-                            state.job = job
-                            state.job_no = job_no
-                            state.job_count = job_count
-                elif model == "WD (EXT)":
-                    if self.wd_ext_utils is not None:
-                        for wd_model in wd_ext_model:
-                            # Check for skipped job
-                            if state.skipped:
-                                print("Job skipped.")
-                                state.skipped = False
-                                continue
-                            # Check for interruption
-                            if state.interrupted:
-                                print("Job interrupted. Ending process.")
-                                state.interrupted = False
-                                break
-                            rating, tags = self.wd_ext_utils.interrogators[wd_model].interrogate(p.init_images[0])
-                            tags_list = [tag for tag, conf in tags.items() if conf > wd_threshold]
-                            if wd_underscore_fix:
-                                tags_spaced = [self.replace_underscores(tag) for tag in tags_list]
-                                preliminary_interrogation = ", ".join(tags_spaced) 
-                            else:
+                    # Check for interruption
+                    if state.interrupted:
+                        print("Job interrupted. Ending process.")
+                        self.stop_lookahead(debug_mode)
+                        self.flush_interrogation_cache()
+                        state.interrupted = False
+                        break
+                
+                    model_started = time.perf_counter()
+                    # Should add the interrogators in the order determined by the model_selection list
+                    if model == "Deepbooru (Native)":
+                        preliminary_interrogation = self.concurrent_or_cached(futures, digest, model, self.get_native_variant(model), "", lambda: self.interrogate_unit(model, "", "", prepared, unload_clip_models_afterwords, unload_wd_models_afterwords))
+                        self.debug_print(debug_mode, f"[Deepbooru (Native)]: [Result]: {preliminary_interrogation}")
+                        interrogation.add(preliminary_interrogation, model)
+                    elif model == "CLIP (Native)":
+                        preliminary_interrogation = self.concurrent_or_cached(futures, digest, model, self.get_native_variant(model), "", lambda: self.interrogate_unit(model, "", "", prepared, unload_clip_models_afterwords, unload_wd_models_afterwords))
+                        self.debug_print(debug_mode, f"[CLIP (Native)]: [Result]: {preliminary_interrogation}")
+                        interrogation.add(preliminary_interrogation, model)
+                    elif model == "Interrogation Worker":
+                        preliminary_interrogation = self.concurrent_or_cached(futures, digest, model, self.get_worker_variant(), "", lambda: self.interrogate_unit(model, "", "", prepared, unload_clip_models_afterwords, unload_wd_models_afterwords))
+                        self.debug_print(debug_mode, f"[Interrogation Worker]: [Result]: {preliminary_interrogation}")
+                        interrogation.add(preliminary_interrogation, model)
+                    elif model == "CLIP (EXT)":
+                        if self.clip_ext is not None:
+                            for clip_model in clip_ext_model:
+                                # Clip-Ext resets state.job system during runtime...
+                                job = state.job
+                                job_no = state.job_no
+                                job_count = state.job_count
+                                # Check for skipped job
+                                if state.skipped:
+                                    print("Job skipped.")
+                                    state.skipped = False
+                                    continue
+                                # Check for interruption
+                                if state.interrupted:
+                                    print("Job interrupted. Ending process.")
+                                    self.stop_lookahead(debug_mode)
+                                    self.flush_interrogation_cache()
+                                    state.interrupted = False
+                                    break
+                                with self.measure(f"interrogate {model}:{clip_model}"):
+                                    preliminary_interrogation = self.concurrent_or_cached(futures, digest, model, clip_model, clip_ext_mode, lambda: self.interrogate_unit(model, clip_model, clip_ext_mode, prepared, unload_clip_models_afterwords, unload_wd_models_afterwords))
+                                self.debug_print(debug_mode, f"[CLIP ({clip_model}:{clip_ext_mode})]: [Result]: {preliminary_interrogation}")
+                                interrogation.add(preliminary_interrogation, f"{model}:{clip_model}")
+                                # Redeclare variables for state.job system
+                                state.job = job
+                                state.job_no = job_no
+                                state.job_count = job_count
+                    elif model == "WD (EXT)":
+                        if self.wd_ext_utils is not None:
+                            for wd_model in wd_ext_model:
+                                # Check for skipped job
+                                if state.skipped:
+                                    print("Job skipped.")
+                                    state.skipped = False
+                                    continue
+                                # Check for interruption
+                                if state.interrupted:
+                                    print("Job interrupted. Ending process.")
+                                    self.stop_lookahead(debug_mode)
+                                    self.flush_interrogation_cache()
+                                    state.interrupted = False
+                                    break
+                                # The raw confidences are cached, so threshold and rating changes do not need a new interrogation
+                                wd_tag_store = self.get_wd_tag_store()
+                                with self.measure(f"interrogate {model}:{wd_model}"):
+                                    vector = wd_tag_store.decode(wd_model, self.concurrent_or_cached(futures, digest, model, wd_model, self.wd_cache_mode(wd_model), lambda: self.interrogate_unit(model, wd_model, "", prepared, unload_clip_models_afterwords, unload_wd_models_afterwords)))
+                                    if vector is None:
+                                        # Stored vector no longer matches the tagger vocabulary, interrogate again
+                                        with self.get_model_lock(model, wd_model):
+                                            vector = wd_tag_store.decode(wd_model, self.interrogate_unit(model, wd_model, "", prepared, unload_clip_models_afterwords, unload_wd_models_afterwords))
+                                tags_list, rating, confidences = wd_tag_store.select(wd_model, vector, wd_threshold, wd_underscore_fix, category_thresholds, wd_top_k, with_scores=True)
+                                for tag, confidence in zip(tags_list, confidences):
+                                    scores[remove_attention(tag)] = max(confidence, scores.get(remove_attention(tag), 0.0))
                                 preliminary_interrogation = ", ".join(tags_list)
-                            if unload_wd_models_afterwords:
-                                self.wd_ext_utils.interrogators[wd_model].unload()
-                            self.debug_print(debug_mode, f"[WD ({wd_model}:{wd_threshold})]: [Result]: {preliminary_interrogation}")
-                            self.debug_print(debug_mode, f"[WD ({wd_model}:{wd_threshold})]: [Ratings]: {rating}")
-                            if wd_append_ratings:
-                                qualifying_ratings = [key for key, value in rating.items() if value >= wd_ratings]
-                                if qualifying_ratings:
-                                    self.debug_print(wd_append_ratings, f"[WD ({wd_model}:{wd_threshold})]: Rating sensitivity set to {wd_ratings}, therefore rating is: {qualifying_ratings}")
-                                    preliminary_interrogation += ", " + ", ".join(qualifying_ratings)
-                                else:
-                                    self.debug_print(wd_append_ratings, f"[WD ({wd_model}:{wd_threshold})]: Rating sensitivity set to {wd_ratings}, unable to determine a rating! Perhaps the rating sensitivity is set too high.")
-                            interrogation += f"{preliminary_interrogation}, "
-                            
-            # Filter prevents overexaggeration of tags due to interrogation models having similar results 
-            if not exaggeration_mode:
-                interrogation = self.clean_string(interrogation)
+                                self.debug_print(debug_mode, f"[WD ({wd_model}:{wd_threshold})]: [Result]: {preliminary_interrogation}")
+                                self.debug_print(debug_mode, f"[WD ({wd_model}:{wd_threshold})]: [Ratings]: {rating}")
+                                if wd_append_ratings:
+                                    qualifying_ratings = [key for key, value in rating.items() if value >= wd_ratings]
+                                    if qualifying_ratings:
+                                        self.debug_print(wd_append_ratings, f"[WD ({wd_model}:{wd_threshold})]: Rating sensitivity set to {wd_ratings}, therefore rating is: {qualifying_ratings}")
+                                        preliminary_interrogation += ", " + ", ".join(qualifying_ratings)
+                                    else:
+                                        self.debug_print(wd_append_ratings, f"[WD ({wd_model}:{wd_threshold})]: Rating sensitivity set to {wd_ratings}, unable to determine a rating! Perhaps the rating sensitivity is set too high.")
+                                interrogation.add(preliminary_interrogation, f"{model}:{wd_model}")
+                
+                    if Script.metrics is not None:
+                        Script.metrics.add_time(f"interrogate {model}", time.perf_counter() - model_started)
             
-            # Find and Replace user defined words in the interrogation prompt
-            if use_custom_replace:
-                replace_pairs = self.parse_replace_pairs(custom_replace_find, custom_replace_replacements)
-                interrogation = self.custom_replace(interrogation, replace_pairs)
+                # Results that were not collected because of a skip or interruption, running ones still finish in the background
+                for future in futures.values():
+                    future.cancel()
+                # Only frames that were interrogated become a reference for the next frames
+                if frame_hash is not None and interrogation:
+                    Script.recent_frames.add(frame_hash, interrogation, scores)
+                # The interrogators are done with this image, frees the full resolution RGB copy and the model inputs
+                prepared.release()
+                            
+                interrogation = run_stages(interrogation, stages, Script.metrics.record_stage if Script.metrics is not None else None)
+                self.debug_print(debug_mode, f"[Tag Sources]: {', '.join(f'{source}: {count}' for source, count in interrogation.count_by_source().items())}")
+                tag_lists.append((interrogation, scores))
+                interrogation = interrogation.render()
             
-            # Remove duplicate prompt content from interrogator prompt
-            if use_positive_filter:
-                interrogation = self.filter_words(interrogation, p.prompt)
-            # Remove negative prompt content from interrogator prompt
-            if use_negative_filter:
-                interrogation = self.filter_words(interrogation, p.negative_prompt)
-            # Remove custom prompt content from interrogator prompt
-            if use_custom_filter:
-                interrogation = self.filter_words(interrogation, custom_filter)
-
-            # Experimental tool for removing puncuations, but commas and a variety of emojis
-            if no_puncuation_mode:
-                interrogation = self.remove_punctuation(interrogation)
+                if export_sidecar_captions:
+                    self.export_sidecar(image_path, interrogation, sidecar_export_directory, sidecar_source, debug_mode)
             
-            # This will weight the interrogation, and also ensure that trailing commas to the interrogation are correctly placed.
-            if prompt_weight_mode:
-                interrogation = f"({interrogation.rstrip(', ')}:{prompt_weight}), "
-            else:
-                interrogation = f"{interrogation.rstrip(', ')}, "
+                interrogations.append(interrogation)
+                
+                if Script.metrics is not None and image_index + 1 < len(prepared_images):
+                    Script.metrics.end_image()
             
             # Experimental reverse mode prep
             if not reverse_mode:
-                prompt = p.prompt
+                original_prompt = p.prompt
             else:
-                prompt = p.negative_prompt
+                original_prompt = p.negative_prompt
             
-            # This will construct the prompt
-            if prompt == "":
-                prompt = interrogation
-            elif in_front == "Append to prompt":
-                prompt = f"{prompt.rstrip(', ')}, {interrogation}"
-            else:
-                prompt = f"{interrogation}{prompt}"
+            # Exported sidecars keep the full interrogation, only the prompt is trimmed and put in canonical order.
+            # The canonical order comes last, the token budget ranks the tags of an interrogator by their original position
+            if use_token_budget or use_canonical_order:
+                canonical = CanonicalOrder(canonical_order, self.get_vocabulary_ranks(wd_ext_model, wd_underscore_fix) if canonical_order == "Vocabulary" else None, weight_quantization) if use_canonical_order else None
+                interrogations = []
+                for tag_list, scores in tag_lists:
+                    if use_token_budget:
+                        tag_list = self.fit_token_budget(tag_list, scores, original_prompt, prompt_weight_mode, prompt_weight, in_front, token_budget_chunks, trim_priority, pinned_tags, debug_mode)
+                    if canonical is not None:
+                        tag_list = canonical.apply(tag_list)
+                    interrogations.append(tag_list.render())
+            
+            with self.measure("assembly"):
+                # This will weight the interrogation, and also ensure that trailing commas to the interrogation are correctly placed.
+                interrogations = [weight_interrogation(interrogation, prompt_weight_mode, prompt_weight) for interrogation in interrogations]
+                # This will construct the prompt of every distinct image
+                image_prompts = [assemble_prompt(original_prompt, interrogation, in_front) for interrogation in interrogations]
+            # Prompt of each entry of p.init_images, the batch slots (and every n_iter batch) cycle through the init images
+            slot_prompts = [image_prompts[slot] for slot in image_slots]
+            prompt = slot_prompts[0]
+            interrogation = interrogations[image_slots[0]]
             
             # Experimental reverse mode assignment
             if not reverse_mode:
@@ -710,28 +1751,46 @@ class Script(scripts.ScriptBuiltinUI):
                 """
                 p.prompt = prompt
                 for i in range(len(p.all_prompts)):
-                    p.all_prompts[i] = prompt
-                # As far as I can tell, prompts is a list that is always 1, 
-                # as it is just p.prompt without the extra network syntax
-                # But since it is a list, I think it should be iterated through to future proof
+                    p.all_prompts[i] = slot_prompts[i % len(slot_prompts)]
+                # prompts holds the prompts of this batch without the extra network syntax, one per batch slot,
+                # slot i is generated from p.init_images[i]
                 for i in range(len(prompts)):
-                    prompts[i] = re.sub("[<].*[>]", "", prompt)
+                    prompts[i] = re.sub("[<].*[>]", "", slot_prompts[i % len(slot_prompts)])
             else:
                 p.negative_prompt = prompt
                 for i in range(len(p.all_negative_prompts)):
-                    p.all_negative_prompts[i] = prompt
-                
-            # Restore Alpha Channel
-            p.init_images[0] = init_image
+                    p.all_negative_prompts[i] = slot_prompts[i % len(slot_prompts)]
             
+            # Identical prompts to the previous batch let the webui reuse its conditioning
+            if Script.prompt_repeats.observe(slot_prompts[i % len(slot_prompts)] for i in range(max(1, len(prompts)))):
+                self.debug_print(debug_mode, "[Canonical Tag Order]: Same prompts as the previous batch")
+                if Script.metrics is not None:
+                    Script.metrics.count("repeated prompts")
+                
             # Prep for reset
             self.prompt_contamination = interrogation
+            self.contaminated_prompt = (prompt, original_prompt)
             
             # Prompt Output default is True
-            self.debug_print(prompt_output or debug_mode, f"[Prompt]: {prompt}")
+            for image_index, image_prompt in enumerate(image_prompts):
+                self.debug_print(prompt_output or debug_mode, f"[Prompt]: {image_prompt}" if len(image_prompts) == 1 else f"[Prompt {image_index + 1}/{len(image_prompts)}]: {image_prompt}")
+            if self.active_cache is not None:
+                self.debug_print(debug_mode, f"[Interrogation Cache]: {self.active_cache.stats()}")
+                # Last image of the batch job, the cache hits of the job are written at once
+                if state.job_no + 1 >= state.job_count:
+                    self.flush_interrogation_cache()
+            if Script.residency is not None:
+                self.debug_print(debug_mode, f"[Model Residency]: {Script.residency.summary()}")
+            if Script.metrics is not None:
+                Script.metrics.end_image()
+                # Last image of the batch job
+                if state.job_no + 1 >= state.job_count:
+                    self.write_metrics(debug_mode)
+            if export_sidecar_captions and state.job_no + 1 >= state.job_count:
+                self.flush_sidecars(debug_mode)
+            if state.job_no + 1 >= state.job_count:
+                self.report_frame_reuse()
+                if use_canonical_order or debug_mode:
+                    self.report_prompt_repeats()
             
             self.debug_print(debug_mode, f"End of {NAME} Process ({state.job_no+1}/{state.job_count})...")
-        
-#Startup Callbacks
-script_callbacks.on_app_started(Script.load_clip_ext_module_wrapper)
-script_callbacks.on_app_started(Script.load_wd_ext_module_wrapper)
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch import cache as cache_module
+from lib_tag_batch.cache import InterrogationCache
+
+# Every value is 100 bytes, a cache of 350 bytes holds 3 of them
+VALUE = "x" * 100
+MAX_SIZE_MB = 350 / (1024 * 1024)
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        self.now += 1.0
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "time", clock.time)
+    return clock
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache" / "interrogations.sqlite")
+
+# last_used as it is on disk, read through a second connection
+def stored_last_used(path):
+    connection = sqlite3.connect(path)
+    try:
+        return dict(connection.execute("SELECT key, last_used FROM entries").fetchall())
+    finally:
+        connection.close()
+
+def keys(cache):
+    return {key for key in ("a", "b", "c", "d", "e") if cache.contains(key)}
+
+def test_least_recently_used_is_evicted_first(path, clock):
+    cache = InterrogationCache(path, MAX_SIZE_MB)
+    for key in ("a", "b", "c"):
+        cache.put(key, VALUE)
+    cache.put("d", VALUE)
+    assert keys(cache) == {"b", "c", "d"}
+    cache.put("e", VALUE)
+    assert keys(cache) == {"c", "d", "e"}
+    assert cache.total_size == 300
+    cache.close()
+
+def test_hits_are_written_before_eviction(path, clock):
+    cache = InterrogationCache(path, MAX_SIZE_MB)
+    for key in ("a", "b", "c"):
+        cache.put(key, VALUE)
+    before = stored_last_used(path)
+    assert cache.get("a") == VALUE
+    # A hit is not written on its own
+    assert stored_last_used(path) == before
+    cache.put("d", VALUE)
+    # "a" was read after "b", so "b" is the least recently used entry
+    assert keys(cache) == {"a", "c", "d"}
+    assert stored_last_used(path)["a"] > before["c"]
+    cache.close()
+
+def test_flush_and_close_write_hits(path, clock):
+    cache = InterrogationCache(path, MAX_SIZE_MB)
+    cache.put("a", VALUE)
+    cache.put("b", VALUE)
+    cache.get("a")
+    cache.flush()
+    flushed = stored_last_used(path)
+    assert flushed["a"] > flushed["b"]
+    cache.get("b")
+    cache.close()
+    closed = stored_last_used(path)
+    assert closed["b"] > closed["a"] == flushed["a"]
+    assert (cache.hits, cache.misses) == (2, 0)
+
+def test_resize_evicts_with_hits(path, clock):
+    cache = InterrogationCache(path, MAX_SIZE_MB)
+    for key in ("a", "b", "c"):
+        cache.put(key, VALUE)
+    cache.get("a")
+    cache.resize(150 / (1024 * 1024))
+    assert keys(cache) == {"a"}
+    cache.close()
+
+def test_purge(path, clock):
+    cache = InterrogationCache(path, MAX_SIZE_MB)
+    cache.put("a", b"\x00" * 100)
+    assert cache.get("a") == b"\x00" * 100
+    assert cache.get("missing") is None
+    cache.purge()
+    assert len(cache) == 0
+    assert (cache.total_size, cache.hits, cache.misses) == (0, 0, 0)
+    # Hits from before the purge are dropped, flushing them does not bring the entries back
+    cache.flush()
+    cache.close()
+    assert stored_last_used(path) == {}
+    reopened = InterrogationCache(path, MAX_SIZE_MB)
+    assert reopened.total_size == 0
+    reopened.close()
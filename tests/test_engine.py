@@ -0,0 +1,112 @@
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch import cli
+from lib_tag_batch.engine import CaptionEngine, StubBackend, caption_file, list_uncaptioned, load_backend
+from lib_tag_batch.sidecar import write_sidecar
+
+# Backend returning a fixed caption, to check the joining and post-processing of the engine
+class FixedBackend:
+    def __init__(self, caption, name="fixed"):
+        self.caption = caption
+        self.name = name
+
+    def interrogate(self, image):
+        return self.caption
+
+@pytest.fixture
+def image_directory(tmp_path):
+    for index in range(3):
+        Image.new("RGB", (32, 24), (index * 80, 40, 120)).save(tmp_path / f"image{index}.png")
+    (tmp_path / "nested").mkdir()
+    Image.new("L", (16, 16), 200).save(tmp_path / "nested" / "gray.jpg")
+    (tmp_path / "notes.md").write_text("not an image", encoding="utf-8")
+    return tmp_path
+
+def read(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return file.read()
+
+def test_stub_backend_is_deterministic():
+    image = Image.new("RGB", (8, 8), (1, 2, 3))
+    caption = StubBackend().interrogate(image)
+    assert caption == StubBackend().interrogate(image.copy())
+    assert caption != StubBackend().interrogate(Image.new("RGB", (8, 8), (3, 2, 1)))
+    assert "_" not in caption
+    assert load_backend("stub", {"keep_underscores": True}).underscore_fix is False
+
+def test_engine_joins_and_post_processes_backends():
+    image = Image.new("RGB", (8, 8))
+    backends = [FixedBackend("1girl, smile, solo"), FixedBackend("smile, outdoors, sky", "second")]
+    assert CaptionEngine(backends).caption(image) == "1girl, smile, solo, outdoors, sky"
+    assert CaptionEngine(backends, exaggeration_mode=True).caption(image) == "1girl, smile, solo, smile, outdoors, sky"
+    engine = CaptionEngine(backends, custom_replace_find="smile", custom_replace_replacements="grin", custom_filter="sky")
+    assert engine.caption(image) == "1girl, grin, solo, outdoors"
+
+def test_list_uncaptioned(image_directory):
+    paths = list_uncaptioned(str(image_directory))
+    assert [os.path.relpath(path, image_directory) for path in paths] == ["image0.png", "image1.png", "image2.png", os.path.join("nested", "gray.jpg")]
+    (image_directory / "image1.txt").write_text("done", encoding="utf-8")
+    assert str(image_directory / "image1.png") not in list_uncaptioned(str(image_directory))
+    assert str(image_directory / "image1.png") in list_uncaptioned(str(image_directory), overwrite=True)
+
+def test_caption_file_writes_sidecar(image_directory):
+    engine = CaptionEngine([StubBackend()])
+    path = str(image_directory / "nested" / "gray.jpg")
+    result_path, seconds, error = caption_file(engine, path)
+    assert (result_path, error) == (path, None)
+    assert seconds >= 0
+    with Image.open(path) as image:
+        assert read(image_directory / "nested" / "gray.txt") == engine.caption(image.convert("RGB"))
+    assert not os.path.exists(str(image_directory / "nested" / "gray.txt.tmp"))
+
+def test_caption_file_reports_unreadable_image(tmp_path):
+    path = tmp_path / "broken.png"
+    path.write_bytes(b"not a png")
+    _, _, error = caption_file(CaptionEngine([StubBackend()]), str(path))
+    assert error is not None and error.startswith("UnidentifiedImageError")
+    assert not (tmp_path / "broken.txt").exists()
+
+def test_write_sidecar_replaces_existing_caption(tmp_path):
+    path = str(tmp_path / "image.txt")
+    write_sidecar(path, "old caption")
+    write_sidecar(path, "new caption")
+    assert read(path) == "new caption"
+    assert os.listdir(tmp_path) == ["image.txt"]
+
+def test_cli_captions_directory(image_directory, capsys):
+    assert cli.main([str(image_directory), "--backend", "stub", "--workers", "2", "--chunksize", "1"]) == 0
+    engine = CaptionEngine([StubBackend()])
+    for index in range(3):
+        with Image.open(image_directory / f"image{index}.png") as image:
+            assert read(image_directory / f"image{index}.txt") == engine.caption(image)
+    assert (image_directory / "nested" / "gray.txt").exists()
+    assert not (image_directory / "notes.txt").exists()
+    # Captioned images are skipped on the next run
+    assert cli.main([str(image_directory), "--backend", "stub", "--workers", "1"]) == 0
+    assert "Nothing to caption" in capsys.readouterr().out
+
+def test_cli_options(image_directory, tmp_path_factory):
+    filter_path = tmp_path_factory.mktemp("options") / "filter.txt"
+    with Image.open(image_directory / "image0.png") as image:
+        caption = StubBackend(underscore_fix=False).interrogate(image)
+    removed = next(tag for tag in caption.split(", ") if "_" in tag)
+    filter_path.write_text(removed, encoding="utf-8")
+    arguments = [str(image_directory), "--backend", "lib_tag_batch.engine:StubBackend", "--workers", "1", "--custom-filter", f"@{filter_path}", "--keep-underscores"]
+    assert cli.main(arguments) == 0
+    assert read(image_directory / "image0.txt").split(", ") == [tag for tag in caption.split(", ") if tag != removed]
+
+def test_cli_errors(image_directory, capsys):
+    assert cli.main([str(image_directory), "--backend", "missing"]) == 2
+    assert "Unknown backend `missing`" in capsys.readouterr().err
+    assert cli.main([str(image_directory), "--backend", "stub", "--rules-pack", str(image_directory / "none.txt")]) == 2
+    with pytest.raises(SystemExit):
+        cli.main([str(image_directory)])
+    (image_directory / "broken.png").write_bytes(b"not a png")
+    assert cli.main([str(image_directory), "--backend", "stub", "--workers", "1"]) == 1
+    assert "broken.png" in capsys.readouterr().err
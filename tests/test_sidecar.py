@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+from PIL import Image, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch.batching import list_images
+from lib_tag_batch.cache import image_digest
+from lib_tag_batch.sidecar import SourcePaths, find_sidecar
+
+# EXIF orientation "rotate 90 CW", width and height swap once transposed
+ROTATED = 6
+
+# Reads an image like the img2img batch tab: an EXIF-transposed copy, which has no filename
+def read_like_batch_tab(path):
+    with Image.open(path) as image:
+        return ImageOps.exif_transpose(image)
+
+def read_digest(path):
+    return image_digest(read_like_batch_tab(path).convert("RGB"))
+
+@pytest.fixture
+def batch_directory(tmp_path):
+    for index in range(4):
+        image = Image.new("RGB", (64, 48), (index * 60, 20, 200 - index * 40))
+        exif = Image.Exif()
+        exif[0x0112] = ROTATED
+        image.save(tmp_path / f"frame{index}.jpg", exif=exif)
+    (tmp_path / "frame2.txt").write_text("1girl, solo", encoding="utf-8")
+    return tmp_path
+
+def test_transposed_image_has_no_filename(batch_directory):
+    image = read_like_batch_tab(str(batch_directory / "frame0.jpg"))
+    assert image.size == (48, 64)
+    assert not getattr(image, "filename", None)
+
+def test_finds_source_of_transposed_image(batch_directory):
+    sources = SourcePaths(list_images(str(batch_directory)))
+    reads = []
+    def counting_digest(path):
+        reads.append(path)
+        return read_digest(path)
+    for index in range(4):
+        path = str(batch_directory / f"frame{index}.jpg")
+        image = read_like_batch_tab(path)
+        assert sources.find(image.size, image_digest(image.convert("RGB")), counting_digest) == path
+    # In directory order every file is read once
+    assert len(reads) == 4
+    assert find_sidecar(sources.find((48, 64), read_digest(str(batch_directory / "frame2.jpg")), counting_digest)).endswith("frame2.txt")
+
+def test_remembered_digest_needs_no_read(batch_directory):
+    path = str(batch_directory / "frame3.jpg")
+    sources = SourcePaths(list_images(str(batch_directory)))
+    sources.remember(read_digest(path), path)
+    def no_read(path):
+        raise AssertionError(f"{path} should not be read")
+    assert sources.find((48, 64), read_digest(path), no_read) == path
+
+def test_unknown_image_is_not_found(batch_directory):
+    sources = SourcePaths(list_images(str(batch_directory)))
+    image = Image.new("RGB", (48, 64), (1, 2, 3))
+    assert sources.find(image.size, image_digest(image), read_digest) is None
+    # Wrong size, no file is read
+    assert sources.find((10, 10), "0" * 40, read_digest) is None
@@ -0,0 +1,95 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch.pipeline import clean_string, post_processing_stages, run_stages
+from lib_tag_batch.tags import TagList
+from lib_tag_batch.text import ReplaceEngineCache, TagFilterCache, parse_replace_pairs, remove_punctuation
+
+WORDS = ["1girl", "solo", "long hair", "long_hair", "hair", "blue eyes", "smile", "Smile", "sky", "cat", "cat ears", "a", "b", "a b"]
+# Emoticons, including the ones holding a comma that span two pieces
+EMOTICONS = [":)", ":-D", ":-,", "',:-|", "^_^", "<3", "\\o/"]
+
+def make_piece(rng):
+    word = rng.choice(WORDS + EMOTICONS) if rng.random() < 0.2 else rng.choice(WORDS)
+    choice = rng.randrange(7)
+    if choice == 0:
+        return f"({word}:{rng.choice(['1.2', '0.8'])})"
+    if choice == 1:
+        return f"{word}!"
+    if choice == 2:
+        return f" {word}  "
+    if choice == 3:
+        return f"{word} \\(cosplay\\)"
+    return word
+
+# Output of one interrogator, as the models return it
+def make_output(rng):
+    pieces = [make_piece(rng) for _ in range(rng.randrange(8))]
+    return rng.choice([", ", ",", " , "]).join(pieces)
+
+def make_settings(rng):
+    finds = ", ".join(rng.choice(WORDS + ["", "-", ":)"]) for _ in range(rng.randrange(4)))
+    replacements = ", ".join(rng.choice(WORDS + ["", "x y", "(\\g<0>:1.1)"]) for _ in range(rng.randrange(4)))
+    return {
+        "exaggeration_mode": rng.random() < 0.3,
+        "use_custom_replace": rng.random() < 0.5,
+        "custom_replace_find": finds,
+        "custom_replace_replacements": replacements,
+        "use_positive_filter": rng.random() < 0.5,
+        "prompt": make_output(rng),
+        "use_negative_filter": rng.random() < 0.5,
+        "negative_prompt": make_output(rng),
+        "use_custom_filter": rng.random() < 0.5,
+        "custom_filter": make_output(rng),
+        "no_puncuation_mode": rng.random() < 0.5,
+    }
+
+# Stages as they worked on the joined string before the tag list, in the same order
+def string_stages(interrogation, settings, tag_filters, replace_engines):
+    if not settings["exaggeration_mode"]:
+        interrogation = clean_string(interrogation)
+    if settings["use_custom_replace"]:
+        interrogation = replace_engines.from_text(settings["custom_replace_find"], settings["custom_replace_replacements"]).apply(interrogation)
+    for enabled, text in (("use_positive_filter", "prompt"), ("use_negative_filter", "negative_prompt"), ("use_custom_filter", "custom_filter")):
+        if settings[enabled]:
+            interrogation = tag_filters.get(settings[text]).apply(interrogation)
+    if settings["no_puncuation_mode"]:
+        interrogation = remove_punctuation(interrogation)
+    return interrogation
+
+def test_tag_list_stages_match_string_stages():
+    rng = random.Random(18)
+    tag_filters, replace_engines = TagFilterCache(), ReplaceEngineCache()
+    for _ in range(3000):
+        outputs = [make_output(rng) for _ in range(rng.randrange(1, 4))]
+        settings = make_settings(rng)
+        interrogation = ""
+        tag_list = TagList()
+        for index, output in enumerate(outputs):
+            interrogation += f"{output}, "
+            tag_list.add(output, f"model {index}")
+        assert tag_list.render() == interrogation
+        stages = post_processing_stages(
+            settings["exaggeration_mode"], settings["use_custom_replace"], settings["custom_replace_find"], settings["custom_replace_replacements"],
+            settings["use_positive_filter"], settings["prompt"], settings["use_negative_filter"], settings["negative_prompt"],
+            settings["use_custom_filter"], settings["custom_filter"], settings["no_puncuation_mode"], tag_filters, replace_engines
+        )
+        expected = string_stages(interrogation, settings, tag_filters, replace_engines)
+        result = run_stages(tag_list, stages)
+        assert result.render() == expected, (outputs, settings)
+        assert run_stages(interrogation, stages) == expected
+        assert len(result.tags) == len(result.sources)
+
+def test_sources_follow_their_tags():
+    tag_list = TagList().add("1girl, smile", "Deepbooru").add("smile, sky", "WD")
+    assert tag_list.count_by_source() == {"Deepbooru": 2, "WD": 2}
+    engines = ReplaceEngineCache()
+    deduped = tag_list.dedupe().replace(engines.from_pairs(parse_replace_pairs("sky", "blue sky")))
+    assert deduped.render() == "1girl, smile, blue sky"
+    assert deduped.count_by_source() == {"Deepbooru": 2, "WD": 1}
+    filtered = deduped.filter(TagFilterCache().get("(smile:1.2)"))
+    assert list(zip([tag.text for tag in filtered.tags], filtered.sources)) == [("1girl", "Deepbooru"), ("blue sky", "WD")]
+    assert len(filtered) == 2
@@ -0,0 +1,179 @@
+import os
+import random
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch.text import EMOTICONS, ReplaceEngine, ReplaceEngineCache, TagFilter, TagFilterCache, parse_replace_pairs, remove_attention, remove_punctuation
+
+# Pieces the random prompts are made of: words, attention syntax, escaped parentheses, spacing and empty tags
+WORDS = ["girl", "1girl", "solo", "long hair", "long_hair", "hair", "blue eyes", "smile", "Smile", "sky", "cat", "cat ears", "a", "b"]
+
+# Tag as a user or an interrogator may write it
+def decorate(word, rng):
+    choice = rng.randrange(8)
+    if choice == 0:
+        return f"({word}:{rng.choice(['1.2', '0.8', '2', '1.15'])})"
+    if choice == 1:
+        return f"({word})"
+    if choice == 2:
+        return f"{word} \\(cosplay\\)"
+    if choice == 3:
+        return f"  {word} "
+    if choice == 4:
+        return f"(({word}))"
+    return word
+
+def make_prompt(rng, words=WORDS, length=12):
+    pieces = [decorate(rng.choice(words), rng) for _ in range(rng.randrange(length + 1))]
+    if rng.random() < 0.3:
+        pieces.insert(rng.randrange(len(pieces) + 1), "")
+    return ",".join(pieces) if rng.random() < 0.3 else ", ".join(pieces)
+
+# Previous implementation of the tag filters, the reference for the output
+def legacy_remove_attention(words):
+    words = re.sub(r":\d+(\.\d+)?", "", words)
+    words = re.sub(r"\\\(", r"TEMP_LEFT_PLACEHOLDER", words)
+    words = re.sub(r"\\\)", r"TEMP_RIGHT_PLACEHOLDER", words)
+    words = re.sub(r"(\(|\))", "", words)
+    words = re.sub(r"TEMP_LEFT_PLACEHOLDER", r"\\(", words)
+    words = re.sub(r"TEMP_RIGHT_PLACEHOLDER", r"\\)", words)
+    return words.strip()
+
+def legacy_filter_words(prompt, negative):
+    if negative is None:
+        negative = ""
+    prompt_words = [word.strip() for word in prompt.split(",")]
+    negative_words = [legacy_remove_attention(word.strip()) for word in negative.split(",")]
+    filtered_words = [word for word in prompt_words if legacy_remove_attention(word) not in negative_words]
+    return ", ".join(filtered_words)
+
+@pytest.mark.parametrize("words", ["(long hair:1.2)", "((smile))", "cat \\(cosplay\\)", "sky:2", " (a:0.5) ", "\\((b)\\)", ""])
+def test_remove_attention(words):
+    assert remove_attention(words) == legacy_remove_attention(words)
+
+def test_tag_filter_matches_legacy():
+    rng = random.Random(6)
+    filters = TagFilterCache()
+    for _ in range(3000):
+        prompt, negative = make_prompt(rng), make_prompt(rng, length=6)
+        assert filters.get(negative).apply(prompt) == legacy_filter_words(prompt, negative)
+        assert remove_attention(prompt) == legacy_remove_attention(prompt)
+
+def test_tag_filter_none_and_cache():
+    filters = TagFilterCache(max_filters=2)
+    assert filters.get(None).apply("a, , b") == legacy_filter_words("a, , b", None)
+    first = filters.get("a, b")
+    assert filters.get("a, b") is first
+    filters.get("c")
+    filters.get("d")
+    assert filters.get("a, b") is not first
+    assert "(a:1.5)" in TagFilter("a, b")
+
+# Previous implementation of find & replace, one re.sub per pair in order
+def legacy_custom_replace(text, replace_pairs):
+    for old, new in replace_pairs.items():
+        text = re.sub(r'\b' + re.escape(old) + r'\b', new, text)
+    return text
+
+# Finds and replacements that overlap, chain into each other, delete, change word boundaries or use templates
+REPLACE_WORDS = ["a", "b", "ab", "a b", "b a", "cat", "cat ears", "ears", "hair", "long hair", "a-b", "-b", "a-", ":)", "x_y", "1girl", "girl"]
+REPLACEMENTS = REPLACE_WORDS + ["", " ", "c", "-", "b b", "\\g<0>!", "x\\g<0>", "(\\g<0>:1.2)"]
+
+def make_pairs(rng):
+    pairs = {}
+    for _ in range(rng.randrange(1, 7)):
+        old = "" if rng.random() < 0.03 else rng.choice(REPLACE_WORDS)
+        pairs[old] = rng.choice(REPLACEMENTS)
+    return pairs
+
+def make_text(rng):
+    tokens = REPLACE_WORDS + ["catgirl", "a_b", "b_", "(a:1.2)", "ab-a"]
+    separators = [" ", ", ", ",", "-", "", "  "]
+    return "".join(rng.choice(tokens) + rng.choice(separators) for _ in range(rng.randrange(1, 10)))
+
+def test_replace_engine_matches_legacy():
+    rng = random.Random(7)
+    for _ in range(4000):
+        pairs = make_pairs(rng)
+        engine = ReplaceEngine(pairs)
+        for _ in range(5):
+            text = make_text(rng)
+            assert engine.apply(text) == legacy_custom_replace(text, pairs), (pairs, text)
+            assert engine.apply_tag(text) == engine.apply(text)
+
+# Pairs whose order matters are split into runs, independent pairs share one scan
+@pytest.mark.parametrize("pairs, runs, text, expected", [
+    ({"cat": "dog", "sky": "sea", "hair": "fur"}, 1, "cat, sky, long hair", "dog, sea, long fur"),
+    # The replacement of the first pair creates a match of the second
+    ({"a": "b", "b": "c"}, 2, "a b", "c c"),
+    # Overlapping finds, the first one wins where they overlap
+    ({"a b": "x", "b c": "y"}, 2, "a b c, b c", "x c, y"),
+    # A deletion joins its neighbours into new word boundaries
+    ({"-": "", "ab": "z"}, 2, "a-b, ab", "z, z"),
+    # An empty find matches every word boundary
+    ({"": "|", "a": "b"}, 2, "a c", "|b| |c|"),
+    # A template whose first character is not a word character changes the word boundary in front of it
+    ({"cat": "(\\g<0>:1.2)", "ears": "tail"}, 2, "cat ears", "(cat:1.2) tail"),
+])
+def test_replace_engine_runs(pairs, runs, text, expected):
+    engine = ReplaceEngine(pairs)
+    assert len(engine.runs) == runs
+    assert engine.apply(text) == expected == legacy_custom_replace(text, pairs)
+
+def test_replace_engine_cache():
+    engines = ReplaceEngineCache(max_engines=2)
+    engine = engines.from_text("cat, sky, extra", "dog, sea")
+    assert engine.pairs == [("cat", "dog"), ("sky", "sea")] == list(parse_replace_pairs("cat, sky, extra", "dog, sea").items())
+    assert engines.from_text("cat, sky, extra", "dog, sea") is engine
+    assert engines.from_pairs({"cat": "dog"}) is engines.from_pairs({"cat": "dog"})
+    engines.from_text("a", "b")
+    assert engines.from_text("cat, sky, extra", "dog, sea") is not engine
+
+# Previous No Puncuation Mode, emoticons were swapped for numbered placeholders and restored afterwards
+def legacy_remove_punctuation(text):
+    for i, noticables in enumerate(EMOTICONS):
+        text = text.replace(noticables, f"SKIP_PLACEHOLDER_{i}")
+    text = re.sub(r'[^\w\s,]', '', text)
+    tags = [tag.strip() for tag in text.split(',')]
+    tags = [tag for tag in tags if tag]
+    text = ', '.join(tags)
+    for i, noticables in enumerate(EMOTICONS):
+        text = text.replace(f"SKIP_PLACEHOLDER_{i}", noticables)
+    return text
+
+# WD and CLIP style text with punctuation, the old and new versions only differ where an emoticon occurs
+def make_punctuated_text(rng):
+    words = WORDS + ["cat's", "a.b", "well-known", "über", "日本", "x_y", "42"]
+    marks = ["", "", "!", "?", ".", "-", "(", ")", "[", "]", "\\", "/", "'", '"', "*", "&"]
+    separators = [", ", ",", " ", " , ", ",,", "\n"]
+    return "".join(rng.choice(marks) + decorate(rng.choice(words), rng) + rng.choice(marks) + rng.choice(separators) for _ in range(rng.randrange(10)))
+
+def test_remove_punctuation_matches_legacy_without_emoticons():
+    rng = random.Random(8)
+    compared = 0
+    while compared < 3000:
+        text = make_punctuated_text(rng)
+        if any(emoticon in text for emoticon in EMOTICONS):
+            continue
+        assert remove_punctuation(text) == legacy_remove_punctuation(text), text
+        compared += 1
+
+# The old version mangled these, see the user-008 commit
+@pytest.mark.parametrize("text, expected", [
+    # Placeholders above 9 were restored through the SKIP_PLACEHOLDER_1 prefix
+    ("smile :-D, ok", "smile :-D, ok"),
+    # Escape sequences were written back instead of the emoticon
+    ("heart <\\3, yay!", "heart <\\3, yay"),
+    ("\\o/ wave", "\\o/ wave"),
+    # Text that looked like a placeholder was rewritten
+    ("its SKIP_PLACEHOLDER_3 x", "its SKIP_PLACEHOLDER_3 x"),
+    # The longest emoticon at a position is kept whole
+    ("happy :-)) face", "happy :-)) face"),
+    ("cat's ears!!, , (smile:1.2)", "cat's ears, smile12"),
+])
+def test_remove_punctuation_keeps_emoticons(text, expected):
+    assert remove_punctuation(text) == expected
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch.wd_store import TagConfidenceStore, selected_tags_vocabulary
+
+RATINGS = ["general", "sensitive", "questionable", "explicit"]
+TAGS = [("1girl", 0), ("solo", 0), ("hatsune_miku", 4), ("vocaloid", 3)]
+
+@pytest.fixture
+def tags_path(tmp_path):
+    rows = [f"{index},{name},9,0" for index, name in enumerate(RATINGS)]
+    rows += [f"{index + 4},{name},{category},0" for index, (name, category) in enumerate(TAGS)]
+    path = tmp_path / "selected_tags.csv"
+    path.write_text("tag_id,name,category,count\n" + "\n".join(rows) + "\n", encoding="utf-8")
+    return path
+
+def make_store(tmp_path):
+    return TagConfidenceStore(str(tmp_path / "wd_vocabulary.json"), lambda tag: tag.replace("_", " "))
+
+# One interrogation like wd_ext_utils returns it
+def interrogate():
+    rating = dict(zip(RATINGS, (0.9, 0.1, 0.0, 0.0)))
+    tags = dict(zip((name for name, _ in TAGS), (0.99, 0.8, 0.7, 0.2)))
+    return rating, tags
+
+def test_selected_tags_vocabulary(tags_path):
+    ratings, tags, categories = selected_tags_vocabulary(str(tags_path))
+    assert ratings == RATINGS
+    assert tags == [name for name, _ in TAGS]
+    assert categories == ["general", "general", "character", "copyright"]
+
+def test_registered_cache_mode_does_not_change_with_first_encode(tmp_path, tags_path):
+    store = make_store(tmp_path)
+    assert store.cache_mode("wd-v1-4") == "confidences:new"
+    store.register("wd-v1-4", *selected_tags_vocabulary(str(tags_path)))
+    mode = store.cache_mode("wd-v1-4")
+    assert mode != "confidences:new"
+    # Keys made by pre-interrogation and lookahead before the first interrogation match the keys made after it
+    vector = store.decode("wd-v1-4", store.encode("wd-v1-4", *interrogate()))
+    assert store.cache_mode("wd-v1-4") == mode
+    names, ratings = store.select("wd-v1-4", vector, 0.5)
+    assert names == ["1girl", "solo", "hatsune miku"]
+    assert ratings["general"] == pytest.approx(0.9)
+    # A later run loads the vocabulary from the file, the mode is the same
+    assert make_store(tmp_path).cache_mode("wd-v1-4") == mode
+
+def test_unregistered_model_changes_mode_on_first_encode(tmp_path):
+    store = make_store(tmp_path)
+    store.encode("other", *interrogate())
+    assert store.cache_mode("other") != "confidences:new"
+
+def test_changed_vocabulary_does_not_decode_old_vectors(tmp_path, tags_path):
+    store = make_store(tmp_path)
+    store.register("wd-v1-4", *selected_tags_vocabulary(str(tags_path)))
+    blob = store.encode("wd-v1-4", *interrogate())
+    mode = store.cache_mode("wd-v1-4")
+    rating, tags = interrogate()
+    tags = {name.upper(): value for name, value in tags.items()}
+    store.encode("wd-v1-4", rating, tags)
+    assert store.cache_mode("wd-v1-4") != mode
+    assert store.decode("wd-v1-4", blob) is None
+    assert isinstance(store.decode("wd-v1-4", store.encode("wd-v1-4", rating, tags)), np.ndarray)
@@ -0,0 +1,167 @@
+import io
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib_tag_batch.engine import StubBackend
+from lib_tag_batch.worker import (
+    HEADER_LENGTH, MAX_HEADER_SIZE, InterrogationWorker, WorkerClient, WorkerError, WorkerServer, encode_frame, read_frame
+)
+
+# Backend that fails on purpose, for the error responses
+class FailingBackend:
+    name = "failing"
+
+    def interrogate(self, image):
+        raise ValueError("no model")
+
+# Worker server that remembers its connections, so a test can drop them like a restarted worker
+class RestartableServer(WorkerServer):
+    def __init__(self, address, worker):
+        self.connections = []
+        super().__init__(address, worker)
+
+    def finish_request(self, request, client_address):
+        self.connections.append(request)
+        super().finish_request(request, client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def address_of(server):
+    host, port = server.server_address[:2]
+    return f"{host}:{port}"
+
+@pytest.fixture
+def server():
+    server = start(RestartableServer("127.0.0.1:0", InterrogationWorker([StubBackend()], "stub-signature")))
+    yield server
+    server.stop()
+
+def make_images(count):
+    return [Image.new("RGB", (24, 16), (index * 20, 100, 200 - index * 10)) for index in range(count)]
+
+def test_frames_round_trip():
+    data = encode_frame({"id": 3, "op": "interrogate"}, b"\x00\x01\x02") + encode_frame({"id": 4, "op": "info"})
+    file = io.BytesIO(data)
+    assert read_frame(file) == ({"id": 3, "op": "interrogate", "size": 3}, b"\x00\x01\x02")
+    assert read_frame(file) == ({"id": 4, "op": "info", "size": 0}, b"")
+    with pytest.raises(EOFError):
+        read_frame(file)
+    # Payload cut short
+    with pytest.raises(EOFError):
+        read_frame(io.BytesIO(encode_frame({"id": 5}, b"\x00\x01\x02")[:-1]))
+    with pytest.raises(WorkerError):
+        read_frame(io.BytesIO(HEADER_LENGTH.pack(MAX_HEADER_SIZE + 1)))
+
+def test_info_and_interrogation(server):
+    client = WorkerClient(address_of(server))
+    info = client.info()
+    assert info["backends"] == ["stub"]
+    assert client.signature == "stub-signature"
+    images = make_images(3) + [Image.new("RGBA", (8, 8), (1, 2, 3, 4))]
+    expected = [StubBackend().interrogate(image.convert("RGB")) for image in images]
+    assert client.interrogate_many(images) == expected
+    assert client.interrogate(images[0]) == expected[0]
+    assert client.info()["requests"] == 5
+    client.close()
+
+@pytest.mark.parametrize("depth", [1, 3, 8])
+def test_pipelined_requests(server, depth):
+    client = WorkerClient(address_of(server), depth=depth)
+    client.connect()
+    # Requests already sent every time a response is read
+    sent_at_read = []
+    connection, file = client.connection, client.file
+
+    class CountingSocket:
+        sent = 0
+
+        def sendall(self, data):
+            CountingSocket.sent += 1
+            connection.sendall(data)
+
+    class CountingFile:
+        def read(self, size):
+            if size == HEADER_LENGTH.size:
+                sent_at_read.append(CountingSocket.sent)
+            return file.read(size)
+
+    client.connection, client.file = CountingSocket(), CountingFile()
+    images = make_images(5)
+    assert client.interrogate_many(images) == [StubBackend().interrogate(image) for image in images]
+    assert sent_at_read == [min(5, index + depth) for index in range(5)]
+    client.connection, client.file = connection, file
+    client.close()
+
+def test_error_responses():
+    server = start(WorkerServer("127.0.0.1:0", InterrogationWorker([FailingBackend()])))
+    try:
+        client = WorkerClient(address_of(server))
+        with pytest.raises(WorkerError, match="ValueError: no model"):
+            client.interrogate(make_images(1)[0])
+        assert client.exchange([({"op": "unknown"}, b"")])[0]["error"] == "Unknown operation unknown"
+        # The connection stays usable after failed requests
+        assert client.info()["requests"] == 1
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# Answers every request with a wrong id
+class OutOfOrderHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header, _ = read_frame(self.rfile)
+            except (EOFError, OSError):
+                return
+            self.wfile.write(encode_frame({"id": header["id"] + 100}))
+
+def test_out_of_order_response_is_rejected():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), OutOfOrderHandler)
+    server.daemon_threads = True
+    start(server)
+    try:
+        client = WorkerClient(address_of(server))
+        with pytest.raises(WorkerError, match="out of order"):
+            client.info()
+        assert client.connection is None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_reconnects_after_worker_restart(server):
+    address = address_of(server)
+    client = WorkerClient(address)
+    image = make_images(1)[0]
+    expected = client.interrogate(image)
+    server.stop()
+    restarted = start(RestartableServer(address, InterrogationWorker([StubBackend()], "stub-signature")))
+    try:
+        # The dropped connection is opened again once, the request is not lost
+        assert client.interrogate(image) == expected
+        assert client.info()["requests"] == 1
+        restarted.stop()
+        with pytest.raises(WorkerError, match="not reachable"):
+            client.interrogate(image)
+    finally:
+        restarted.stop()
+        client.close()